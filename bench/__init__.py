@@ -0,0 +1,5 @@
+"""Tools for exercising redisfuse without a kernel mount.
+
+Each module drives the Redis operations class directly, the way fuse.py
+would, and is run with `python -m bench.<module>` from the top of the tree.
+"""
@@ -0,0 +1,100 @@
+"""Random writes into a big file, as one value and in chunks.
+
+Starts a stand-in (bench/server.py) and writes a --mb megabyte file
+through the filesystem, as a hash field (/ch/disk.img is field img of
+the hash ch:disk) the way a dotted name is stored by default, then with
+--chunk-size.  Then overwrites --writes random 4 KB blocks of it, each
+flushed on its own the way a database or VM image does, and trims a few
+bytes off its end a few times, and reports the operations per second
+and the biggest value redis ended up holding.
+
+Every HSETRANGE and TRUNCATE splices the whole field server-side, so
+their cost grows with the file; chunked, each only splices one chunk.
+(Strings are spliced in place by SETRANGE in a real redis: for them the
+gain is mostly the bounded value size.)
+
+    python -m bench.chunks [--mb N] [--chunk-size KB] [--writes N]
+"""
+
+from __future__ import absolute_import
+
+import random
+import sys
+from optparse import OptionParser
+from timeit import default_timer
+
+import redis
+
+from bench.server import Server
+from redisfuse import Redis
+
+BLOCK = 4096
+PATH = '/ch/disk.img'
+TRIMS = 20
+
+
+def run(server, mb, chunk_size, writes):
+  client = redis.Redis(server.host, server.port)
+  client.delete('ch:disk', 'ch:disk.img')
+  client.hset('ch:disk', 'img', '')
+  fs = Redis(server.host, server.port, watch=False, cache_size=0,
+      chunk_size=chunk_size)
+  fs('init', '/')
+  list(fs('readdir', '/ch', 0))
+  fh = fs('open', PATH, 2)
+  block = '\1' * (1 << 20)
+  for offset in xrange(0, mb << 20, len(block)):
+    fs('write', PATH, block, offset, fh)
+  fs('flush', PATH, fh)
+  rng = random.Random(1)
+  expected = bytearray(block * mb)
+
+  start = default_timer()
+  for i in xrange(writes):
+    offset = rng.randrange(0, (mb << 20) // BLOCK) * BLOCK
+    data = chr(i % 255 + 1) * BLOCK
+    fs('write', PATH, data, offset, fh)
+    fs('fsync', PATH, 0, fh)
+    expected[offset:offset + BLOCK] = data
+  written = default_timer() - start
+  start = default_timer()
+  for i in xrange(TRIMS):
+    del expected[-BLOCK:]
+    fs('truncate', PATH, len(expected), fh)
+  trimmed = default_timer() - start
+  fs('release', PATH, fh)
+
+  right = fs('read', PATH, len(expected) + 1, 0, 0) == str(expected)
+  largest = max(len(value) for key in client.scan_iter('ch:*')
+      for value in client.hgetall(key).values())
+  return (writes / written, TRIMS / trimmed, largest, right)
+
+
+def main():
+  parser = OptionParser(usage='usage: %prog [--mb N] [--chunk-size KB] '
+      '[--writes N]')
+  parser.add_option('--mb', type='int', default=32,
+      help='megabytes in the file [default: %default]')
+  parser.add_option('--chunk-size', type='int', default=256,
+      help='kilobytes per chunk [default: %default]')
+  parser.add_option('--writes', type='int', default=500,
+      help='random 4 KB blocks overwritten [default: %default]')
+  (options, args) = parser.parse_args()
+  server = Server().start()
+  try:
+    print '%-16s %10s %10s %12s' % ('', 'writes/s', 'trims/s', 'largest')
+    good = True
+    for (name, chunk_size) in (('one value', None),
+        ('%d KB chunks' % options.chunk_size, options.chunk_size << 10)):
+      (writes, trims, largest, right) = run(server, options.mb, chunk_size,
+          options.writes)
+      print '%-16s %10.0f %10.0f %12d%s' % (name, writes, trims, largest,
+          '' if right else '  WRONG')
+      good = good and right
+    return good
+  finally:
+    server.stop()
+
+
+if __name__ == "__main__":
+  sys.exit(0 if main() else 1)
@@ -0,0 +1,153 @@
+"""Mounting a Redis Cluster.
+
+Starts stand-in clusters (bench/server.py) of more and more primaries,
+each reply held back --delay milliseconds like a network would, spreads
+the same keys over each, and times the first full listing and a lazy
+listing of one directory through the filesystem.  Walking and resolving
+every shard at once should make the full listing about as quick as the
+biggest shard.  Then, on the biggest cluster, checks that writes, partial
+writes to hash fields (scripts), truncates and renames between slots
+land, and that a slot moving to another node (MOVED) is followed.
+
+    python -m bench.cluster [--keys N] [--delay MS] [nodes ...]
+
+Needs redis-py-cluster.  nodes defaults to 1 2 4 8.
+"""
+
+from __future__ import absolute_import
+
+import sys
+from optparse import OptionParser
+from timeit import default_timer
+
+from bench.server import Cluster as StandIn, keyslot
+from cluster import Cluster, RedisCluster
+from redisfuse import Redis
+
+PER_DIR = 100
+
+
+def load(client, keys):
+  pipe = client.pipeline(transaction=False)
+  for i in xrange(keys):
+    key = 'clu:%d:k%d' % (i // PER_DIR, i)
+    if i % 10 == 0:
+      pipe.hset(key, 'a', 'x' * 10)
+    else:
+      pipe.set(key, 'v' * (i % 100))
+    if i % 1000 == 999:
+      pipe.execute()
+  pipe.execute()
+
+
+def mounted(standin, **options):
+  fs = Redis(standin.host, standin.port, cluster=True, watch=False,
+      cache_size=0, **options)
+  fs('init', '/')
+  return fs
+
+
+def timed(nodes, keys, delay):
+  standin = StandIn(nodes).start()
+  try:
+    load(Cluster(standin.host, standin.port), keys)
+    for server in standin.servers:
+      server.delay = delay
+    fs = mounted(standin)
+    start = default_timer()
+    listed = sum(1 for entry in walk(fs, '/'))
+    full = default_timer() - start
+    fs = mounted(standin, lazy=True)
+    start = default_timer()
+    for path in ('/clu', '/clu/0'):
+      fs('getattr', path)
+    list(fs('readdir', '/clu/0', 0))
+    lazy = default_timer() - start
+    print '%5d %10d %10.2f %10.3f' % (nodes, listed, full, lazy)
+    return listed == keys
+  finally:
+    standin.stop()
+
+
+def walk(fs, path):
+  for (name, attrs, offset) in fs('readdir', path, 0):
+    if name in ('.', '..'):
+      continue
+    child = path.rstrip('/') + '/' + name
+    if attrs['st_mode'] & 0040000:
+      for found in walk(fs, child):
+        yield found
+    else:
+      yield child
+
+
+def check(nodes):
+  """Writes and redirects on a cluster of nodes primaries."""
+  standin = StandIn(nodes).start()
+  try:
+    client = Cluster(standin.host, standin.port)
+    client.hset('chk:hash', 'f', 'x' * 10)
+    fs = mounted(standin)
+    list(fs('readdir', '/', 0))
+    wrong = []
+
+    fh = fs('create', '/chk/new', 0644)
+    fs('write', '/chk/new', 'hello', 0, fh)
+    fs('release', '/chk/new', fh)
+    if client.get('chk:new') != 'hello':
+      wrong.append('write')
+
+    fh = fs('open', '/chk/hash.f', 2)
+    fs('write', '/chk/hash.f', 'yy', 3, fh)
+    fs('write', '/chk/hash.f', 'zz', 8, fh)
+    fs('release', '/chk/hash.f', fh)
+    if client.hget('chk:hash', 'f') != 'xxxyyxxxzz':
+      wrong.append('hash field write')
+
+    fs('truncate', '/chk/new', 2)
+    if client.get('chk:new') != 'he':
+      wrong.append('truncate')
+
+    # picked to hash to a slot on another node
+    target = next('chk:moved%d' % i for i in xrange(1000)
+        if standin.owners[keyslot('chk:moved%d' % i)] is not
+        standin.owners[keyslot('chk:new')])
+    fs('rename', '/chk/new', '/' + target.replace(':', '/'))
+    if client.get(target) != 'he' or client.exists('chk:new'):
+      wrong.append('rename between slots')
+
+    slot = keyslot(target)
+    elsewhere = [s for s in standin.servers if s is not standin.owners[slot]]
+    standin.move(slot, elsewhere[0])
+    path = '/' + target.replace(':', '/')
+    if fs('read', path, 10, 0, 0) != 'he':
+      wrong.append('read after MOVED')
+    fs = mounted(standin)
+    if path not in set(walk(fs, '/')):
+      wrong.append('listing after MOVED')
+
+    print 'checks on %d nodes: %s' % (nodes,
+        'wrong: ' + ', '.join(wrong) if wrong else 'all good')
+    return not wrong
+  finally:
+    standin.stop()
+
+
+def main():
+  parser = OptionParser(usage='usage: %prog [--keys N] [--delay MS] '
+      '[nodes ...]')
+  parser.add_option('--keys', type='int', default=20000,
+      help='keys spread over the cluster [default: %default]')
+  parser.add_option('--delay', type='float', default=5.0,
+      help='milliseconds every reply is held back [default: %default]')
+  (options, nodes) = parser.parse_args()
+  nodes = [int(n) for n in nodes] or [1, 2, 4, 8]
+  if RedisCluster is None:
+    parser.error('needs redis-py-cluster (pip install redis-py-cluster)')
+  print '%5s %10s %10s %10s' % ('nodes', 'files', 'listing s', 'lazy dir s')
+  good = all([timed(n, options.keys, options.delay / 1000.0) for n in nodes])
+  return check(max(nodes)) and good
+
+
+if __name__ == "__main__":
+  sys.exit(0 if main() else 1)
@@ -0,0 +1,101 @@
+"""Coalescing concurrent operations over a slow link.
+
+Starts a stand-in (bench/server.py) holding every request back --delay
+milliseconds like a distant server would, then has many threads read
+small files through the filesystem at once, the way a multi-threaded
+fuse mount serves `grep -r` or a build.  Each read is one GETRANGE.
+Without coalescing, threads queue for the pool's connections and every
+read costs a round trip on one of them; with it, the reads that queue up
+while a batch is on the wire all go out in the next one.
+
+    python -m bench.coalesce [--delay MS] [--threads N] [--files N]
+
+Reports reads per second and commands per batch for each setup.
+"""
+
+from __future__ import absolute_import
+
+import sys
+from optparse import OptionParser
+from threading import Thread
+from timeit import default_timer
+
+import redis
+
+from bench.server import Server
+from coalesce import coalesced
+from redisfuse import Redis
+
+# (name, pool connections for fuse threads, --coalesce window in seconds)
+SETUPS = [
+  ('pool of 4', 4, None),
+  ('pool of 16', 16, None),
+  ('coalesce', 16, 0),
+  ('coalesce 1ms', 16, 0.001),
+]
+
+
+def run(server, delay, threads, files, connections, window):
+  fs = Redis(server.host, server.port, threads=connections, lazy=True,
+      watch=False, cache_size=0, coalesce=window)
+  fs('init', '/')
+  paths = ['/co/%d/f%d' % (n, i) for n in xrange(threads)
+      for i in xrange(files)]
+  for n in xrange(threads):
+    fs('getattr', '/co')
+    fs('getattr', '/co/%d' % n)
+  for path in paths:
+    fs('getattr', path)
+  server.delay = delay
+  wrong = []
+
+  def reader(n):
+    for i in xrange(files):
+      path = '/co/%d/f%d' % (n, i)
+      if fs('read', path, 100, 0, 0) != path:
+        wrong.append(path)
+
+  workers = [Thread(target=reader, args=(n,)) for n in xrange(threads)]
+  start = default_timer()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  took = default_timer() - start
+  server.delay = 0
+  batch = coalesced(fs.coalescers)['per_batch'] if fs.coalescers else 1
+  return (len(paths) / took, batch, not wrong)
+
+
+def main():
+  parser = OptionParser(usage='usage: %prog [--delay MS] [--threads N] '
+      '[--files N]')
+  parser.add_option('--delay', type='float', default=30.0,
+      help='milliseconds every request is held back [default: %default]')
+  parser.add_option('--threads', type='int', default=64,
+      help='threads reading at once [default: %default]')
+  parser.add_option('--files', type='int', default=20,
+      help='files each thread reads [default: %default]')
+  (options, args) = parser.parse_args()
+  server = Server().start()
+  try:
+    client = redis.Redis(server.host, server.port)
+    for n in xrange(options.threads):
+      for i in xrange(options.files):
+        path = '/co/%d/f%d' % (n, i)
+        client.set(path[1:].replace('/', ':'), path)
+    print '%-14s %10s %10s' % ('', 'reads/s', 'per batch')
+    good = True
+    for (name, connections, window) in SETUPS:
+      (rate, batch, right) = run(server, options.delay / 1000.0,
+          options.threads, options.files, connections, window)
+      print '%-14s %10.0f %10.1f%s' % (name, rate, batch,
+          '' if right else '  WRONG')
+      good = good and right
+    return good
+  finally:
+    server.stop()
+
+
+if __name__ == "__main__":
+  sys.exit(0 if main() else 1)
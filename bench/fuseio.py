@@ -0,0 +1,79 @@
+"""fuse.py read and write throughput.
+
+Calls FUSE.read and FUSE.write the way libfuse would, with a kernel-sized
+buffer and a file info struct, but without mounting anything, so the only
+cost measured is getting data between Python and the kernel's buffer.
+Compares the current bridges with the copying ones fuse.py used to have.
+
+    python -m bench.fuseio [block KB] [blocks]
+"""
+
+from __future__ import absolute_import
+
+import sys
+from ctypes import POINTER, c_byte, cast, create_string_buffer, memmove, \
+    pointer, string_at
+from timeit import default_timer
+
+from fuse import FUSE, Operations, fuse_file_info
+
+
+class Blocks(Operations):
+  """Reads come from one block held in memory, writes are copied into
+     another, the way WriteBuffer keeps them."""
+
+  def __init__(self, block):
+    self.block = block
+    self.written = bytearray(len(block))
+
+  def read(self, path, size, offset, fh):
+    return self.block
+
+  def write(self, path, data, offset, fh):
+    self.written[:len(data)] = data
+    return len(data)
+
+
+def old_read(self, path, buf, size, offset, fip):
+  fh = fip.contents if self.raw_fi else fip.contents.fh
+  ret = self.operations('read', path, size, offset, fh)
+  if not ret:
+    return 0
+  data = create_string_buffer(ret[:size], size)
+  memmove(buf, data, size)
+  return size
+
+
+def old_write(self, path, buf, size, offset, fip):
+  data = string_at(buf, size)
+  fh = fip.contents if self.raw_fi else fip.contents.fh
+  return self.operations('write', path, data, offset, fh)
+
+
+def timed(name, bridge, fs, size, blocks):
+  kernel = create_string_buffer(size)
+  buf = cast(kernel, POINTER(c_byte))
+  fip = pointer(fuse_file_info())
+  start = default_timer()
+  for i in xrange(blocks):
+    if bridge(fs, '/file', buf, size, i * size, fip) != size:
+      raise AssertionError('%s moved a short block' % name)
+  seconds = default_timer() - start
+  print '%-10s %9.0f MB/s' % (name, size * blocks / seconds / 2 ** 20)
+  return seconds
+
+
+def main(kb=1024, blocks=2000):
+  size = kb * 1024
+  fs = object.__new__(FUSE)   # no mount, just the bridges
+  fs.operations = Blocks('r' * size)
+  fs.raw_fi = False
+  for (op, old, new) in (('read', old_read, FUSE.read.im_func),
+      ('write', old_write, FUSE.write.im_func)):
+    before = timed('old ' + op, old, fs, size, blocks)
+    after = timed('new ' + op, new, fs, size, blocks)
+    print '%.1fx faster' % (before / after)
+
+
+if __name__ == "__main__":
+  main(*[int(arg) for arg in sys.argv[1:]])
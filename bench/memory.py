@@ -0,0 +1,63 @@
+"""Memory used by the directory index.
+
+Fills a PathIndex with synthetic string keys, a thousand to a directory,
+the way listing a keyspace does and reports the resident memory each key
+costs (names included).  Every size is measured in a fresh process.
+
+    python -m bench.memory [keys ...]
+
+keys defaults to 1000000 10000000.  10M keys needs a few GB free.
+"""
+
+import gc
+import resource
+import subprocess
+import sys
+
+from index import PathIndex
+from records import Record
+
+PER_DIR = 1000
+
+
+def rss():
+  try:
+    with open('/proc/self/statm') as statm:
+      return int(statm.read().split()[1]) * resource.getpagesize()
+  except IOError:
+    # peak rather than current, close enough in a process doing nothing else
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def fill(keys):
+  index = PathIndex()
+  for d in xrange(keys // PER_DIR + 1):
+    index.mkdir('/bench/%d' % d)
+  for i in xrange(keys):
+    index.add('/bench/%d/key%d' % (i // PER_DIR, i),
+        Record(size=i % 4096, type='string'))
+  return index
+
+
+def measure(keys):
+  gc.collect()
+  before = rss()
+  index = fill(keys)
+  gc.collect()
+  used = rss() - before
+  print '%d keys: %.1f MB, %d bytes/key' % (keys, used / 1048576.0,
+      used // keys)
+  return index
+
+
+def main(sizes):
+  for keys in sizes:
+    subprocess.check_call([sys.executable, '-m', 'bench.memory', '--one',
+        str(keys)])
+
+
+if __name__ == "__main__":
+  if sys.argv[1:2] == ['--one']:
+    measure(int(sys.argv[2]))
+  else:
+    main([int(arg) for arg in sys.argv[1:]] or [1000000, 10000000])
@@ -0,0 +1,77 @@
+"""Path parsing microbenchmark.
+
+Times turning paths into keys the way every operation does: with the
+regex-based layer() redisfuse used before paths.py, with paths.parse, and
+through a PathParser memo the way find or git status hit it (the same
+paths stat'd over and over).  Also checks all of them agree.
+
+    python -m bench.paths [paths] [rounds]
+"""
+
+from __future__ import absolute_import
+
+import re
+import sys
+from timeit import default_timer
+
+from paths import PathParser, parse
+
+
+def layer(path, level):
+  """The old parser, kept here as the baseline."""
+  if level == 0 and path == "/":
+    return "/"
+  split = path.split(".")
+  matched_slash_dot = re.match(r'.*/\..*', path)
+  if matched_slash_dot and level == 0:
+    return split[0] + "." + split[1]
+  elif matched_slash_dot and level == 1:
+    return ".".join(split[2:])
+  else:
+    if level == 0 and len(split) > level:
+      return split[level]
+    elif len(split) > level:
+      return ".".join(split[level:])
+    else:
+      return False
+
+
+def old_parse(path):
+  splits = filter(None, path.split("/"))
+  return (":".join(splits),
+      ":".join(filter(None, layer(path, 0).split("/"))), layer(path, 1),
+      "/" + "/".join(splits[:-1]), splits[-1])
+
+
+def sample(count):
+  shapes = ['/.git/objects/%02x/%038x', '/users/%d/profile.%d',
+      '/cache/.hidden.%d.%d', '/top%d.tar.%d', '/a/b/c/d/e%d/%d']
+  return [shapes[i % len(shapes)] % (i % 256, i) for i in xrange(count)]
+
+
+def timed(name, fn, paths, rounds):
+  start = default_timer()
+  for i in xrange(rounds):
+    for path in paths:
+      fn(path)
+  per_call = (default_timer() - start) / (rounds * len(paths))
+  print '%-10s %7.2f us/path' % (name, per_call * 1e6)
+  return per_call
+
+
+def main(count=10000, rounds=10):
+  paths = sample(count)
+  for path in paths:
+    if old_parse(path) != parse(path):
+      print 'MISMATCH', path, old_parse(path), parse(path)
+      return False
+  base = timed('layer', old_parse, paths, rounds)
+  timed('parse', parse, paths, rounds)
+  memo = PathParser()
+  fast = timed('memoized', memo.parse, paths, rounds)
+  print '%.1fx faster when memoized' % (base / fast)
+  return True
+
+
+if __name__ == "__main__":
+  sys.exit(0 if main(*[int(arg) for arg in sys.argv[1:]]) else 1)
@@ -0,0 +1,99 @@
+"""Streaming big values over a slow link.
+
+Starts a stand-in (bench/server.py) holding every request back --delay
+milliseconds, then reads a big string through the filesystem the way
+`cat` or `cp` does, 128 KB at a time through one file handle, with
+reading ahead off and on, and reports the throughput.  Then has many
+threads read the same bytes at once and counts the GETRANGEs that
+reached the server: one, if they shared a single fetch.
+
+    python -m bench.readahead [--delay MS] [--mb N] [--threads N]
+"""
+
+from __future__ import absolute_import
+
+import sys
+from optparse import OptionParser
+from threading import Thread
+from timeit import default_timer
+
+import redis
+
+from bench.server import Server
+from readahead import READAHEAD_MAX
+from redisfuse import Redis
+
+CHUNK = 128 * 1024   # what the kernel asks for at a time
+
+
+def mounted(server, readahead):
+  fs = Redis(server.host, server.port, watch=False, cache_size=0,
+      readahead=readahead)
+  fs('init', '/')
+  list(fs('readdir', '/ra', 0))
+  return fs
+
+
+def stream(server, delay, value, readahead):
+  fs = mounted(server, readahead)
+  server.delay = delay
+  fh = fs('open', '/ra/big', 0)
+  start = default_timer()
+  data = []
+  offset = 0
+  while True:
+    chunk = fs('read', '/ra/big', CHUNK, offset, fh)
+    if not chunk:
+      break
+    data.append(str(chunk))
+    offset += len(chunk)
+  took = default_timer() - start
+  fs('release', '/ra/big', fh)
+  server.delay = 0
+  right = ''.join(data) == value
+  print '%-22s %8.1f MB/s%s' % ('readahead %d MB' % (readahead >> 20),
+      len(value) / took / 1048576, '' if right else '  WRONG')
+  return right
+
+
+def shared(server, delay, threads):
+  fs = mounted(server, 0)
+  server.delay = delay
+  server.reset()
+  workers = [Thread(target=fs, args=('read', '/ra/big', CHUNK, 0, 0))
+      for i in xrange(threads)]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  server.delay = 0
+  fetches = server.commands['GETRANGE']
+  print '%d threads reading the same bytes: %d GETRANGE' % (threads,
+      fetches)
+  return fetches < threads
+
+
+def main():
+  parser = OptionParser(usage='usage: %prog [--delay MS] [--mb N] '
+      '[--threads N]')
+  parser.add_option('--delay', type='float', default=30.0,
+      help='milliseconds every request is held back [default: %default]')
+  parser.add_option('--mb', type='int', default=32,
+      help='megabytes streamed [default: %default]')
+  parser.add_option('--threads', type='int', default=16,
+      help='threads reading the same bytes at once [default: %default]')
+  (options, args) = parser.parse_args()
+  server = Server().start()
+  try:
+    value = ''.join(chr(i % 251) for i in xrange(1 << 20)) * options.mb
+    redis.Redis(server.host, server.port).set('ra:big', value)
+    delay = options.delay / 1000.0
+    good = all([stream(server, delay, value, readahead)
+        for readahead in (0, READAHEAD_MAX)])
+    return shared(server, delay, options.threads) and good
+  finally:
+    server.stop()
+
+
+if __name__ == "__main__":
+  sys.exit(0 if main() else 1)
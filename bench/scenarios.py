@@ -0,0 +1,268 @@
+"""Benchmark scenarios.
+
+Drives the Redis operations class the way fuse.py would (every call goes
+through __call__, so it's timed and its round trips counted) through a
+handful of workloads, and reports for each: operations per second, redis
+round trips, and bytes sent to and received from redis.
+
+    python -m bench.scenarios [--redis host:port] [--scale N] [scenario ...]
+
+Without --redis everything runs against the in-process stand-in server
+(bench/server.py).  With it, the server given is FLUSHALL'd before every
+scenario: point it at a scratch redis.  --scale shrinks or grows every
+workload (0.1 for a quick run).
+"""
+
+from __future__ import absolute_import
+
+import random
+from stat import S_ISDIR
+from optparse import OptionParser
+from timeit import default_timer
+
+import redis
+
+from bench.server import Server
+from redisfuse import Redis
+
+CHUNK = 128 * 1024   # the most the kernel reads at once
+PAGE = 4096
+
+
+def scaled(n, scale):
+  return max(int(n * scale), 1)
+
+
+# Each scenario is a (load, run) pair.  load(client, scale) puts the data
+# in redis, untimed.  run(fs, scale) does the work and returns how many
+# operations it made.
+
+def load_populate(client, scale):
+  pipe = client.pipeline(transaction=False)
+  for i in xrange(scaled(100000, scale)):
+    key = 'pop:%d:k%d' % (i // 100, i)
+    if i % 10 == 0:
+      pipe.hset(key, 'a', 'x' * 10)
+      pipe.hset(key, 'b', 'y' * 100)
+    elif i % 20 == 1:
+      pipe.rpush(key, 'one', 'two', 'three')
+    else:
+      pipe.set(key, 'v' * (i % 512))
+    if i % 1000 == 999:
+      pipe.execute()
+  pipe.execute()
+
+
+def run_populate(fs, scale):
+  # the first listing of the root lists the whole keyspace
+  list(fs('readdir', '/', 0))
+  return scaled(100000, scale)
+
+
+def load_deep(client, scale):
+  pipe = client.pipeline(transaction=False)
+  fanout = 4
+  depth = max(int(5 * min(scale, 1)), 2)
+  leaves = ['deep']
+  for level in xrange(depth):
+    leaves = ['%s:d%d' % (leaf, n) for leaf in leaves for n in xrange(fanout)]
+  for leaf in leaves:
+    for n in xrange(fanout):
+      pipe.set('%s:f%d' % (leaf, n), 'x' * 100)
+  pipe.execute()
+
+
+def run_deep(fs, scale):
+  """ls -lR of a deep tree, listing lazily."""
+  fs('getattr', '/deep')
+  ops = 1
+  stack = ['/deep']
+  while stack:
+    path = stack.pop()
+    ops += 1
+    for (name, attrs, offset) in fs('readdir', path, 0):
+      if name in ('.', '..'):
+        continue
+      child = path + '/' + name
+      ops += 1
+      if fs('getattr', child)['st_nlink'] > 1:
+        stack.append(child)
+  return ops
+
+
+def run_find(fs, scale):
+  """find over the same tree: entry types come with the listing, so only
+     directories are stat'd."""
+  fs('getattr', '/deep')
+  ops = 1
+  stack = ['/deep']
+  while stack:
+    path = stack.pop()
+    ops += 1
+    for (name, attrs, offset) in fs('readdir', path, 0):
+      if name not in ('.', '..') and S_ISDIR(attrs['st_mode']):
+        stack.append(path + '/' + name)
+  return ops
+
+
+def load_seq_read(client, scale):
+  client.set('big', 'b' * scaled(100 * 1024 * 1024, scale))
+
+
+def run_seq_read(fs, scale):
+  size = fs('getattr', '/big')['st_size']
+  fh = fs('open', '/big', 0)
+  ops = 2
+  for offset in xrange(0, size, CHUNK):
+    fs('read', '/big', CHUNK, offset, fh)
+    ops += 1
+  fs('release', '/big', fh)
+  return ops
+
+
+def load_random_writes(client, scale):
+  client.set('rw:s', 's' * (4 * 1024 * 1024))
+  client.hset('rw:h', 'f', 'h' * (1024 * 1024))
+
+
+def run_random_writes(fs, scale):
+  rng = random.Random(1)
+  data = 'w' * PAGE
+  ops = 0
+  for (path, size, writes) in (('/rw/s', 4 * 1024 * 1024, 1000),
+      ('/rw/h.f', 1024 * 1024, 250)):
+    fs('getattr', path)
+    fh = fs('open', path, 0)
+    for i in xrange(scaled(writes, scale)):
+      fs('write', path, data, rng.randrange(size // PAGE) * PAGE, fh)
+    fs('release', path, fh)
+    ops += scaled(writes, scale) + 3
+  return ops
+
+
+def load_git(client, scale):
+  pass
+
+
+def run_git(fs, scale):
+  """Roughly the calls git init, git add and git commit make."""
+  rng = random.Random(2)
+  calls = [0]
+  def call(op, *args):
+    calls[0] += 1
+    try:
+      return fs(op, *args)
+    except OSError:
+      return None
+
+  def write_file(path, data):
+    fh = call('create', path, 0644)
+    call('write', path, data, 0, fh)
+    call('release', path, fh)
+
+  def write_object(data):
+    name = '%040x' % rng.getrandbits(160)
+    dir = '/.git/objects/' + name[:2]
+    if call('getattr', dir) is None:
+      call('mkdir', dir, 0755)
+    tmp = dir + '/tmp_obj_%06d' % rng.randrange(10 ** 6)
+    write_file(tmp, data)
+    call('rename', tmp, dir + '/' + name[2:])
+
+  # git init
+  for dir in ('/.git', '/.git/objects', '/.git/refs', '/.git/refs/heads'):
+    call('mkdir', dir, 0755)
+  write_file('/.git/HEAD', 'ref: refs/heads/master\n')
+  write_file('/.git/config', '[core]\n\tbare = false\n')
+
+  # git add: hash every file into an object, then write the index
+  files = scaled(500, scale)
+  for i in xrange(files):
+    call('getattr', '/src%d' % i)
+    write_file('/src%d' % i, 'line\n' * rng.randint(1, 200))
+    fh = call('open', '/src%d' % i, 0)
+    data = call('read', '/src%d' % i, CHUNK, 0, fh)
+    call('release', '/src%d' % i, fh)
+    write_object(data)
+  write_file('/.git/index.lock', 'DIRC' + 'i' * 64 * files)
+  call('rename', '/.git/index.lock', '/.git/index')
+
+  # git commit: stat everything, write the tree and commit, move the ref
+  for i in xrange(files):
+    call('getattr', '/src%d' % i)
+  list(call('readdir', '/', 0))
+  write_object('tree' * files)
+  write_object('commit')
+  write_file('/.git/refs/heads/master.lock', '%040x\n' % 0)
+  call('rename', '/.git/refs/heads/master.lock', '/.git/refs/heads/master')
+  return calls[0]
+
+
+SCENARIOS = [
+  ('populate', load_populate, run_populate, dict()),
+  ('deep_readdir', load_deep, run_deep, dict(lazy=True)),
+  ('find', load_deep, run_find, dict(lazy=True)),
+  ('seq_read', load_seq_read, run_seq_read, dict(lazy=True)),
+  ('random_writes', load_random_writes, run_random_writes, dict(lazy=True)),
+  ('git', load_git, run_git, dict(lazy=True)),
+]
+
+
+def transferred(client):
+  info = client.info('stats')
+  return (info['total_net_input_bytes'], info['total_net_output_bytes'])
+
+
+def run(name, load, work, options, host, port, scale):
+  client = redis.Redis(host, port)
+  client.flushall()
+  load(client, scale)
+
+  fs = Redis(host, port, watch=False, **options)
+  fs('init', '/')
+  fs.stats.reset()
+  (sent, received) = transferred(client)
+  start = default_timer()
+  ops = work(fs, scale)
+  seconds = default_timer() - start
+  (sent_after, received_after) = transferred(client)
+
+  trips = sum(op.trips for op in fs.stats.ops.values())
+  print '%-14s %8d %8.2f %9.0f %8d %8.2f %10d %10d' % (name, ops, seconds,
+      ops / seconds, trips, float(trips) / ops, (sent_after - sent) // 1024,
+      (received_after - received) // 1024)
+  fs.redis.connection_pool.disconnect()
+  client.connection_pool.disconnect()
+
+
+def main():
+  parser = OptionParser(
+      usage='usage: %prog [--redis host:port] [--scale N] [scenario ...]')
+  parser.add_option('--redis', help='benchmark against this redis, which '
+      'gets FLUSHALL\'d, instead of the stand-in')
+  parser.add_option('--scale', type='float', default=1.0,
+      help='multiply every workload by this [default: %default]')
+  (options, names) = parser.parse_args()
+  chosen = [s for s in SCENARIOS if not names or s[0] in names]
+  if not chosen:
+    parser.error('scenarios: %s' % ' '.join(s[0] for s in SCENARIOS))
+
+  server = None
+  if options.redis:
+    (host, port) = options.redis.rsplit(':', 1)
+    port = int(port)
+  else:
+    server = Server().start()
+    (host, port) = (server.host, server.port)
+
+  print '%-14s %8s %8s %9s %8s %8s %10s %10s' % ('scenario', 'ops', 'seconds',
+      'ops/s', 'trips', 'trips/op', 'KB sent', 'KB recvd')
+  for (name, load, work, fs_options) in chosen:
+    run(name, load, work, fs_options, host, port, options.scale)
+
+  if server:
+    server.stop()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,679 @@
+"""A redis stand-in for benchmarks.
+
+Speaks enough of the redis protocol for everything redisfuse sends, keeps
+the data in plain Python containers, and counts commands and bytes in
+each direction, so benchmarks run without a redis server and can see how
+much we talk to it.
+
+It is not redis.  One database, no expiry, no persistence, no pubsub,
+and scripts only run if they are ones redisfuse ships (implemented here
+natively, looked up by SHA1).  CLIENT TRACKING and DEBUG are refused so
+the filesystem takes its fallback paths.
+
+    server = Server()          # listens on 127.0.0.1, a free port
+    server.start()
+    ... Redis('127.0.0.1', server.port) ...
+    server.stop()
+
+Cluster runs several of them as a redis cluster with one primary per
+shard: each answers CLUSTER SLOTS and sends MOVED for keys whose hash
+slot another one owns, and move() hands a slot over, keys and all.
+delay= holds every request that many seconds before it's read, standing
+in for the network: a pipeline arriving together waits once, and each
+connection waits on its own.
+"""
+
+from __future__ import absolute_import
+
+import cPickle
+import socket
+import SocketServer
+from binascii import crc_hqx
+from collections import defaultdict
+from hashlib import sha1
+from threading import Lock, Thread
+from time import sleep
+from zlib import crc32
+
+import chunks
+import scripts
+from paths import glob
+
+# keys are spread over this many SCAN buckets; a cursor is a bucket number
+SCAN_BUCKETS = 4096
+
+# redis cluster hash slots
+SLOTS = 16384
+
+# commands without keys, and those whose arguments are all keys; every
+# other command's key is its first argument
+KEYLESS = frozenset(['PING', 'SELECT', 'CLIENT', 'CONFIG', 'DEBUG', 'INFO',
+    'DBSIZE', 'FLUSHALL', 'FLUSHDB', 'SCAN', 'SCRIPT', 'CLUSTER', 'ASKING',
+    'READONLY'])
+ALL_KEYS = frozenset(['DEL', 'EXISTS', 'MGET', 'RENAME'])
+
+
+class Error(Exception):
+  """Sent back to the client as an error reply."""
+
+
+class ZSet(dict):
+  """member -> score"""
+
+  def ordered(self):
+    return sorted(self, key=lambda member: (self[member], member))
+
+
+def keyslot(key):
+  """The hash slot a redis cluster keeps key in: CRC16 of the key, or of
+     the part in {braces} if there is one."""
+  start = key.find('{')
+  if start > -1:
+    end = key.find('}', start + 1)
+    if end > start + 1:
+      key = key[start + 1:end]
+  return crc_hqx(key, 0) % SLOTS
+
+
+def keys_of(args):
+  name = args[0].upper()
+  if name in KEYLESS:
+    return []
+  if name in ('EVAL', 'EVALSHA'):
+    return args[3:3 + int(args[2])]
+  return args[1:] if name in ALL_KEYS else args[1:2]
+
+
+def hgetrange(db, keys, args):
+  value = db.get_type(keys[0], dict).get(args[0], '')
+  start, end = int(args[1]), int(args[2])
+  return value[start:end + 1]
+
+
+def hsetrange(db, keys, args):
+  fields = db.get_type(keys[0], dict, create=True)
+  value = fields.get(args[0], '')
+  offset = int(args[1])
+  if len(value) < offset:
+    value += '\0' * (offset - len(value))
+  fields[args[0]] = value[:offset] + args[2] + value[offset + len(args[2]):]
+  return len(fields[args[0]])
+
+
+def truncate(db, keys, args):
+  length = int(args[0])
+  if len(args) > 1:
+    fields = db.get_type(keys[0], dict, create=True)
+    value = fields.get(args[1], '')
+  else:
+    value = db.get_type(keys[0], str)
+  value = value[:length] + '\0' * (length - len(value))
+  if len(args) > 1:
+    fields[args[1]] = value
+  else:
+    db.store(keys[0], value)
+  return length
+
+
+def chunked(db, key):
+  fields = db.get_type(key, dict)
+  layout = chunks.parse(fields.get(chunks.MANIFEST))
+  if layout is None:
+    raise Error('ERR not a chunked file')
+  return (fields, layout[0], layout[1])
+
+
+def chunkgetrange(db, keys, args):
+  fields = db.get_type(keys[0], dict)
+  layout = chunks.parse(fields.get(chunks.MANIFEST))
+  if layout is None:
+    return ''
+  (length, size) = layout
+  (start, end) = (int(args[0]), int(args[1]))
+  if end < 0 or end >= length:
+    end = length - 1
+  if start > end:
+    return ''
+  parts = []
+  for index in xrange(start // size, end // size + 1):
+    chunk = fields.get(str(index), '')
+    chunk += '\0' * (size - len(chunk))
+    parts.append(chunk)
+  offset = start - start // size * size
+  return ''.join(parts)[offset:offset + end - start + 1]
+
+
+def chunksetrange(db, keys, args):
+  (fields, length, size) = chunked(db, keys[0])
+  (offset, data) = (int(args[0]), args[1])
+  done = 0
+  while done < len(data):
+    (index, start) = divmod(offset + done, size)
+    piece = data[done:done + size - start]
+    chunk = fields.get(str(index), '')
+    chunk += '\0' * (start - len(chunk))
+    fields[str(index)] = chunk[:start] + piece + chunk[start + len(piece):]
+    done += len(piece)
+  if data:
+    length = max(length, offset + len(data))
+  fields[chunks.MANIFEST] = chunks.manifest(length, size)
+  return length
+
+
+def chunktruncate(db, keys, args):
+  (fields, old, size) = chunked(db, keys[0])
+  length = int(args[0])
+  if length < old:
+    keep = -(-length // size)
+    for index in xrange(keep, -(-old // size)):
+      fields.pop(str(index), None)
+    field = str(keep - 1)
+    if length % size and field in fields:
+      fields[field] = fields[field][:length % size]
+  fields[chunks.MANIFEST] = chunks.manifest(length, size)
+  return length
+
+
+# scripts redisfuse sends, by the SHA1 redis would know them by
+SCRIPTS = {
+  sha1(scripts.HGETRANGE).hexdigest(): hgetrange,
+  sha1(scripts.HSETRANGE).hexdigest(): hsetrange,
+  sha1(scripts.TRUNCATE).hexdigest(): truncate,
+  sha1(scripts.CHUNKGETRANGE).hexdigest(): chunkgetrange,
+  sha1(scripts.CHUNKSETRANGE).hexdigest(): chunksetrange,
+  sha1(scripts.CHUNKTRUNCATE).hexdigest(): chunktruncate,
+}
+
+
+class Database(object):
+  def __init__(self, server):
+    self.server = server
+    self.data = {}
+    self.buckets = [set() for i in xrange(SCAN_BUCKETS)]
+    self.lock = Lock()   # one command at a time, like redis
+
+  # every key comes and goes through store and drop, which keep buckets
+  def store(self, key, value):
+    if key not in self.data:
+      self.buckets[crc32(key) % SCAN_BUCKETS].add(key)
+    self.data[key] = value
+
+  def drop(self, key):
+    if self.data.pop(key, None) is not None:
+      self.buckets[crc32(key) % SCAN_BUCKETS].discard(key)
+      return 1
+    return 0
+
+  def get_type(self, key, kind, create=False):
+    value = self.data.get(key)
+    if value is None:
+      value = kind()
+      if create:
+        self.store(key, value)
+    elif type(value) is not kind:
+      raise Error('WRONGTYPE Operation against a key holding the wrong '
+          'kind of value')
+    return value
+
+  def tidy(self, key):
+    """Drop key if it's an empty collection, like redis does."""
+    value = self.data.get(key)
+    if value is not None and not isinstance(value, str) and not value:
+      self.drop(key)
+
+  def execute(self, args):
+    name = args[0].upper()
+    command = getattr(self, 'cmd_' + name.replace(' ', '_'), None)
+    if command is None:
+      raise Error("ERR unknown command '%s'" % args[0])
+    with self.lock:
+      if self.server.cluster:
+        self.server.cluster.check(self.server, keys_of(args))
+      return command(*args[1:])
+
+  # connection and server
+  def cmd_PING(self, message=None):
+    return message if message is not None else Status('PONG')
+
+  def cmd_SELECT(self, db):
+    if db != '0':
+      raise Error('ERR the stand-in only has database 0')
+    return OK
+
+  def cmd_CLIENT(self, subcommand, *args):
+    if subcommand.upper() == 'ID':
+      return 1
+    if subcommand.upper() == 'SETNAME':
+      return OK
+    raise Error('ERR the stand-in does not support CLIENT %s' % subcommand)
+
+  def cmd_CONFIG(self, subcommand, *args):
+    if subcommand.upper() == 'GET' and args[0] == 'notify-keyspace-events':
+      return ['notify-keyspace-events', '']
+    raise Error('ERR the stand-in has no configuration')
+
+  def cmd_CLUSTER(self, subcommand, *args):
+    if not self.server.cluster:
+      raise Error('ERR This instance has cluster support disabled')
+    if subcommand.upper() == 'SLOTS':
+      return self.server.cluster.slots()
+    if subcommand.upper() == 'KEYSLOT':
+      return keyslot(args[0])
+    raise Error('ERR the stand-in does not support CLUSTER %s' % subcommand)
+
+  def cmd_DEBUG(self, *args):
+    raise Error('ERR DEBUG command not allowed')
+
+  def cmd_INFO(self, *sections):
+    return 'total_net_input_bytes:%d\r\ntotal_net_output_bytes:%d\r\n' % (
+        self.server.bytes_in, self.server.bytes_out)
+
+  def cmd_DBSIZE(self):
+    return len(self.data)
+
+  def cmd_FLUSHALL(self, *args):
+    self.data.clear()
+    for bucket in self.buckets:
+      bucket.clear()
+    return OK
+  cmd_FLUSHDB = cmd_FLUSHALL
+
+  # keys
+  def cmd_TYPE(self, key):
+    value = self.data.get(key)
+    return Status(TYPES.get(type(value), 'none'))
+
+  def cmd_EXISTS(self, *keys):
+    return sum(1 for key in keys if key in self.data)
+
+  def cmd_DEL(self, *keys):
+    return sum(self.drop(key) for key in keys)
+
+  def cmd_RENAME(self, key, new):
+    if key not in self.data:
+      raise Error('ERR no such key')
+    value = self.data[key]
+    self.drop(key)
+    self.drop(new)
+    self.store(new, value)
+    return OK
+
+  def cmd_DUMP(self, key):
+    value = self.data.get(key)
+    return cPickle.dumps(value, 2) if value is not None else None
+
+  def cmd_RESTORE(self, key, ttl, data, *options):
+    if key in self.data and 'REPLACE' not in [o.upper() for o in options]:
+      raise Error('BUSYKEY Target key name already exists.')
+    self.drop(key)
+    self.store(key, cPickle.loads(data))
+    return OK
+
+  def cmd_PTTL(self, key):
+    return -1 if key in self.data else -2
+
+  def cmd_SCAN(self, cursor, *args):
+    options = dict((args[i].upper(), args[i + 1])
+        for i in xrange(0, len(args) - 1, 2))
+    match = glob(options['MATCH']) if 'MATCH' in options else None
+    count = int(options.get('COUNT', 10))
+    bucket = int(cursor)
+    keys = []
+    scanned = 0   # like redis, COUNT is how much to look at, not to return
+    while bucket < SCAN_BUCKETS and scanned < count:
+      scanned += len(self.buckets[bucket])
+      keys.extend(key for key in self.buckets[bucket]
+          if match is None or match.match(key))
+      bucket += 1
+    return [str(bucket % SCAN_BUCKETS), keys]
+
+  # strings
+  def cmd_GET(self, key):
+    value = self.data.get(key)
+    if value is not None and not isinstance(value, str):
+      self.get_type(key, str)
+    return value
+
+  def cmd_MGET(self, *keys):
+    return [value if isinstance(value, str) else None
+        for value in (self.data.get(key) for key in keys)]
+
+  def cmd_SET(self, key, value, *options):
+    self.drop(key)
+    self.store(key, value)
+    return OK
+
+  def cmd_STRLEN(self, key):
+    return len(self.get_type(key, str))
+
+  def cmd_GETRANGE(self, key, start, end):
+    value = self.get_type(key, str)
+    start, end = int(start), int(end)
+    if start < 0:
+      start = max(len(value) + start, 0)
+    if end < 0:
+      end = len(value) + end
+    return value[start:end + 1]
+
+  def cmd_SETRANGE(self, key, offset, data):
+    value = self.get_type(key, str)
+    offset = int(offset)
+    if len(value) < offset:
+      value += '\0' * (offset - len(value))
+    value = value[:offset] + data + value[offset + len(data):]
+    self.store(key, value)
+    return len(value)
+
+  def cmd_APPEND(self, key, data):
+    value = self.get_type(key, str) + data
+    self.store(key, value)
+    return len(value)
+
+  # hashes
+  def cmd_HGET(self, key, field):
+    return self.get_type(key, dict).get(field)
+
+  def cmd_HMGET(self, key, *fields):
+    value = self.get_type(key, dict)
+    return [value.get(field) for field in fields]
+
+  def cmd_HSET(self, key, *pairs):
+    if not pairs or len(pairs) % 2:
+      raise Error("ERR wrong number of arguments for 'hset' command")
+    value = self.get_type(key, dict, create=True)
+    added = 0
+    for i in xrange(0, len(pairs), 2):
+      added += pairs[i] not in value
+      value[pairs[i]] = pairs[i + 1]
+    return added
+  cmd_HMSET = cmd_HSET
+
+  def cmd_HDEL(self, key, *fields):
+    value = self.get_type(key, dict)
+    removed = sum(1 for field in fields if value.pop(field, None) is not None)
+    self.tidy(key)
+    return removed
+
+  def cmd_HKEYS(self, key):
+    return list(self.get_type(key, dict))
+
+  def cmd_HLEN(self, key):
+    return len(self.get_type(key, dict))
+
+  def cmd_HSTRLEN(self, key, field):
+    return len(self.get_type(key, dict).get(field, ''))
+
+  def cmd_HEXISTS(self, key, field):
+    return int(field in self.get_type(key, dict))
+
+  def cmd_HGETALL(self, key):
+    return [item for pair in self.get_type(key, dict).iteritems()
+        for item in pair]
+
+  # lists, sets and sorted sets
+  def cmd_RPUSH(self, key, *values):
+    value = self.get_type(key, list, create=True)
+    value.extend(values)
+    return len(value)
+
+  def cmd_LLEN(self, key):
+    return len(self.get_type(key, list))
+
+  def cmd_LRANGE(self, key, start, stop):
+    value = self.get_type(key, list)
+    start, stop = int(start), int(stop)
+    return value[start:(stop + 1) or None]
+
+  def cmd_SADD(self, key, *members):
+    value = self.get_type(key, set, create=True)
+    before = len(value)
+    value.update(members)
+    return len(value) - before
+
+  def cmd_SCARD(self, key):
+    return len(self.get_type(key, set))
+
+  def cmd_SMEMBERS(self, key):
+    return list(self.get_type(key, set))
+
+  def cmd_ZADD(self, key, *pairs):
+    value = self.get_type(key, ZSet, create=True)
+    before = len(value)
+    for i in xrange(0, len(pairs), 2):
+      value[pairs[i + 1]] = float(pairs[i])
+    return len(value) - before
+
+  def cmd_ZCARD(self, key):
+    return len(self.get_type(key, ZSet))
+
+  def cmd_ZRANGE(self, key, start, stop, *options):
+    members = self.get_type(key, ZSet).ordered()
+    start, stop = int(start), int(stop)
+    return members[start:(stop + 1) or None]
+
+  # scripts
+  def cmd_SCRIPT(self, subcommand, *args):
+    if subcommand.upper() == 'LOAD':
+      sha = sha1(args[0]).hexdigest()
+      if sha not in SCRIPTS:
+        raise Error('ERR the stand-in only runs the scripts redisfuse ships')
+      return sha
+    if subcommand.upper() == 'EXISTS':
+      return [int(sha in SCRIPTS) for sha in args]
+    raise Error('ERR the stand-in does not support SCRIPT %s' % subcommand)
+
+  def cmd_EVALSHA(self, sha, numkeys, *args):
+    script = SCRIPTS.get(sha.lower())
+    if script is None:
+      raise Error('NOSCRIPT No matching script. Please use EVAL.')
+    numkeys = int(numkeys)
+    return script(self, args[:numkeys], args[numkeys:])
+
+  def cmd_EVAL(self, source, numkeys, *args):
+    return self.cmd_EVALSHA(sha1(source).hexdigest(), numkeys, *args)
+
+
+TYPES = {str: 'string', dict: 'hash', list: 'list', set: 'set', ZSet: 'zset'}
+
+
+class Status(str):
+  """A simple string reply (+OK) rather than a bulk one."""
+
+OK = Status('OK')
+
+
+def encode(reply):
+  if isinstance(reply, Status):
+    return '+%s\r\n' % reply
+  if isinstance(reply, str):
+    return '$%d\r\n%s\r\n' % (len(reply), reply)
+  if isinstance(reply, (int, long)):
+    return ':%d\r\n' % reply
+  if reply is None:
+    return '$-1\r\n'
+  if isinstance(reply, Error):
+    return '-%s\r\n' % reply
+  return '*%d\r\n%s' % (len(reply), ''.join(encode(item) for item in reply))
+
+
+class Requests(object):
+  """What a client sends, read as the handler's rfile.  Each time
+     everything that arrived has been handled, the next request waits for
+     the server's delay."""
+
+  def __init__(self, connection, server):
+    self.connection = connection
+    self.server = server
+    self.buffer = ''
+    self.pos = 0
+
+  def fill(self):
+    data = self.connection.recv(65536)
+    if data and self.server.delay:
+      sleep(self.server.delay)
+    self.buffer = self.buffer[self.pos:] + data
+    self.pos = 0
+    return bool(data)
+
+  def readline(self):
+    end = self.buffer.find('\n', self.pos)
+    while end < 0:
+      if not self.fill():
+        return ''
+      end = self.buffer.find('\n')
+    line = self.buffer[self.pos:end + 1]
+    self.pos = end + 1
+    return line
+
+  def read(self, size):
+    while len(self.buffer) - self.pos < size and self.fill():
+      pass
+    data = self.buffer[self.pos:self.pos + size]
+    self.pos += len(data)
+    return data
+
+  def close(self):
+    pass
+
+
+class Handler(SocketServer.StreamRequestHandler):
+  def setup(self):
+    SocketServer.StreamRequestHandler.setup(self)
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.rfile = Requests(self.connection, self.server)
+
+  def read_command(self):
+    line = self.rfile.readline()
+    if not line:
+      return None
+    received = len(line)
+    if line[0] != '*':
+      args = line.split()   # inline command
+    else:
+      args = []
+      for i in xrange(int(line[1:])):
+        header = self.rfile.readline()
+        size = int(header[1:])
+        args.append(self.rfile.read(size + 2)[:-2])
+        received += len(header) + size + 2
+    self.server.count(args[0] if args else '', received, 0)
+    return args
+
+  def handle(self):
+    while True:
+      args = self.read_command()
+      if args is None:
+        return
+      if not args:
+        continue
+      try:
+        reply = self.server.db.execute(args)
+      except Error, e:
+        reply = e
+      except (TypeError, ValueError, IndexError), e:
+        reply = Error('ERR %s' % e)
+      out = encode(reply)
+      self.server.count(None, 0, len(out))
+      self.wfile.write(out)
+
+
+class Server(SocketServer.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, host='127.0.0.1', port=0, delay=0):
+    SocketServer.ThreadingTCPServer.__init__(self, (host, port), Handler)
+    self.host, self.port = self.server_address
+    self.db = Database(self)
+    self.delay = delay
+    self.cluster = None
+    self.counts_lock = Lock()
+    self.reset()
+
+  def reset(self):
+    """Start counting from zero."""
+    with self.counts_lock:
+      self.commands = defaultdict(int)
+      self.bytes_in = 0
+      self.bytes_out = 0
+
+  def count(self, command, received, sent):
+    with self.counts_lock:
+      if command:
+        self.commands[command.upper()] += 1
+      self.bytes_in += received
+      self.bytes_out += sent
+
+  def start(self):
+    thread = Thread(target=self.serve_forever, name='stand-in')
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+class Cluster(object):
+  """Stand-ins sharing the hash slots out evenly, one shard each."""
+
+  def __init__(self, nodes=3, host='127.0.0.1', delay=0):
+    self.servers = [Server(host, delay=delay) for i in xrange(nodes)]
+    for server in self.servers:
+      server.cluster = self
+    self.owners = [self.servers[slot * nodes // SLOTS]
+        for slot in xrange(SLOTS)]
+    self.host, self.port = self.servers[0].host, self.servers[0].port
+
+  def check(self, server, keys):
+    """Refuse keys server doesn't own, the way redis does."""
+    slots = set(keyslot(key) for key in keys)
+    if len(slots) > 1:
+      raise Error("CROSSSLOT Keys in request don't hash to the same slot")
+    for slot in slots:
+      owner = self.owners[slot]
+      if owner is not server:
+        raise Error('MOVED %d %s:%d' % (slot, owner.host, owner.port))
+
+  def slots(self):
+    """The CLUSTER SLOTS reply: each run of slots and who owns it."""
+    reply = []
+    for slot in xrange(SLOTS):
+      owner = self.owners[slot]
+      if reply and reply[-1][2][1] == owner.port and reply[-1][1] == slot - 1:
+        reply[-1][1] = slot
+      else:
+        reply.append([slot, slot, [owner.host, owner.port, str(owner.port)]])
+    return reply
+
+  def move(self, slot, server):
+    """Hand slot, and every key in it, over to server."""
+    source = self.owners[slot].db
+    with source.lock:
+      with server.db.lock:
+        for key in [key for key in source.data if keyslot(key) == slot]:
+          server.db.store(key, source.data[key])
+          source.drop(key)
+        self.owners[slot] = server
+
+  @property
+  def commands(self):
+    commands = defaultdict(int)
+    for server in self.servers:
+      for (name, count) in server.commands.items():
+        commands[name] += count
+    return commands
+
+  def reset(self):
+    for server in self.servers:
+      server.reset()
+
+  def start(self):
+    for server in self.servers:
+      server.start()
+    return self
+
+  def stop(self):
+    for server in self.servers:
+      server.stop()
@@ -0,0 +1,218 @@
+"""Mounting an RDB snapshot.
+
+Writes a synthetic dump.rdb (strings, compressed and integer strings,
+quicklist lists, listpack and plain hashes, intset and listpack sets,
+listpack and skiplist zsets, keys in a second database, expired keys and
+a stream), then opens it with rdb.Snapshot and reports how long the pass
+over it took and the memory the index costs, and reads every value back
+through the filesystem to check it.
+
+    python -m bench.snapshot [keys] [file]
+
+keys defaults to 1000000; the file is removed afterwards unless given.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import tempfile
+from struct import pack
+from timeit import default_timer
+
+from bench.memory import rss
+from rdb import Snapshot, SnapshotClient
+from redisfuse import Redis
+
+PER_DIR = 1000
+TAKEN = 1700000000   # ctime of the snapshot
+CHECKED = 3          # directories read back through the filesystem
+
+
+def length(n):
+  if n < 1 << 6:
+    return chr(n)
+  if n < 1 << 14:
+    return chr(0x40 | n >> 8) + chr(n & 0xff)
+  return '\x80' + pack('>I', n)
+
+
+def string(value):
+  if value.isdigit() and len(value) < 10 and value[0] != '0' and \
+     int(value) < 1 << 31:
+    return '\xc2' + pack('<i', int(value))
+  if len(value) > 64 and len(set(value)) == 1:
+    # LZF: one literal byte, then back references copying it
+    compressed = '\x00' + value[0]
+    left = len(value) - 1
+    while left:
+      run = min(left, 264)
+      if run < 3:
+        compressed += chr(run - 1) + value[0] * run
+      else:
+        compressed += '\xe0' + chr(run - 9) + '\x00' if run >= 9 else \
+            chr((run - 2) << 5) + '\x00'
+      left -= run
+    return '\xc3' + length(len(compressed)) + length(len(value)) + compressed
+  return length(len(value)) + value
+
+
+def listpack(items):
+  body = ''
+  for item in items:
+    if item.isdigit() and int(item) < 128 and str(int(item)) == item:
+      entry = chr(int(item))
+    elif len(item) < 64:
+      entry = chr(0x80 | len(item)) + item
+    else:
+      entry = chr(0xe0 | len(item) >> 8) + chr(len(item) & 0xff) + item
+    body += entry + chr(len(entry))   # entries here are all under 128
+  return pack('<IH', 6 + len(body) + 1, len(items)) + body + '\xff'
+
+
+def intset(values):
+  return pack('<II', 4, len(values)) + ''.join(pack('<i', v)
+      for v in sorted(values))
+
+
+def generate(path, keys):
+  """Write the snapshot and return what each key should read back as."""
+  expected = {}
+  with open(path, 'wb') as f:
+    f.write('REDIS0011')
+    f.write('\xfa' + string('redis-ver') + string('7.2.0'))
+    f.write('\xfa' + string('ctime') + string(str(TAKEN)))
+    f.write('\xfe\x00\xfb' + length(keys) + length(0))
+    for i in xrange(keys):
+      key = 'snap:%d:k%d' % (i // PER_DIR, i)
+      kind = i % 10
+      if kind == 0:
+        fields = dict(('f%d' % n, 'v' * n) for n in xrange(i % 7 + 1))
+        f.write('\x10' + string(key) + string(listpack(sum(fields.items(),
+            ()))))
+        expected.update((key + '.' + name, value)
+            for (name, value) in fields.items())
+        continue
+      if kind == 1:
+        f.write('\x04' + string(key) + length(2) + string('a') +
+            string('1') + string('b') + string('x' * 100))
+        expected[key + '.a'] = '1'
+        expected[key + '.b'] = 'x' * 100
+        continue
+      if kind == 2:
+        items = ['item%d' % n for n in xrange(5)] + ['7', 'y' * 70]
+        f.write('\x12' + string(key) + length(3) + length(2) +
+            string(listpack(items[:4])) + length(1) + string(items[4]) +
+            length(2) + string(listpack(items[5:])))
+        value = items
+      elif kind == 3:
+        f.write('\x0b' + string(key) + string(intset([3, 1, 2])))
+        value = set(['1', '2', '3'])
+      elif kind == 4:
+        f.write('\x14' + string(key) + string(listpack(['m', 'n'])))
+        value = set(['m', 'n'])
+      elif kind == 5:
+        f.write('\x11' + string(key) + string(listpack(['a', '1', 'b',
+            '2'])))
+        value = ['a', 'b']
+      elif kind == 6:
+        f.write('\x05' + string(key) + length(2) + string('z') +
+            pack('<d', 1.5) + string('y') + pack('<d', -2.0))
+        value = ['y', 'z']
+      elif kind == 7:
+        value = 'r' * 200
+        f.write('\x00' + string(key) + string(value))
+      elif kind == 8:
+        value = str(i)
+        f.write('\x00' + string(key) + string(value))
+      else:
+        value = 'plain value %d\n' % i
+        f.write('\x00' + string(key) + string(value))
+      expected[key] = value
+    # gone by the time the snapshot was taken, and still to go
+    f.write('\xfc' + pack('<Q', (TAKEN - 1) * 1000) + '\x00' +
+        string('snap:expired') + string('x'))
+    f.write('\xfc' + pack('<Q', (TAKEN + 60) * 1000) + '\x00' +
+        string('snap:expiring') + string('soon'))
+    expected['snap:expiring'] = 'soon'
+    # an empty stream with one consumer group, never shown
+    f.write('\x13' + string('snap:stream') + length(0) + length(0) * 3 +
+        length(0) * 5 + length(1) + string('group') + length(0) * 3 +
+        length(0) + length(1) + string('consumer') + pack('<Q', 0) +
+        length(0))
+    f.write('\xfe\x01' + '\x00' + string('snap:other-db') + string('x'))
+    f.write('\xff' + '\0' * 8)
+  return expected
+
+
+def check(path, expected, keys):
+  """Read back every file in the first few directories through the
+     filesystem, and make sure nothing else shows up there."""
+  fs = Redis(None, None, client=SnapshotClient(Snapshot(path)), lazy=True,
+      readonly=True, watch=False, cache_size=0)
+  fs('init', '/')
+  dirs = ['/snap/%d' % d
+      for d in xrange(min(CHECKED, (keys - 1) // PER_DIR + 1))]
+  for dir in ['/snap'] + dirs:
+    fs('getattr', dir)
+  files = dict(found for dir in dirs for found in walk(fs, dir))
+  wanted = dict(('/' + key.replace(':', '/'), value)
+      for (key, value) in expected.items())
+  wanted = dict((path, value) for (path, value) in wanted.items()
+      if path.rsplit('/', 1)[0] in dirs or path == '/snap/expiring')
+  wrong = 0
+  for (path, value) in wanted.items():
+    size = fs('getattr', path)['st_size']
+    data = fs('read', path, size, 0, 0)
+    wrong += (data if isinstance(value, str) else eval(data)) != value
+    files.pop(path, None)
+  for path in ('/snap/expired', '/snap/stream', '/snap/other-db'):
+    try:
+      fs('getattr', path)
+      wrong += 1
+    except OSError:
+      pass
+  print '%d of %d files read back wrong, %d unexpected' % (wrong,
+      len(wanted), len(files))
+  return not wrong and not files
+
+
+def walk(fs, path):
+  for (name, attrs, offset) in fs('readdir', path, 0):
+    if name in ('.', '..'):
+      continue
+    child = path + '/' + name
+    if attrs['st_mode'] & 0040000:
+      for found in walk(fs, child):
+        yield found
+    else:
+      yield (child, attrs)
+
+
+def main(keys=1000000, path=None):
+  keep = path is not None
+  if not keep:
+    (fd, path) = tempfile.mkstemp(suffix='.rdb')
+    os.close(fd)
+  try:
+    start = default_timer()
+    expected = generate(path, keys)
+    print 'wrote %d keys, %.1f MB in %.1fs' % (keys,
+        os.path.getsize(path) / 1048576.0, default_timer() - start)
+    before = rss()
+    start = default_timer()
+    snapshot = Snapshot(path)
+    print 'opened in %.2fs, index %.1f MB (%d bytes/key)' % (
+        default_timer() - start, (rss() - before) / 1048576.0,
+        (rss() - before) // len(snapshot.keys))
+    del snapshot
+    return check(path, expected, keys)
+  finally:
+    if not keep:
+      os.remove(path)
+
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  sys.exit(0 if main(int(args[0]) if args else 1000000,
+      *args[1:]) else 1)
@@ -0,0 +1,100 @@
+"""Concurrency stress test.
+
+Hammers one Redis operations object from many threads at once, the way a
+multi-threaded fuse mount does, then checks that redis and the directory
+listing hold exactly what every thread wrote.
+
+    python -m bench.stress <server> <port> [threads] [files-per-thread]
+
+Everything lives under the stress:<pid> namespace and is deleted afterwards,
+but point it at a scratch redis anyway.
+"""
+
+import os
+import random
+import sys
+import traceback
+from threading import Thread
+
+from redisfuse import Redis
+
+CHUNK = 4096
+
+
+def worker(fs, base, n, files, expected, errors):
+  rng = random.Random(n)
+  try:
+    for i in xrange(files):
+      name = 'w%d-%d' % (n, i)
+      path = base + '/' + name
+      data = os.urandom(rng.randint(0, 16 * CHUNK))
+
+      # write out of order so the buffer has to merge extents
+      fh = fs.create(path, 0644)
+      chunks = range(0, len(data), CHUNK)
+      rng.shuffle(chunks)
+      for offset in chunks:
+        fs.write(path, data[offset:offset + CHUNK], offset, fh)
+      fs.release(path, fh)
+
+      fh = fs.open(path, 0)
+      got = fs.read(path, len(data) + 1, 0, fh)
+      fs.release(path, fh)
+      if str(got) != data:
+        errors.append('%s: read %d bytes back, wrote %d' %
+            (path, len(got), len(data)))
+
+      list(fs.readdir(base, 0))
+      if fs.getattr(path)['st_size'] != len(data):
+        errors.append('%s: wrong size' % path)
+
+      roll = rng.random()
+      if roll < 0.3:
+        fs.rename(path, base + '/r' + name[1:])
+        name = 'r' + name[1:]
+      elif roll < 0.5:
+        fs.unlink(path)
+        continue
+      expected[name] = data
+  except Exception:
+    errors.append(traceback.format_exc())
+
+
+def main(host, port, threads=16, files=50):
+  fs = Redis(host, port, threads=threads, lazy=True, watch=False)
+  namespace = 'stress:%d' % os.getpid()
+  base = '/' + namespace.replace(':', '/')
+  fs.mkdir(base, 0755)
+
+  expected = {}
+  errors = []
+  workers = [Thread(target=worker, args=(fs, base, n, files, expected, errors))
+      for n in xrange(threads)]
+  for t in workers:
+    t.start()
+  for t in workers:
+    t.join()
+
+  listed = set(name for (name, attrs, offset) in fs.readdir(base, 0))
+  listed -= set(['.', '..'])
+  if listed != set(expected):
+    errors.append('listing is off by %s' % sorted(listed ^ set(expected)))
+  for name, data in expected.iteritems():
+    if fs.redis.get(namespace + ':' + name) != data:
+      errors.append('%s: redis has something else' % name)
+  for keys in fs.scan(namespace + ':*'):
+    fs.redis.delete(*keys)
+
+  for error in errors:
+    print error
+  print '%d threads, %d files each: %s' % (threads, files,
+      'FAILED' if errors else 'ok')
+  return not errors
+
+
+if __name__ == "__main__":
+  if len(sys.argv) < 3:
+    print __doc__
+    sys.exit(1)
+  sys.exit(0 if main(sys.argv[1], int(sys.argv[2]),
+      *[int(arg) for arg in sys.argv[3:]]) else 1)
@@ -0,0 +1,97 @@
+"""In-process cache of file contents.
+
+Values are cached whole, keyed by (redis key, hash field), and evicted least
+recently used first once the cache holds more than max_bytes.  The cache
+doesn't know when redis changes; the filesystem calls invalidate() for its
+own writes and for every invalidation redis sends us (CLIENT TRACKING or
+keyspace notifications).
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+# bytes of file contents kept in memory
+CACHE_SIZE = 64 * 1024 * 1024
+
+# values bigger than this are never cached, they'd just push everything
+# else out
+CACHE_ENTRY = 1024 * 1024
+
+
+class ContentCache(object):
+  def __init__(self, max_bytes=CACHE_SIZE, max_entry=CACHE_ENTRY):
+    self.max_bytes = max_bytes
+    self.max_entry = min(max_entry, max_bytes)
+    self.entries = OrderedDict()   # (key, field) -> value, oldest first
+    self.fields = {}               # key -> set of cached fields
+    self.size = 0
+    self.lock = Lock()
+    # bumped on every invalidation.  A value fetched before an invalidation
+    # may be stale, so put() refuses it (see epoch argument).
+    self.epoch = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def __contains__(self, (key, field)):
+    """Whether (key, field) is cached, without counting a hit or miss."""
+    return (key, field) in self.entries
+
+  def get(self, key, field=None):
+    """The cached value or None."""
+    with self.lock:
+      value = self.entries.pop((key, field), None)
+      if value is None:
+        self.misses += 1
+        return None
+      self.entries[(key, field)] = value   # now the most recently used
+      self.hits += 1
+      return value
+
+  def put(self, key, field, value, epoch):
+    """Cache value, unless it's too big or something was invalidated since
+       epoch (read self.epoch before fetching value from redis)."""
+    if value is None or len(value) > self.max_entry:
+      return
+    with self.lock:
+      if epoch != self.epoch:
+        return
+      self._remove(key, field)
+      self.entries[(key, field)] = value
+      self.fields.setdefault(key, set()).add(field)
+      self.size += len(value)
+      while self.size > self.max_bytes:
+        (old_key, old_field) = next(iter(self.entries))
+        self._remove(old_key, old_field)
+        self.evictions += 1
+
+  def invalidate(self, key=None):
+    """Forget everything cached for key (or everything, if key is None)."""
+    with self.lock:
+      self.epoch += 1
+      self.invalidations += 1
+      if key is None:
+        self.entries.clear()
+        self.fields.clear()
+        self.size = 0
+        return
+      for field in list(self.fields.get(key, ())):
+        self._remove(key, field)
+
+  def _remove(self, key, field):
+    value = self.entries.pop((key, field), None)
+    if value is None:
+      return
+    self.size -= len(value)
+    fields = self.fields[key]
+    fields.discard(field)
+    if not fields:
+      del self.fields[key]
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return dict(entries=len(self.entries), bytes=self.size,
+        max_bytes=self.max_bytes, hits=self.hits, misses=self.misses,
+        hit_rate=float(self.hits) / lookups if lookups else 0.0,
+        evictions=self.evictions, invalidations=self.invalidations)
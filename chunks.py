@@ -0,0 +1,44 @@
+"""Big files stored as fixed-size chunks.
+
+A string or hash field is one value: every write to it rewrites it whole
+server-side (SETRANGE, HSETRANGE copy it), and it can grow as big as the
+file does, past what proxies and replication are happy with.  With a
+chunk size set, a file growing past it moves into a hash of its own at
+the key its path names (/a/big.iso is the hash a:big.iso, not field iso
+of a:big), holding
+
+  __chunks__   "<length> <chunk size>"
+  0, 1, ...    bytes 0 up to chunk size, chunk size up to twice that, ...
+
+Reads, writes and truncates (the CHUNK* scripts in scripts.py) then touch
+only the chunks they cover, and no value is ever larger than one chunk.
+Chunks never written (a sparse file, or one extended by truncate) read
+as zero bytes.  Each file keeps the chunk size it was made with, so
+mounting again with another one still reads it.
+
+Files only ever move this way: a chunked file truncated back down stays
+chunked.
+"""
+
+# hash field a chunked file's manifest is kept in
+MANIFEST = '__chunks__'
+
+
+def manifest(length, chunk_size):
+  return '%d %d' % (length, chunk_size)
+
+
+def parse(manifest):
+  """(length, chunk size) from a manifest, None if it isn't one."""
+  try:
+    (length, chunk_size) = [int(n) for n in manifest.split()]
+  except (AttributeError, ValueError):
+    return None
+  return (length, chunk_size)
+
+
+def fields(value, chunk_size):
+  """(field, data) making up value as a chunked file."""
+  yield (MANIFEST, manifest(len(value), chunk_size))
+  for (index, start) in enumerate(xrange(0, len(value), chunk_size)):
+    yield (str(index), value[start:start + chunk_size])
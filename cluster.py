@@ -0,0 +1,152 @@
+"""Redis Cluster.
+
+A cluster shares its keys out between several primaries by hash slot.
+redis-py-cluster (pip install redis-py-cluster) sends every command to
+the node owning its key's slot and follows MOVED and ASK redirects while
+slots migrate.  Its pipelines split the queued commands per node, write
+to every node before reading any replies, and retry redirected commands
+one at a time, so a pipeline costs about one round trip however many
+nodes it touches.
+
+What Cluster adds for the filesystem:
+
+- primaries(): a plain client per primary.  SCAN, SCRIPT LOAD and
+  keyspace notifications are all per node, so listing, loading scripts
+  and watching go to each primary.
+- merged(): runs a generator per primary in its own thread and yields
+  what they produce as it arrives, so the keyspace is walked on every
+  shard at once and a listing takes as long as the biggest shard, not
+  all of them in turn.
+- EVALSHA can be queued on pipelines (redis-py-cluster refuses it), and
+  DEBUG DIGEST-VALUE goes to the node holding the key.
+
+Databases other than 0 and CLIENT TRACKING (whose invalidations can only
+be redirected to a client on the same node) aren't available.
+"""
+
+from Queue import Queue
+from threading import Event, Lock, Thread
+
+import redis
+
+try:
+  from rediscluster import RedisCluster, ClusterConnection, \
+      ClusterConnectionPool
+  from rediscluster.pipeline import ClusterPipeline
+except ImportError:
+  RedisCluster = None
+
+# batches a primary's scan may get ahead of the listing by
+AHEAD = 4
+
+
+class Unavailable(Exception):
+  """redis-py-cluster isn't installed."""
+
+
+if RedisCluster is not None:
+
+  class Connection(ClusterConnection):
+    """Counts every command (or pipeline) sent as a round trip in stats,
+       like redisfuse.Connection."""
+
+    def __init__(self, stats=None, **kwargs):
+      ClusterConnection.__init__(self, **kwargs)
+      self.stats = stats
+
+    def send_packed_command(self, *args, **kwargs):
+      if self.stats:
+        self.stats.round_trip()
+      ClusterConnection.send_packed_command(self, *args, **kwargs)
+
+  class Routing(object):
+    def _determine_slot(self, *args):
+      if args[0] == 'DEBUG' and len(args) > 2:
+        return self.connection_pool.nodes.keyslot(args[2])
+      return super(Routing, self)._determine_slot(*args)
+
+  class Pipeline(Routing, ClusterPipeline):
+    evalsha = redis.Redis.evalsha
+
+  class Cluster(Routing, RedisCluster):
+    """A cluster client, found through the node at host:port."""
+
+    def __init__(self, host, port, stats=None, max_connections=None):
+      # cluster-require-full-coverage is only looked up through CONFIG,
+      # which managed clusters tend to disable
+      RedisCluster.__init__(self, connection_pool=ClusterConnectionPool(
+          startup_nodes=[dict(host=host, port=port)],
+          connection_class=Connection, stats=stats,
+          skip_full_coverage_check=True))
+      self.stats = stats
+      self.max_connections = max_connections
+      self.clients = {}   # node name -> client
+      self.clients_lock = Lock()
+
+    def pipeline(self, transaction=None, shard_hint=None):
+      return Pipeline(connection_pool=self.connection_pool,
+          startup_nodes=self.connection_pool.nodes.startup_nodes,
+          result_callbacks=self.result_callbacks,
+          response_callbacks=self.response_callbacks)
+
+    def primaries(self):
+      """A client for each primary, as the cluster stands now."""
+      with self.clients_lock:
+        clients = []
+        for node in self.connection_pool.nodes.all_masters():
+          client = self.clients.get(node['name'])
+          if client is None:
+            client = self.clients[node['name']] = redis.Redis(
+                connection_pool=redis.BlockingConnectionPool(
+                    host=node['host'], port=node['port'],
+                    connection_class=Connection, stats=self.stats,
+                    timeout=None, max_connections=self.max_connections))
+          clients.append(client)
+        return clients
+
+else:
+
+  def Cluster(*args, **kwargs):
+    raise Unavailable('Redis Cluster needs redis-py-cluster '
+        '(pip install redis-py-cluster)')
+
+
+def merged(iterators):
+  """Everything iterators yield, each run in a thread of its own, in the
+     order it arrives.  An exception in any of them is raised here once
+     it gets to the front.  Stopping early lets the threads finish at
+     their next item."""
+  queue = Queue(AHEAD * len(iterators))
+  stop = Event()
+  done = object()
+
+  def drain(iterator):
+    try:
+      for item in iterator:
+        if stop.is_set():
+          return
+        queue.put((item, None))
+    except Exception, e:
+      queue.put((None, e))
+    finally:
+      queue.put((done, None))
+
+  for iterator in iterators:
+    thread = Thread(target=drain, args=(iterator,))
+    thread.daemon = True
+    thread.start()
+  try:
+    running = len(iterators)
+    while running:
+      (item, error) = queue.get()
+      if error is not None:
+        raise error
+      if item is done:
+        running -= 1
+      else:
+        yield item
+  finally:
+    stop.set()
+    # unblock threads still waiting to put
+    while not queue.empty():
+      queue.get_nowait()
@@ -0,0 +1,213 @@
+"""Coalescing commands from concurrent operations into pipelines.
+
+fuse calls us from many threads at once, and each of them would send its
+commands on a connection of its own and wait a round trip for the reply.
+With coalescing, callers hand their commands (a single command, or a
+whole pipeline) to a Coalescer instead.  Its writer thread takes whatever
+has queued up, waiting up to window seconds for more unless batch
+commands are already waiting, and sends it all on one connection in a
+single write.  It doesn't wait for the replies: a reader thread parses
+them as they come back, in order, and hands each caller its own.  So
+any number of batches can be on the wire at once, and over a slow link
+throughput is bounded by bandwidth instead of round trips and the size
+of the connection pool.
+
+The price is head-of-line blocking: a reply can't be read before the
+ones sent ahead of it, so one slow command (a big HGETALL) holds up
+everything queued behind it.
+
+Transactions (MULTI/EXEC, WATCH), pubsub and the tracking connection
+still take connections of their own from the pool.
+"""
+
+import sys
+from Queue import Queue, Empty
+from threading import Event, Lock, Thread
+from timeit import default_timer
+
+import redis
+from redis.client import Pipeline
+from redis.exceptions import ResponseError
+
+# seconds the writer waits for more commands before sending; 0 sends
+# whatever queued up while the last batch was being written
+WINDOW = 0
+
+# commands sent at most in one batch
+BATCH = 1000
+
+
+class Waiter(object):
+  """One caller's commands and, once they're back, their replies."""
+
+  __slots__ = ('commands', 'op', 'replies', 'error', 'done')
+
+  def __init__(self, commands, op):
+    self.commands = commands   # [(args, options)]
+    self.op = op               # OpStats the round trip is charged to
+    self.replies = None
+    self.error = None
+    self.done = Event()
+
+  def fail(self, error):
+    self.error = error
+    self.done.set()
+
+
+class Coalescer(object):
+  def __init__(self, client, stats=None, window=WINDOW, batch=BATCH):
+    self.client = client   # parses the replies
+    self.stats = stats
+    self.window = window
+    self.batch = batch
+    self.queue = Queue()      # Waiters to send
+    self.inflight = Queue()   # (connection, Waiters) sent, in order
+    # held while writing a batch and while failing the ones in flight, so
+    # a batch is never written to a connection that is being torn down
+    self.lock = Lock()
+    self.connection = None
+    self.batches = 0
+    self.commands = 0
+    for target in (self.write, self.read):
+      thread = Thread(target=target)
+      thread.daemon = True
+      thread.start()
+
+  def submit(self, commands):
+    """Send commands with the next batch and return their replies, a
+       ResponseError in place of any that failed."""
+    op = getattr(self.stats.current, 'op', None) if self.stats else None
+    waiter = Waiter(commands, op)
+    self.queue.put(waiter)
+    waiter.done.wait()
+    if waiter.error is not None:
+      raise waiter.error
+    return waiter.replies
+
+  def collect(self):
+    """The next batch of Waiters."""
+    batch = [self.queue.get()]
+    size = len(batch[0].commands)
+    deadline = default_timer() + self.window
+    while size < self.batch:
+      left = deadline - default_timer()
+      try:
+        waiter = self.queue.get(timeout=left) if left > 0 else \
+            self.queue.get_nowait()
+      except Empty:
+        break
+      batch.append(waiter)
+      size += len(waiter.commands)
+    return (batch, size)
+
+  def write(self):
+    while True:
+      (batch, size) = self.collect()
+      with self.lock:
+        try:
+          if self.connection is None:
+            # held for good; pool.disconnect() (tracking starting) still
+            # closes it and it reconnects on the next write
+            self.connection = self.client.connection_pool.get_connection(
+                'coalesce')
+            # round trips are charged below, to every op in the batch
+            self.connection.stats = None
+          connection = self.connection
+          connection.send_packed_command(connection.pack_commands(
+              [args for waiter in batch for (args, options) in
+                  waiter.commands]))
+          self.inflight.put((connection, batch))
+        except Exception, e:
+          if self.connection is not None:
+            self.connection.disconnect()
+          for waiter in batch:
+            waiter.fail(e)
+          continue
+      self.batches += 1
+      self.commands += size
+      if self.stats:
+        for op in set(waiter.op for waiter in batch):
+          self.stats.round_trip(op)
+
+  def read(self):
+    parse = self.client.parse_response
+    while True:
+      (connection, batch) = self.inflight.get()
+      try:
+        for waiter in batch:
+          replies = []
+          for (args, options) in waiter.commands:
+            try:
+              replies.append(parse(connection, args[0], **options))
+            except ResponseError:
+              replies.append(sys.exc_info()[1])
+          waiter.replies = replies
+          waiter.done.set()
+      except Exception, e:
+        self.broken(connection, batch, e)
+
+  def broken(self, connection, batch, error):
+    """Fail everything sent on connection that hasn't been answered."""
+    with self.lock:
+      connection.disconnect()
+      for waiter in batch:
+        if not waiter.done.is_set():
+          waiter.fail(error)
+      # all written before the disconnect, since writing holds the lock
+      while True:
+        try:
+          (sent_on, waiters) = self.inflight.get_nowait()
+        except Empty:
+          break
+        for waiter in waiters:
+          waiter.fail(error)
+
+
+def coalesced(coalescers):
+  """Batches and commands sent by coalescers, for the stats files."""
+  batches = sum(c.batches for c in coalescers)
+  commands = sum(c.commands for c in coalescers)
+  return dict(batches=batches, commands=commands,
+      per_batch=float(commands) / batches if batches else 0.0)
+
+
+class CoalescedPipeline(Pipeline):
+  """A pipeline sent as one piece of a Coalescer's next batch."""
+
+  def __init__(self, client):
+    Pipeline.__init__(self, client.connection_pool, client.response_callbacks,
+        transaction=False, shard_hint=None)
+    self.coalescer = client.coalescer
+
+  def execute(self, raise_on_error=True):
+    stack = self.command_stack
+    try:
+      if not stack:
+        return []
+      replies = self.coalescer.submit(stack)
+      if raise_on_error:
+        self.raise_first_error(stack, replies)
+      return replies
+    finally:
+      self.reset()
+
+
+class Coalesced(redis.Redis):
+  """A client whose commands and pipelines go through a Coalescer, on a
+     connection of its own from connection_pool."""
+
+  def __init__(self, connection_pool, stats=None, window=WINDOW,
+               batch=BATCH):
+    redis.Redis.__init__(self, connection_pool=connection_pool)
+    self.coalescer = Coalescer(self, stats, window, batch)
+
+  def execute_command(self, *args, **options):
+    reply = self.coalescer.submit([(args, options)])[0]
+    if isinstance(reply, ResponseError):
+      raise reply
+    return reply
+
+  def pipeline(self, transaction=False, shard_hint=None):
+    if transaction or shard_hint:
+      return redis.Redis.pipeline(self, transaction, shard_hint)
+    return CoalescedPipeline(self)
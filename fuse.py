@@ -20,6 +20,7 @@ from ctypes import *
 from ctypes.util import find_library
 from errno import *
 from functools import partial
+from inspect import getargspec
 from os import strerror
 from platform import machine, system
 from stat import S_IFDIR
@@ -231,6 +232,28 @@ class fuse_operations(Structure):
 def time_of_timespec(ts):
     return ts.tv_sec + ts.tv_nsec / 10 ** 9
 
+_as_read_buffer = pythonapi.PyObject_AsReadBuffer
+_as_read_buffer.argtypes = [py_object, POINTER(c_void_p), POINTER(c_ssize_t)]
+
+def buffer_address(data):
+    """Returns an (address, length) pair for the bytes of a str, buffer,
+       bytearray, mmap or array without copying them. data must be kept
+       alive while the address is in use. memoryviews have no old-style
+       buffer interface on 2.x: convert them (and hold on to the result)
+       first."""
+    address, length = c_void_p(), c_ssize_t()
+    _as_read_buffer(data, byref(address), byref(length))
+    return address.value, length.value
+
+def takes_offset(readdir):
+    """Whether an Operations readdir accepts the offset argument. The
+       stock fusepy one is readdir(self, path, fh)."""
+    try:
+        args, varargs = getargspec(readdir)[:2]
+    except TypeError:
+        return True
+    return varargs is not None or len(args) > 3   # self, path, fh, offset
+
 def set_st_attrs(st, attrs):
     for key, val in attrs.items():
         if key in ('st_atime', 'st_mtime', 'st_ctime'):
@@ -241,15 +264,24 @@ def set_st_attrs(st, attrs):
             setattr(st, key, val)
 
 
+# Only complain about a missing libfuse when mounting, so Operations classes
+# can still be imported and driven directly (tests, benchmarks)
 _libfuse_path = find_library('fuse')
-if not _libfuse_path:
-    raise EnvironmentError('Unable to find libfuse')
-_libfuse = CDLL(_libfuse_path)
-_libfuse.fuse_get_context.restype = POINTER(fuse_context)
+if _libfuse_path:
+    _libfuse = CDLL(_libfuse_path)
+    _libfuse.fuse_get_context.restype = POINTER(fuse_context)
+else:
+    _libfuse = None
+
+
+def _need_libfuse():
+    if _libfuse is None:
+        raise EnvironmentError('Unable to find libfuse')
 
 
 def fuse_get_context():
     """Returns a (uid, gid, pid) tuple"""
+    _need_libfuse()
     ctxp = _libfuse.fuse_get_context()
     ctx = ctxp.contents
     return ctx.uid, ctx.gid, ctx.pid
@@ -270,8 +302,11 @@ class FUSE(object):
            class as is to Operations, instead of just the fh field.
            This gives you access to direct_io, keep_cache, etc."""
         
+        _need_libfuse()
         self.operations = operations
         self.raw_fi = raw_fi
+        self.readdir_offset = takes_offset(getattr(operations, 'readdir',
+            None))
         args = ['fuse']
         if kwargs.pop('foreground', False):
             args.append('-f')
@@ -364,12 +399,17 @@ class FUSE(object):
         ret = self.operations('read', path, size, offset, fh)
         if not ret:
             return 0
-        data = create_string_buffer(ret[:size], size)
-        memmove(buf, data, size)
-        return size
+        if isinstance(ret, memoryview):
+            ret = ret.tobytes()   # ret keeps the copy alive for the memmove
+        # copy straight from whatever read returned into the kernel's buffer
+        address, length = buffer_address(ret)
+        length = min(length, size)
+        memmove(buf, address, length)
+        return length
     
     def write(self, path, buf, size, offset, fip):
-        data = string_at(buf, size)
+        # a view of the kernel's buffer, only valid until we return
+        data = memoryview((c_char * size).from_address(addressof(buf.contents)))
         fh = fip.contents if self.raw_fi else fip.contents.fh
         return self.operations('write', path, data, offset, fh)
     
@@ -427,7 +467,8 @@ class FUSE(object):
     
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
-        for item in self.operations('readdir', path, fip.contents.fh):
+        args = (offset,) if self.readdir_offset else ()
+        for item in self.operations('readdir', path, fip.contents.fh, *args):
             if isinstance(item, str):
                 name, st, offset = item, None, 0
             else:
@@ -586,12 +627,17 @@ class Operations(object):
         return 0
     
     def read(self, path, size, offset, fh):
-        """Returns a string containing the data requested."""
+        """Returns a string (or any buffer: buffer, bytearray, mmap...)
+           containing the data requested."""
         raise FuseOSError(EIO)
     
-    def readdir(self, path, fh):
+    def readdir(self, path, fh, offset=0):
         """Can return either a list of names, or a list of (name, attrs, offset)
-           tuples. attrs is a dict as in getattr."""
+           tuples. attrs is a dict as in getattr.
+
+           With tuples, offset is the offset of the last entry the kernel
+           already has (0 at first) and only entries after it are wanted.
+           Each entry's offset must be non-zero."""
         return ['.', '..']
     
     def readlink(self, path):
@@ -635,6 +681,8 @@ class Operations(object):
         return 0
     
     def write(self, path, data, offset, fh):
+        """data is a memoryview of the kernel's buffer, copy anything that
+           has to outlive the call."""
         raise FuseOSError(EROFS)
 
 
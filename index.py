@@ -0,0 +1,220 @@
+"""The directory tree redisfuse shows for a redis keyspace.
+
+Every path component is a node holding its stat attributes; directories
+map child names to nodes, so looking up, adding or removing an entry costs
+a hash lookup per path component no matter how big the directory is.
+
+Each directory also remembers the order entries were added in.  Every
+entry gets a sequence number which readdir hands to the kernel as the
+entry's offset, so a listing can be resumed from the middle even while
+entries come and go.
+"""
+
+from array import array
+from bisect import bisect_right
+
+from records import DirRecord
+
+# offsets 1 and 2 are '.' and '..'
+FIRST_SEQ = 3
+
+
+class Node(object):
+  __slots__ = ('name', 'attrs', 'seq')
+
+  def __init__(self, name, attrs):
+    self.name = name
+    self.attrs = attrs
+    self.seq = 0
+
+  def is_dir(self):
+    return False
+
+
+class Dir(Node):
+  __slots__ = ('stem', 'children', 'order', 'seqs', 'removed', 'next_seq',
+               'stems')
+
+  def __init__(self, name, attrs, stem):
+    Node.__init__(self, name, attrs)
+    self.stem = stem
+    self.children = {}   # name -> Node
+    # children in the order they were added.  Removed children stay until
+    # enough of them pile up to be worth compacting.
+    self.order = []
+    self.seqs = array('l')   # seq of each node in order, for bisecting
+    self.removed = 0
+    self.next_seq = FIRST_SEQ
+    # stem -> names: which entries belong to the same redis key (the
+    # fields of hash "h" are files "h.a", "h.b", ...)
+    self.stems = {}
+
+  def is_dir(self):
+    return True
+
+  def add(self, node):
+    node.seq = self.next_seq
+    self.next_seq += 1
+    self.children[node.name] = node
+    self.order.append(node)
+    self.seqs.append(node.seq)
+    stem = self.stem(node.name)
+    if stem != node.name:
+      self.stems.setdefault(stem, set()).add(node.name)
+    self.attrs.nlink = 2 + len(self.children)
+
+  def remove(self, name):
+    node = self.children.pop(name)
+    stem = self.stem(name)
+    if stem != name:
+      names = self.stems[stem]
+      names.discard(name)
+      if not names:
+        del self.stems[stem]
+    self.attrs.nlink = 2 + len(self.children)
+    self.removed += 1
+    if self.removed > 32 and self.removed > len(self.children):
+      self.compact()
+    return node
+
+  def live(self, node, seq):
+    # a node moved within the directory shows up in order twice, only its
+    # latest seq counts
+    return node.seq == seq and self.children.get(node.name) is node
+
+  def compact(self):
+    pairs = [(n, s) for (n, s) in zip(self.order, self.seqs)
+        if self.live(n, s)]
+    self.order = [n for (n, s) in pairs]
+    self.seqs = array('l', [s for (n, s) in pairs])
+    self.removed = 0
+
+  def entries(self, offset=0):
+    """(name, node, seq) for every child added after offset."""
+    start = bisect_right(self.seqs, offset)
+    for (node, seq) in zip(self.order[start:], self.seqs[start:]):
+      if self.live(node, seq):
+        yield (node.name, node, seq)
+
+
+class PathIndex(object):
+  """Directory tree keyed by absolute paths ('/', '/a', '/a/b.c').
+
+     Looks like a dict of path -> Record for reading.  Changes go
+     through add, mkdir, remove and move so directories stay consistent.
+     stem(name) says which redis key a file name belongs to; entries
+     sharing a stem can be found with related()."""
+
+  def __init__(self, stem=lambda name: name):
+    self.stem = stem
+    self.root = Dir('', DirRecord(), stem)
+
+  def node(self, path):
+    node = self.root
+    for name in path.split('/'):
+      if not name:
+        continue
+      if not node.is_dir():
+        return None
+      node = node.children.get(name)
+      if node is None:
+        return None
+    return node
+
+  def __contains__(self, path):
+    return self.node(path) is not None
+
+  def __getitem__(self, path):
+    node = self.node(path)
+    if node is None:
+      raise KeyError(path)
+    return node.attrs
+
+  def get(self, path, default=None):
+    node = self.node(path)
+    return default if node is None else node.attrs
+
+  def is_dir(self, path):
+    node = self.node(path)
+    return node is not None and node.is_dir()
+
+  def parent(self, path):
+    """(parent directory node, name) for path."""
+    (dir, name) = split_path(path)
+    node = self.node(dir)
+    if node is None or not node.is_dir():
+      raise KeyError(dir)
+    return (node, name)
+
+  def add(self, path, attrs):
+    """Add a file.  The parent directory must exist and path must not."""
+    (dir, name) = self.parent(path)
+    if name in dir.children:
+      raise KeyError(path)
+    node = Node(name, attrs)
+    dir.add(node)
+    return attrs
+
+  def mkdir(self, path, attrs=None):
+    """Add a directory, creating missing parents.  Returns False if path
+       already exists."""
+    (parent, name) = split_path(path)
+    if not self.is_dir(parent):
+      self.mkdir(parent)
+    (dir, name) = self.parent(path)
+    if name in dir.children:
+      return False
+    dir.add(Dir(name, attrs or DirRecord(), self.stem))
+    return True
+
+  def remove(self, path):
+    (dir, name) = self.parent(path)
+    if name not in dir.children:
+      raise KeyError(path)
+    return dir.remove(name).attrs
+
+  def move(self, old, new):
+    """Move an entry (and everything below it), replacing whatever is at
+       new."""
+    (odir, oname) = self.parent(old)
+    (ndir, nname) = self.parent(new)
+    node = odir.remove(oname)
+    if nname in ndir.children:
+      ndir.remove(nname)
+    node.name = nname
+    ndir.add(node)
+
+  def entries(self, path, offset=0):
+    """(name, attrs, seq) for the children of path, in the order they were
+       added, resuming after offset."""
+    node = self.node(path)
+    if node is None or not node.is_dir():
+      raise KeyError(path)
+    for (name, child, seq) in node.entries(offset):
+      yield (name, child.attrs, seq)
+
+  def related(self, path):
+    """Names in path's directory belonging to the same stem as path."""
+    (dir, name) = self.parent(path)
+    names = set(dir.stems.get(name, ()))
+    if name in dir.children:
+      names.add(name)
+    return names
+
+  def walk(self, path='/'):
+    """(path, attrs) for every file below path."""
+    stack = [(path.rstrip('/'), self.node(path))]
+    while stack:
+      (base, node) = stack.pop()
+      for (name, child) in node.children.items():
+        child_path = base + '/' + name
+        if child.is_dir():
+          stack.append((child_path, child))
+        else:
+          yield (child_path, child.attrs)
+
+
+def split_path(path):
+  """('/a/b', 'c') for '/a/b/c'."""
+  (dir, name) = path.rstrip('/').rsplit('/', 1)
+  return (dir or '/', name)
@@ -0,0 +1,122 @@
+"""Logging.
+
+Everything goes through the "redisfuse" logger.  Filesystem operations
+are logged at DEBUG by LogOps, which costs a level check per call while
+DEBUG is off, so a mount only pays for logging when someone is reading
+it.  setup() configures the level, how many operations to sample, and
+whether records are written from a background thread.
+"""
+
+import logging
+import sys
+from collections import defaultdict
+from itertools import count
+from Queue import Queue, Full
+from threading import Thread
+
+log = logging.getLogger('redisfuse')
+log.addHandler(logging.NullHandler())
+
+# characters of each argument or result shown when logging an operation
+PAYLOAD = 64
+
+# records waiting for the background thread before we start dropping them
+QUEUE_SIZE = 10000
+
+FORMAT = '%(asctime)s %(threadName)s %(levelname)s %(message)s'
+
+
+def short(value, limit=PAYLOAD):
+  """repr of value, cut down to limit characters.  Big containers and
+     buffers aren't repr'd at all, only measured."""
+  if isinstance(value, (str, bytearray, memoryview, buffer)) and \
+     len(value) > limit:
+    return '<%d bytes %r...>' % (len(value), str(bytearray(value[:limit])))
+  if isinstance(value, (list, tuple, dict, set)) and len(value) > limit:
+    return '<%s of %d>' % (type(value).__name__, len(value))
+  text = repr(value)
+  if len(text) > limit:
+    return text[:limit] + '...'
+  return text
+
+
+class Sampler(object):
+  """Says yes to one in every `every` calls of each operation."""
+
+  def __init__(self, every=1):
+    self.every = every
+    self.calls = defaultdict(count)
+
+  def __call__(self, op):
+    return self.every <= 1 or next(self.calls[op]) % self.every == 0
+
+
+class LogOps(object):
+  """Mixin for Operations logging each call and its result at DEBUG
+     (or a sample of them, see setup)."""
+
+  sample = Sampler()
+
+  def __call__(self, op, *args):
+    if not log.isEnabledFor(logging.DEBUG) or not self.sample(op):
+      return super(LogOps, self).__call__(op, *args)
+    log.debug('-> %s %s', op, ' '.join(short(arg) for arg in args))
+    ret = '[Unhandled Exception]'
+    try:
+      ret = super(LogOps, self).__call__(op, *args)
+      return ret
+    except OSError, e:
+      ret = str(e)
+      raise
+    finally:
+      log.debug('<- %s %s', op, short(ret))
+
+
+class QueueHandler(logging.Handler):
+  """Hands records to a background thread which passes them on to handler,
+     so a slow terminal or pipe doesn't hold up filesystem calls.  If the
+     thread falls too far behind records are dropped (and counted) rather
+     than making anyone wait."""
+
+  def __init__(self, handler, size=QUEUE_SIZE):
+    logging.Handler.__init__(self)
+    self.handler = handler
+    self.queue = Queue(size)
+    self.dropped = 0
+    writer = Thread(target=self.drain, name='log')
+    writer.daemon = True
+    writer.start()
+
+  def emit(self, record):
+    # nothing the message refers to may change once we return
+    record.msg = record.getMessage()
+    record.args = None
+    try:
+      self.queue.put_nowait(record)
+    except Full:
+      self.dropped += 1
+
+  def drain(self):
+    while True:
+      self.handler.handle(self.queue.get())
+
+
+def setup(level='warning', sample=1, queued=False, stream=sys.stderr):
+  handler = logging.StreamHandler(stream)
+  handler.setFormatter(logging.Formatter(FORMAT))
+  if queued:
+    handler = QueueHandler(handler)
+  log.addHandler(handler)
+  log.setLevel(level.upper())
+  LogOps.sample.every = sample
+
+
+def toggle_debug():
+  """Switch DEBUG on, or back to the level it was on before."""
+  if log.getEffectiveLevel() == logging.DEBUG:
+    log.setLevel(getattr(log, 'saved_level', logging.WARNING))
+  else:
+    log.saved_level = log.getEffectiveLevel()
+    log.setLevel(logging.DEBUG)
+  log.warning('log level is now %s',
+      logging.getLevelName(log.getEffectiveLevel()))
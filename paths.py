@@ -0,0 +1,97 @@
+"""Mapping filesystem paths to redis keys.
+
+Directories are key namespaces: /a/b/c is the key a:b:c.  A file name
+with a dot in it may also be a hash field: /a/h.txt is field txt of the
+hash a:h.  Hidden names keep their leading dot (/.h.txt is field txt of
+.h).  Which reading applies depends on what redis holds, so parse()
+returns both and the filesystem picks one.
+
+Every operation starts by parsing its path, and find or git status stat
+the same paths over and over, so parses are memoized.
+"""
+
+import re
+
+# paths remembered per parser
+PATH_CACHE = 64 * 1024
+
+
+def layers(path):
+  """Split path into the part naming a key and the hash field after it
+     ('/a/h', 'txt' for '/a/h.txt').  The field is False if there's no dot
+     in the name."""
+  if path == '/':
+    return ('/', False)
+  split = path.split('.')
+  if '/.' in path:
+    # /".here.we.are" == ".here", "we.are"
+    return (split[0] + '.' + split[1], '.'.join(split[2:]))
+  if len(split) > 1:
+    return (split[0], '.'.join(split[1:]))
+  return (split[0], False)
+
+
+def key_stem(name):
+  """The part of a file name naming its redis key ("h" for field "h.a")."""
+  return layers('/' + name)[0][1:]
+
+
+def parse(path):
+  """(key, hash key, field, parent directory, file name) for path.
+
+     key is the whole path as one key (a string value), hash key and field
+     the hash field reading of it."""
+  parts = [part for part in path.split('/') if part]
+  (key_path, field) = layers(path)
+  hash_key = ':'.join([part for part in key_path.split('/') if part])
+  return (':'.join(parts), hash_key, field, '/' + '/'.join(parts[:-1]),
+      parts[-1] if parts else '')
+
+
+def glob(pattern):
+  """Compile a SCAN MATCH pattern."""
+  regex = []
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if c == '\\' and i + 1 < len(pattern):
+      i += 1
+      regex.append(re.escape(pattern[i]))
+    elif c == '*':
+      regex.append('.*')
+    elif c == '?':
+      regex.append('.')
+    elif c == '[':
+      end = pattern.find(']', i + 1)
+      if end < 0:
+        regex.append(re.escape(c))
+      else:
+        regex.append('[' + pattern[i + 1:end].replace('\\', '\\\\') + ']')
+        i = end
+    else:
+      regex.append(re.escape(c))
+    i += 1
+  return re.compile(''.join(regex) + r'\Z', re.S)
+
+
+class PathParser(object):
+  """parse() with a bounded memo.  Parsing doesn't depend on what's in
+     redis so memoized results never go stale, but the filesystem forgets
+     paths it renames or deletes so they don't crowd out live ones."""
+
+  def __init__(self, size=PATH_CACHE):
+    self.size = size
+    self.memo = {}
+
+  def parse(self, path):
+    parsed = self.memo.get(path)
+    if parsed is None:
+      parsed = parse(path)
+      if len(self.memo) >= self.size:
+        # starting over is cheaper than keeping recency for every lookup
+        self.memo.clear()
+      self.memo[path] = parsed
+    return parsed
+
+  def forget(self, path):
+    self.memo.pop(path, None)
@@ -0,0 +1,746 @@
+"""Read-only access to an RDB snapshot.
+
+Snapshot memory-maps a dump.rdb file and reads it through once, noting
+where each key's value starts and what type it is without decoding
+anything.  Values are decoded from the mapping only when they're asked
+for, and strings are sliced straight out of it, so a snapshot of any size
+opens about as fast as it can be read and only the key index is kept in
+memory.
+
+SnapshotClient answers the part of the redis-py client API the filesystem
+uses from a Snapshot, so
+
+    Redis(None, None, client=SnapshotClient(Snapshot('dump.rdb')),
+          readonly=True, watch=False, cache_size=0)
+
+browses a dump without a server.  Every RDB version up to 12 (redis 7.4)
+is understood except hashes with expiring fields; streams and module
+values are stepped over and never show up as files.
+"""
+
+import mmap
+import os
+from bisect import bisect_left
+from hashlib import sha1
+from struct import unpack_from
+from threading import Lock
+
+from redis.exceptions import ResponseError
+
+import chunks
+import scripts
+from paths import glob
+
+VERSION = 12   # newest RDB version we know
+
+# collections decoded per client, kept for the reads that follow
+DECODED = 64
+
+# opcodes
+SLOT_INFO = 0xf4
+FUNCTION = 0xf5
+MODULE_AUX = 0xf7
+IDLE = 0xf8
+FREQ = 0xf9
+AUX = 0xfa
+RESIZEDB = 0xfb
+EXPIRETIME_MS = 0xfc
+EXPIRETIME = 0xfd
+SELECTDB = 0xfe
+EOF = 0xff
+
+# value types
+STRING = 0
+LIST = 1
+SET = 2
+ZSET = 3
+HASH = 4
+ZSET_2 = 5
+MODULE_2 = 7
+HASH_ZIPMAP = 9
+LIST_ZIPLIST = 10
+SET_INTSET = 11
+ZSET_ZIPLIST = 12
+HASH_ZIPLIST = 13
+LIST_QUICKLIST = 14
+STREAM_LISTPACKS = 15
+HASH_LISTPACK = 16
+ZSET_LISTPACK = 17
+LIST_QUICKLIST_2 = 18
+STREAM_LISTPACKS_2 = 19
+SET_LISTPACK = 20
+STREAM_LISTPACKS_3 = 21
+
+TYPES = {
+  STRING: 'string',
+  LIST: 'list', LIST_ZIPLIST: 'list', LIST_QUICKLIST: 'list',
+  LIST_QUICKLIST_2: 'list',
+  SET: 'set', SET_INTSET: 'set', SET_LISTPACK: 'set',
+  ZSET: 'zset', ZSET_2: 'zset', ZSET_ZIPLIST: 'zset', ZSET_LISTPACK: 'zset',
+  HASH: 'hash', HASH_ZIPMAP: 'hash', HASH_ZIPLIST: 'hash',
+  HASH_LISTPACK: 'hash',
+  STREAM_LISTPACKS: 'stream', STREAM_LISTPACKS_2: 'stream',
+  STREAM_LISTPACKS_3: 'stream',
+  MODULE_2: 'module',
+}
+
+# a key's type is kept in the low bits of its value's offset
+TYPE_BITS = 5
+
+WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+
+class RDBError(Exception):
+  """The file isn't an RDB snapshot we can read."""
+
+
+def lzf_decompress(data, length):
+  out = bytearray(length)
+  (i, o) = (0, 0)
+  while i < len(data):
+    ctrl = ord(data[i])
+    i += 1
+    if ctrl < 32:
+      # a run of ctrl + 1 literal bytes
+      out[o:o + ctrl + 1] = data[i:i + ctrl + 1]
+      i += ctrl + 1
+      o += ctrl + 1
+      continue
+    # a back reference, which may overlap what it's copying
+    size = ctrl >> 5
+    if size == 7:
+      size += ord(data[i])
+      i += 1
+    ref = o - ((ctrl & 0x1f) << 8) - ord(data[i]) - 1
+    i += 1
+    for j in xrange(size + 2):
+      out[o] = out[ref + j]
+      o += 1
+  return str(out)
+
+
+class Snapshot(object):
+  """The keys of one database in an RDB file.
+
+     keys maps each key to where its value starts in the file, shifted
+     left by TYPE_BITS, with the value's type in the low bits."""
+
+  def __init__(self, path, db=0):
+    self.path = path
+    with open(path, 'rb') as f:
+      if not os.fstat(f.fileno()).st_size:
+        raise RDBError('%s is empty' % path)   # and can't be mapped
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.db = db
+    self.keys = {}
+    self.aux = {}
+    self.load()
+    # sorted, so SCAN can jump straight to a prefix
+    self.names = sorted(self.keys)
+
+  # lengths and strings
+
+  def length(self, pos):
+    """(length, pos after it).  A length with the top two bits set is
+       the encoding of a special string (see string) and comes back
+       negative: -1 - the encoding."""
+    first = ord(self.data[pos])
+    kind = first >> 6
+    if kind == 0:
+      return (first & 0x3f, pos + 1)
+    if kind == 1:
+      return (((first & 0x3f) << 8) | ord(self.data[pos + 1]), pos + 2)
+    if kind == 3:
+      return (-1 - (first & 0x3f), pos + 1)
+    if first == 0x80:
+      return (unpack_from('>I', self.data, pos + 1)[0], pos + 5)
+    if first == 0x81:
+      return (unpack_from('>Q', self.data, pos + 1)[0], pos + 9)
+    raise RDBError('bad length at offset %d' % pos)
+
+  def span(self, pos):
+    """(start, end, pos after) of the string at pos if it's stored as is,
+       (None, length, pos after) if it's an integer or compressed."""
+    (size, pos) = self.length(pos)
+    if size >= 0:
+      return (pos, pos + size, pos + size)
+    encoding = -1 - size
+    if encoding == 0:
+      return (None, len(str(unpack_from('<b', self.data, pos)[0])), pos + 1)
+    if encoding == 1:
+      return (None, len(str(unpack_from('<h', self.data, pos)[0])), pos + 2)
+    if encoding == 2:
+      return (None, len(str(unpack_from('<i', self.data, pos)[0])), pos + 4)
+    if encoding == 3:
+      (compressed, pos) = self.length(pos)
+      (size, pos) = self.length(pos)
+      return (None, size, pos + compressed)
+    raise RDBError('bad string encoding at offset %d' % pos)
+
+  def string(self, pos):
+    """(string, pos after it)."""
+    (size, pos) = self.length(pos)
+    if size >= 0:
+      return (self.data[pos:pos + size], pos + size)
+    encoding = -1 - size
+    if encoding == 0:
+      return (str(unpack_from('<b', self.data, pos)[0]), pos + 1)
+    if encoding == 1:
+      return (str(unpack_from('<h', self.data, pos)[0]), pos + 2)
+    if encoding == 2:
+      return (str(unpack_from('<i', self.data, pos)[0]), pos + 4)
+    if encoding == 3:
+      (compressed, pos) = self.length(pos)
+      (size, pos) = self.length(pos)
+      return (lzf_decompress(self.data[pos:pos + compressed], size),
+          pos + compressed)
+    raise RDBError('bad string encoding at offset %d' % pos)
+
+  def skip_string(self, pos):
+    return self.span(pos)[2]
+
+  # the pass over the file
+
+  def load(self):
+    data = self.data
+    if data[:5] != 'REDIS' or not data[5:9].isdigit():
+      raise RDBError('%s is not an RDB file' % self.path)
+    version = int(data[5:9])
+    if version > VERSION:
+      raise RDBError('RDB version %d is newer than we know' % version)
+    pos = 9
+    db = 0
+    expires = None
+    while True:
+      opcode = ord(data[pos])
+      pos += 1
+      if opcode == EOF:
+        break
+      elif opcode == SELECTDB:
+        (db, pos) = self.length(pos)
+      elif opcode == RESIZEDB:
+        pos = self.length(self.length(pos)[1])[1]
+      elif opcode == AUX:
+        (name, pos) = self.string(pos)
+        (value, pos) = self.string(pos)
+        self.aux[name] = value
+      elif opcode == EXPIRETIME_MS:
+        expires = unpack_from('<Q', data, pos)[0]
+        pos += 8
+      elif opcode == EXPIRETIME:
+        expires = unpack_from('<I', data, pos)[0] * 1000
+        pos += 4
+      elif opcode == FREQ:
+        pos += 1
+      elif opcode == IDLE:
+        pos = self.length(pos)[1]
+      elif opcode == MODULE_AUX:
+        for i in xrange(3):   # module id, when_opcode, when
+          pos = self.length(pos)[1]
+        pos = self.skip_module(pos)
+      elif opcode == FUNCTION:
+        pos = self.skip_string(pos)
+      elif opcode == SLOT_INFO:
+        for i in xrange(3):   # slot, keys, keys with expiry
+          pos = self.length(pos)[1]
+      elif opcode in TYPES:
+        (key, pos) = self.string(pos)
+        start = pos
+        pos = self.skip_value(opcode, pos)
+        if db == self.db and not self.expired(expires):
+          self.keys[key] = (start << TYPE_BITS) | opcode
+        expires = None
+      else:
+        raise RDBError('unknown opcode or type %d at offset %d' %
+            (opcode, pos - 1))
+
+  def expired(self, expires):
+    """Keys which had expired when the snapshot was taken are left out, as
+       the server would have done."""
+    taken = self.aux.get('ctime')
+    return expires is not None and taken is not None and \
+        expires <= int(taken) * 1000
+
+  def skip_value(self, type, pos):
+    if type in (STRING, HASH_ZIPMAP, LIST_ZIPLIST, SET_INTSET, ZSET_ZIPLIST,
+        HASH_ZIPLIST, HASH_LISTPACK, ZSET_LISTPACK, SET_LISTPACK):
+      return self.skip_string(pos)
+    (count, pos) = self.length(pos)
+    if type in (LIST, SET, LIST_QUICKLIST):
+      for i in xrange(count):
+        pos = self.skip_string(pos)
+    elif type == HASH:
+      for i in xrange(count * 2):
+        pos = self.skip_string(pos)
+    elif type == ZSET:
+      for i in xrange(count):
+        pos = self.skip_string(pos)
+        size = ord(self.data[pos])
+        pos += 1 + (size if size < 253 else 0)   # 253+ are nan and infs
+    elif type == ZSET_2:
+      for i in xrange(count):
+        pos = self.skip_string(pos) + 8
+    elif type == LIST_QUICKLIST_2:
+      for i in xrange(count):
+        pos = self.skip_string(self.length(pos)[1])
+    elif type == MODULE_2:
+      pos = self.skip_module(pos)
+    else:
+      pos = self.skip_stream(type, count, pos)
+    return pos
+
+  def skip_module(self, pos):
+    """Step over a module value saved with opcodes, up to its EOF."""
+    while True:
+      (opcode, pos) = self.length(pos)
+      if opcode == 0:
+        return pos
+      elif opcode in (1, 2):   # signed, unsigned int
+        pos = self.length(pos)[1]
+      elif opcode == 3:        # float
+        pos += 4
+      elif opcode == 4:        # double
+        pos += 8
+      elif opcode == 5:
+        pos = self.skip_string(pos)
+      else:
+        raise RDBError('bad module opcode %d at offset %d' % (opcode, pos))
+
+  def skip_stream(self, type, listpacks, pos):
+    lens = self.lens
+    for i in xrange(listpacks * 2):   # master id, listpack
+      pos = self.skip_string(pos)
+    pos = lens(pos, 3)   # length, last id
+    if type != STREAM_LISTPACKS:
+      pos = lens(pos, 5)   # first id, max deleted id, entries added
+    (groups, pos) = self.length(pos)
+    for i in xrange(groups):
+      pos = self.skip_string(pos)
+      pos = lens(pos, 2 if type == STREAM_LISTPACKS else 3)
+      (pending, pos) = self.length(pos)
+      for j in xrange(pending):
+        pos = lens(pos + 16 + 8, 1)   # id, delivery time, deliveries
+      (consumers, pos) = self.length(pos)
+      for j in xrange(consumers):
+        pos = self.skip_string(pos) + 8   # name, seen time
+        if type == STREAM_LISTPACKS_3:
+          pos += 8   # active time
+        (pending, pos) = self.length(pos)
+        pos += 16 * pending
+    return pos
+
+  def lens(self, pos, count):
+    for i in xrange(count):
+      pos = self.length(pos)[1]
+    return pos
+
+  # values
+
+  def entry(self, key):
+    """(type, pos) of key's value, or (None, None)."""
+    packed = self.keys.get(key)
+    if packed is None:
+      return (None, None)
+    return (packed & ((1 << TYPE_BITS) - 1), packed >> TYPE_BITS)
+
+  def type(self, key):
+    return TYPES.get(self.entry(key)[0], 'none')
+
+  def value(self, type, pos):
+    """Decode the value at pos: a str, a list, a set, a dict (hashes) or
+       a list of (member, score) pairs in score order (zsets)."""
+    if type == STRING:
+      return self.string(pos)[0]
+    if type in (HASH_ZIPMAP, LIST_ZIPLIST, SET_INTSET, ZSET_ZIPLIST,
+        HASH_ZIPLIST, HASH_LISTPACK, ZSET_LISTPACK, SET_LISTPACK):
+      blob = self.string(pos)[0]
+      if type == HASH_ZIPMAP:
+        return zipmap(blob)
+      if type == SET_INTSET:
+        return set(intset(blob))
+      items = list(ziplist(blob) if type in (LIST_ZIPLIST, ZSET_ZIPLIST,
+          HASH_ZIPLIST) else listpack(blob))
+      if type in (HASH_ZIPLIST, HASH_LISTPACK):
+        return dict(zip(items[0::2], items[1::2]))
+      if type in (ZSET_ZIPLIST, ZSET_LISTPACK):
+        return zip(items[0::2], [float(score) for score in items[1::2]])
+      if type == SET_LISTPACK:
+        return set(items)
+      return items
+    (count, pos) = self.length(pos)
+    items = []
+    for i in xrange(count):
+      if type == LIST_QUICKLIST:
+        (blob, pos) = self.string(pos)
+        items.extend(ziplist(blob))
+      elif type == LIST_QUICKLIST_2:
+        (container, pos) = self.length(pos)
+        (blob, pos) = self.string(pos)
+        if container == 1:   # a single big element stored plain
+          items.append(blob)
+        else:
+          items.extend(listpack(blob))
+      elif type in (ZSET, ZSET_2):
+        (member, pos) = self.string(pos)
+        if type == ZSET_2:
+          score = unpack_from('<d', self.data, pos)[0]
+          pos += 8
+        else:
+          size = ord(self.data[pos])
+          score = {253: float('nan'), 254: float('inf'),
+              255: float('-inf')}.get(size)
+          if score is None:
+            score = float(self.data[pos + 1:pos + 1 + size])
+            pos += size
+          pos += 1
+        items.append((member, score))
+      elif type == HASH:
+        (field, pos) = self.string(pos)
+        (value, pos) = self.string(pos)
+        items.append((field, value))
+      elif type in (LIST, SET):
+        (member, pos) = self.string(pos)
+        items.append(member)
+      else:
+        raise RDBError('%s values are not readable' % TYPES[type])
+    if type == HASH:
+      return dict(items)
+    if type == SET:
+      return set(items)
+    if type in (ZSET, ZSET_2):
+      items.sort(key=lambda (member, score): (score, member))
+    return items
+
+
+def ziplist(blob):
+  pos = 10   # total bytes, tail offset, count
+  while ord(blob[pos]) != 0xff:
+    pos += 5 if ord(blob[pos]) == 0xfe else 1   # previous entry's length
+    first = ord(blob[pos])
+    kind = first >> 6
+    if kind == 0:
+      (size, pos) = (first & 0x3f, pos + 1)
+    elif kind == 1:
+      (size, pos) = (((first & 0x3f) << 8) | ord(blob[pos + 1]), pos + 2)
+    elif kind == 2:
+      (size, pos) = (unpack_from('>I', blob, pos + 1)[0], pos + 5)
+    else:
+      if first == 0xc0:
+        (value, pos) = (unpack_from('<h', blob, pos + 1)[0], pos + 3)
+      elif first == 0xd0:
+        (value, pos) = (unpack_from('<i', blob, pos + 1)[0], pos + 5)
+      elif first == 0xe0:
+        (value, pos) = (unpack_from('<q', blob, pos + 1)[0], pos + 9)
+      elif first == 0xf0:
+        value = unpack_from('<i', '\0' + blob[pos + 1:pos + 4])[0] >> 8
+        pos += 4
+      elif first == 0xfe:
+        (value, pos) = (unpack_from('<b', blob, pos + 1)[0], pos + 2)
+      else:   # 0 to 12 in the encoding itself
+        (value, pos) = ((first & 0x0f) - 1, pos + 1)
+      yield str(value)
+      continue
+    yield blob[pos:pos + size]
+    pos += size
+
+
+def listpack(blob):
+  pos = 6   # total bytes, count
+  while ord(blob[pos]) != 0xff:
+    first = ord(blob[pos])
+    start = pos
+    value = None
+    if first < 0x80:
+      (value, pos) = (first, pos + 1)
+    elif first < 0xc0:
+      size = first & 0x3f
+      (value, pos) = (blob[pos + 1:pos + 1 + size], pos + 1 + size)
+    elif first < 0xe0:
+      value = ((first & 0x1f) << 8) | ord(blob[pos + 1])
+      if value >= 1 << 12:
+        value -= 1 << 13
+      pos += 2
+    elif first < 0xf0:
+      size = ((first & 0x0f) << 8) | ord(blob[pos + 1])
+      (value, pos) = (blob[pos + 2:pos + 2 + size], pos + 2 + size)
+    elif first == 0xf0:
+      size = unpack_from('<I', blob, pos + 1)[0]
+      (value, pos) = (blob[pos + 5:pos + 5 + size], pos + 5 + size)
+    elif first == 0xf1:
+      (value, pos) = (unpack_from('<h', blob, pos + 1)[0], pos + 3)
+    elif first == 0xf2:
+      value = unpack_from('<i', '\0' + blob[pos + 1:pos + 4])[0] >> 8
+      pos += 4
+    elif first == 0xf3:
+      (value, pos) = (unpack_from('<i', blob, pos + 1)[0], pos + 5)
+    elif first == 0xf4:
+      (value, pos) = (unpack_from('<q', blob, pos + 1)[0], pos + 9)
+    else:
+      raise RDBError('bad listpack encoding %#x' % first)
+    # each entry ends with its own length, for walking backwards
+    size = pos - start
+    pos += 1 if size < 1 << 7 else 2 if size < 1 << 14 else \
+        3 if size < 1 << 21 else 4 if size < 1 << 28 else 5
+    yield value if isinstance(value, str) else str(value)
+
+
+def intset(blob):
+  (width, count) = unpack_from('<II', blob)
+  format = {2: 'h', 4: 'i', 8: 'q'}[width]
+  return [str(value) for value in unpack_from('<%d%s' % (count, format),
+      blob, 8)]
+
+
+def zipmap(blob):
+  pos = 1   # count
+  fields = {}
+  while ord(blob[pos]) != 0xff:
+    (size, pos) = zipmap_length(blob, pos)
+    field = blob[pos:pos + size]
+    (size, pos) = zipmap_length(blob, pos + size)
+    free = ord(blob[pos])
+    fields[field] = blob[pos + 1:pos + 1 + size]
+    pos += 1 + size + free
+  return fields
+
+
+def zipmap_length(blob, pos):
+  first = ord(blob[pos])
+  if first < 254:
+    return (first, pos + 1)
+  return (unpack_from('<I', blob, pos + 1)[0], pos + 5)
+
+
+def window(length, start, end):
+  """Python slice bounds for redis' inclusive, possibly negative, start
+     and end."""
+  if start < 0:
+    start = max(length + start, 0)
+  if end < 0:
+    end += length
+  end = min(end, length - 1)
+  if start > end:
+    return (0, 0)
+  return (start, end + 1)
+
+
+class SnapshotClient(object):
+  """Looks enough like a redis-py client for the filesystem to read a
+     Snapshot through it.  Writes fail with READONLY errors."""
+
+  def __init__(self, snapshot):
+    self.snapshot = snapshot
+    self.decoded = {}   # pos -> collection decoded from there
+    self.lock = Lock()
+    # the scripts the filesystem runs, done natively
+    self.scripts = {sha1(scripts.HGETRANGE).hexdigest(): self._hgetrange,
+        sha1(scripts.CHUNKGETRANGE).hexdigest(): self._chunkgetrange}
+
+  def lookup(self, key, *types):
+    """(type, pos) of key, which must be one of types (names).  (None,
+       None) if there's no such key."""
+    (type, pos) = self.snapshot.entry(key)
+    if type is not None and TYPES[type] not in types:
+      raise ResponseError(WRONGTYPE)
+    return (type, pos)
+
+  def collection(self, key, kind):
+    (type, pos) = self.lookup(key, kind)
+    if type is None:
+      return None
+    value = self.decoded.get(pos)
+    if value is None:
+      value = self.snapshot.value(type, pos)
+      with self.lock:
+        if len(self.decoded) >= DECODED:
+          self.decoded.clear()
+        self.decoded[pos] = value
+    return value
+
+  def type(self, key):
+    return self.snapshot.type(key)
+
+  def scan(self, cursor=0, match=None, count=None):
+    names = self.snapshot.names
+    cursor = int(cursor)
+    count = count or 10
+    if match:
+      # most patterns are a namespace: jump to it, stop after it
+      prefix = literal_prefix(match)
+      cursor = max(cursor, bisect_left(names, prefix))
+      pattern = glob(match)
+    batch = names[cursor:cursor + count]
+    cursor += count
+    if match:
+      if batch and not batch[-1].startswith(prefix):
+        cursor = len(names)
+      batch = [name for name in batch if pattern.match(name)]
+    return (0 if cursor >= len(names) else cursor, batch)
+
+  def pttl(self, key):
+    # nothing expires in a snapshot; keys gone by the time it was taken
+    # aren't in it
+    return -1 if self.snapshot.type(key) != 'none' else -2
+
+  def get(self, key):
+    (type, pos) = self.lookup(key, 'string')
+    return None if type is None else self.snapshot.string(pos)[0]
+
+  def strlen(self, key):
+    (type, pos) = self.lookup(key, 'string')
+    if type is None:
+      return 0
+    (start, end, after) = self.snapshot.span(pos)
+    return end if start is None else end - start
+
+  def getrange(self, key, start, end):
+    (type, pos) = self.lookup(key, 'string')
+    if type is None:
+      return ''
+    (first, last, after) = self.snapshot.span(pos)
+    if first is None:
+      value = self.snapshot.string(pos)[0]
+      return value[slice(*window(len(value), start, end))]
+    # stored as is: straight out of the mapping
+    (start, end) = window(last - first, start, end)
+    return self.snapshot.data[first + start:first + end]
+
+  def hget(self, key, field):
+    return (self.collection(key, 'hash') or {}).get(field)
+
+  def hexists(self, key, field):
+    return field in (self.collection(key, 'hash') or {})
+
+  def hgetall(self, key):
+    return dict(self.collection(key, 'hash') or {})
+
+  def hkeys(self, key):
+    return (self.collection(key, 'hash') or {}).keys()
+
+  def hlen(self, key):
+    return len(self.collection(key, 'hash') or {})
+
+  def hstrlen(self, key, field):
+    return len(self.hget(key, field) or '')
+
+  def llen(self, key):
+    return len(self.collection(key, 'list') or [])
+
+  def lrange(self, key, start, end):
+    items = self.collection(key, 'list') or []
+    return items[slice(*window(len(items), start, end))]
+
+  def scard(self, key):
+    return len(self.collection(key, 'set') or ())
+
+  def smembers(self, key):
+    return set(self.collection(key, 'set') or ())
+
+  def zcard(self, key):
+    return len(self.collection(key, 'zset') or [])
+
+  def zrange(self, key, start, end, desc=False, withscores=False):
+    items = self.collection(key, 'zset') or []
+    if desc:
+      items = items[::-1]
+    items = items[slice(*window(len(items), start, end))]
+    return items if withscores else [member for (member, score) in items]
+
+  def _hgetrange(self, keys, args):
+    value = self.hget(keys[0], args[0]) or ''
+    return value[slice(*window(len(value), int(args[1]), int(args[2])))]
+
+  def _chunkgetrange(self, keys, args):
+    fields = self.collection(keys[0], 'hash') or {}
+    layout = chunks.parse(fields.get(chunks.MANIFEST))
+    if layout is None:
+      return ''
+    (length, size) = layout
+    (start, end) = window(length, int(args[0]), int(args[1]))
+    parts = []
+    for index in xrange(start // size, (end - 1) // size + 1):
+      chunk = fields.get(str(index), '')
+      parts.append(chunk + '\0' * (size - len(chunk)))
+    offset = start // size * size
+    return ''.join(parts)[start - offset:end - offset]
+
+  def evalsha(self, sha, numkeys, *args):
+    script = self.scripts.get(sha)
+    if script is None:
+      raise ResponseError('NOSCRIPT snapshots only run the scripts '
+          'redisfuse reads with')
+    return script(args[:numkeys], args[numkeys:])
+
+  def script_load(self, source):
+    return sha1(source).hexdigest()
+
+  def register_script(self, source):
+    return SnapshotScript(self, source)
+
+  def config_get(self, pattern='*'):
+    return {}
+
+  def execute_command(self, *args):
+    raise ResponseError("ERR %s isn't available on a snapshot" % args[0])
+
+  def readonly(self, *args, **kwargs):
+    raise ResponseError("READONLY You can't write against a snapshot.")
+
+  set = setrange = append = delete = rename = hset = hdel = readonly
+
+  def pipeline(self, transaction=True):
+    return SnapshotPipeline(self)
+
+
+class SnapshotScript(object):
+  """What register_script returns (see redis.client.Script)."""
+
+  def __init__(self, client, source):
+    self.client = client
+    self.sha = sha1(source).hexdigest()
+
+  def __call__(self, keys=[], args=[], client=None):
+    return (client or self.client).evalsha(self.sha, len(keys),
+        *(tuple(keys) + tuple(args)))
+
+
+class SnapshotPipeline(object):
+  """Queues calls and answers them all in execute(), like a pipeline."""
+
+  def __init__(self, client):
+    self.client = client
+    self.queued = []
+
+  def __getattr__(self, name):
+    method = getattr(self.client, name)
+    def queue(*args, **kwargs):
+      self.queued.append((method, args, kwargs))
+      return self
+    return queue
+
+  def execute(self, raise_on_error=True):
+    (queued, self.queued) = (self.queued, [])
+    replies = []
+    for (method, args, kwargs) in queued:
+      try:
+        replies.append(method(*args, **kwargs))
+      except ResponseError, e:
+        replies.append(e)
+    if raise_on_error:
+      for reply in replies:
+        if isinstance(reply, ResponseError):
+          raise reply
+    return replies
+
+
+def literal_prefix(pattern):
+  """The start of a SCAN MATCH pattern every matching key begins with."""
+  prefix = []
+  i = 0
+  while i < len(pattern) and pattern[i] not in '*?[':
+    if pattern[i] == '\\' and i + 1 < len(pattern):
+      i += 1
+    prefix.append(pattern[i])
+    i += 1
+  return ''.join(prefix)
+
@@ -0,0 +1,172 @@
+"""Sharing fetches and reading ahead.
+
+Flights: when several threads want the same bytes at once (processes
+reading one file, or the kernel reading ahead on several threads), only
+the first fetches them and the others wait for its result.  A fetch
+that started before its key changed isn't joined by anyone reading
+after the change (see forget).
+
+ReadAhead: a file handle read sequentially gets the windows after the
+one asked for fetched in the background, so by the time the reader gets
+there its bytes are on their way or already here.  Every read continuing
+where the last one stopped doubles the window, up to max_window; any
+other read drops what was fetched and starts again from min_window.
+Streaming a big value then keeps a few large GETRANGEs on the wire at
+all times instead of one small one per round trip.
+"""
+
+from Queue import Queue
+from threading import Event, Lock, Thread
+
+# bytes read ahead once a handle turns out to be read sequentially, and
+# most it grows to
+READAHEAD_MIN = 128 * 1024
+READAHEAD_MAX = 4 * 1024 * 1024
+
+# threads fetching windows in the background
+PREFETCH_THREADS = 4
+
+
+class Flight(object):
+  """A fetch on its way and, once it's landed, its result."""
+
+  __slots__ = ('value', 'error', 'landed')
+
+  def __init__(self):
+    self.value = None
+    self.error = None
+    self.landed = Event()
+
+  def run(self, fetch):
+    try:
+      self.value = fetch()
+    except Exception, e:
+      self.error = e
+    self.landed.set()
+
+  def result(self):
+    self.landed.wait()
+    if self.error is not None:
+      raise self.error
+    return self.value
+
+
+class Flights(object):
+  def __init__(self):
+    self.flights = {}   # (key, ...) -> Flight
+    self.lock = Lock()
+
+  def fetch(self, id, fetch):
+    """fetch()'s result, shared with everyone asking for id meanwhile.
+       id starts with the redis key."""
+    with self.lock:
+      flight = self.flights.get(id)
+      leader = flight is None
+      if leader:
+        flight = self.flights[id] = Flight()
+    if leader:
+      flight.run(fetch)
+      with self.lock:
+        if self.flights.get(id) is flight:
+          del self.flights[id]
+    return flight.result()
+
+  def forget(self, key):
+    """Fetches of key from now on start afresh."""
+    with self.lock:
+      for id in [id for id in self.flights if id[0] == key]:
+        del self.flights[id]
+
+
+class Prefetcher(object):
+  """Runs fetches on a few background threads, charging their round
+     trips in stats to the operation that asked for them."""
+
+  def __init__(self, stats=None, threads=PREFETCH_THREADS):
+    self.stats = stats
+    self.queue = Queue()
+    for i in xrange(threads):
+      thread = Thread(target=self.work)
+      thread.daemon = True
+      thread.start()
+
+  def submit(self, fetch):
+    """A Flight for fetch()."""
+    flight = Flight()
+    op = getattr(self.stats.current, 'op', None) if self.stats else None
+    self.queue.put((flight, fetch, op))
+    return flight
+
+  def work(self):
+    while True:
+      (flight, fetch, op) = self.queue.get()
+      if self.stats:
+        self.stats.current.op = op
+      flight.run(fetch)
+
+
+class ReadAhead(object):
+  """Windows fetched ahead of one file handle's reads.
+
+     fetch(start, end) returns the bytes from start up to (not including)
+     end, fewer at the end of the value."""
+
+  def __init__(self, key, fetch, prefetcher, min_window=READAHEAD_MIN,
+               max_window=READAHEAD_MAX):
+    self.key = key
+    self.fetch = fetch
+    self.prefetcher = prefetcher
+    self.min_window = min_window
+    self.max_window = max_window
+    self.window = min_window
+    self.next = 0        # where a sequential read would start
+    self.segments = []   # [(start, end, Flight)], back to back
+    # the kernel may read through one handle from several threads
+    self.lock = Lock()
+
+  def read(self, offset, size, length):
+    """size bytes at offset of a value length bytes long, or None if the
+       read isn't sequential and should just be fetched."""
+    if offset >= length:
+      return None
+    end = min(offset + size, length)
+    with self.lock:
+      sequential = offset == self.next
+      self.next = end
+      while self.segments and self.segments[0][1] <= offset:
+        self.segments.pop(0)
+      covered = self.segments and self.segments[0][0] <= offset
+      if not covered:
+        self.segments = []
+        if not sequential:
+          self.window = self.min_window
+          return None
+      elif end <= self.segments[-1][1]:
+        self.window = min(2 * self.window, self.max_window)
+      # the part not asked for yet is fetched right here, the windows
+      # after it in the background
+      demand = None
+      start = self.segments[-1][1] if self.segments else offset
+      if start < end:
+        demand = (start, Flight())
+        self.segments.append((start, end, demand[1]))
+      while self.segments[-1][1] < min(end + self.window, length):
+        start = self.segments[-1][1]
+        self.issue(start, min(start + self.window, length))
+      wanted = [(start, flight) for (start, stop, flight) in self.segments
+          if start < end and stop > offset]
+    if demand is not None:
+      (start, flight) = demand
+      flight.run(lambda: self.fetch(start, end))
+    data = ''.join(str(flight.result()) for (start, flight) in wanted)
+    return data[offset - wanted[0][0]:end - wanted[0][0]]
+
+  def issue(self, start, end):
+    fetch = self.fetch
+    self.segments.append((start, end, self.prefetcher.submit(
+        lambda: fetch(start, end))))
+
+  def drop(self):
+    """Forget what was fetched, the value changed."""
+    with self.lock:
+      self.segments = []
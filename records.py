@@ -0,0 +1,74 @@
+"""Per-file metadata.
+
+A mount can list millions of keys, so every entry's attributes live in a
+small slotted Record instead of the stat dict fuse wants; getattr builds
+that dict with stat() only when the kernel asks for it.  Type names are
+interned and timestamps are kept to the second with one float object per
+second, so neither costs a separate object per file.
+"""
+
+from stat import S_IFDIR, S_IFREG
+from time import time
+
+FILE_MODE = S_IFREG | 0755
+DIR_MODE = S_IFDIR | 0755
+
+_clock = [0.0]
+
+def now():
+  """The current time to the second.  Every caller within the same second
+     gets the same float object."""
+  t = float(int(time()))
+  if t != _clock[0]:
+    _clock[0] = t
+  return _clock[0]
+
+
+class Record(object):
+  """Attributes of one file.
+
+     type is the redis type behind the file (None for directories and
+     symlinks), stamp the version stamp of a formatted collection (see
+     Redis.measure).  A size of None means not measured yet."""
+
+  __slots__ = ('mode', 'size', '_type', 'atime', 'mtime', 'ctime', 'stamp',
+               'owner', 'xattrs')
+
+  nlink = 1
+
+  def __init__(self, mode=FILE_MODE, size=0, type=None, stamp=None):
+    self.mode = mode
+    self.size = size
+    self.type = type
+    self.atime = self.mtime = self.ctime = now()
+    self.stamp = stamp
+    self.owner = None    # (uid, gid) once chown'd
+    self.xattrs = None   # dict once an extended attribute is set
+
+  @property
+  def type(self):
+    return self._type
+
+  @type.setter
+  def type(self, type):
+    # one string object per type, not one per reply
+    self._type = intern(type) if type else None
+
+  def touch(self):
+    self.mtime = self.ctime = now()
+
+  def stat(self):
+    """The stat dict fuse expects from getattr."""
+    st = dict(st_mode=self.mode, st_nlink=self.nlink, st_size=self.size,
+        st_atime=self.atime, st_mtime=self.mtime, st_ctime=self.ctime)
+    if self.owner:
+      (st['st_uid'], st['st_gid']) = self.owner
+    return st
+
+
+class DirRecord(Record):
+  __slots__ = ('nlink',)
+
+  def __init__(self, mode=DIR_MODE):
+    Record.__init__(self, mode)
+    self.nlink = 2
@@ -1,63 +1,270 @@
 #!/usr/bin/env python
 
-from collections import defaultdict
-from errno import ENOENT, EACCES, EEXIST
+from contextlib import contextmanager
+from itertools import count
+from errno import ENOENT, ENOTDIR, EACCES, EEXIST, EROFS
+from os import O_RDWR, O_WRONLY
 from stat import S_IFDIR, S_IFLNK, S_IFREG
-from sys import argv, exit
-from time import time
-from pprint import pprint, pformat
+from sys import exit
+from optparse import OptionParser
+from time import sleep, time
+from pprint import pformat
+from threading import Lock, RLock, Thread
 import re
 import redis
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+from fuse import FUSE, FuseOSError, Operations
+from log import log, LogOps, setup as setup_logging, toggle_debug
+from writeback import WriteBuffer
+from cache import ContentCache, CACHE_SIZE
+from index import PathIndex, split_path
+from records import Record, DirRecord, now
+from paths import PathParser, key_stem
+from stats import Stats, TimeOps
+from scripts import Scripts
+import chunks
+from rdb import RDBError, Snapshot, SnapshotClient
+from cluster import Cluster, Unavailable, merged
+from replicas import Replicas, REPLICA_LAG, ROUTINGS
+from coalesce import Coalesced, BATCH, coalesced
+from readahead import Flights, Prefetcher, ReadAhead, READAHEAD_MIN, \
+    READAHEAD_MAX
 
+# bytes a file handle may buffer before it is pushed to redis early
+MAX_DIRTY = 4 * 1024 * 1024
 
-def layer(path, level):
-  if level == 0 and path == "/":
-    return "/"
-  split = path.split(".")
-  # /".here.we.are", 0 == ".here"
-  #                  1 == "we.are"
-  matched_slash_dot = re.match(r'.*/\..*', path)
-  if matched_slash_dot and level == 0:
-    return split[0] + "." + split[1]
-  elif matched_slash_dot and level == 1:
-    return ".".join(split[2:])
+# keys asked for per SCAN call (and resolved per pipeline) while populating
+SCAN_COUNT = 1000
+
+# redis connections for fuse worker threads, plus a few for our own
+# background threads (keyspace watcher, client side caching)
+THREADS = 16
+BACKGROUND_CONNECTIONS = 4
+
+# locks shared out between directories, see Stripes
+LOCK_STRIPES = 64
+
+# seconds between keyspace sweeps when the server won't notify us of changes
+POLL_INTERVAL = 60
+
+# seconds between attempts to subscribe to keyspace events again after
+# losing the subscription
+RESUBSCRIBE_DELAY = 1
+
+# collections shown as formatted files and how to count their members.
+# The count (plus a digest where the server allows DEBUG) is the version
+# stamp telling us whether a formatted size we worked out is still good.
+CARDINALITY = {'hash': 'hlen', 'list': 'llen', 'set': 'scard', 'zset': 'zcard'}
+
+# file types read a range at a time instead of whole
+RANGED = ('string', 'hash_field', 'chunked')
+
+# bytes of small files fetched into the content cache per directory at
+# most, see warm_contents
+WARM_MAX = 4 * 1024 * 1024
+
+# virtual files showing what Stats has counted, writing either resets it
+STATS_FILES = ('/.stats', '/.stats.json')
+
+# operations a read-only mount refuses (and open for writing)
+WRITES = frozenset(['chmod', 'chown', 'create', 'link', 'mkdir',
+    'removexattr', 'rename', 'rmdir', 'setxattr', 'symlink', 'truncate',
+    'unlink', 'utimens', 'write'])
+
+# notify-keyspace-events classes following changes needs: generic,
+# string, hash, list, set and zset commands, expiries and evictions
+EVENT_CLASSES = 'g$hlszxe'
+
+# keyspace events after which the key no longer exists under its name
+GONE_EVENTS = ('del', 'expired', 'evicted', 'rename_from')
+
+def glob_escape(pattern):
+  """Escape pattern so SCAN MATCH treats it literally."""
+  return re.sub(r'([*?\[\]\\])', r'\\\1', pattern)
+
+def formatted(value):
+  """The file contents for a value fetched from redis."""
+  if isinstance(value, str):
+    return value
   else:
-    if level == 0 and len(split) > level:
-      return split[level]
-    elif len(split) > level:
-      return ".".join(split[level:])
-    else:
-      return False
+    # hgetall, sets, lists, and zsets aren't returnable unless formatted
+    # also, let's be nice and throw in a newline so we can `cat` nicely
+    return pformat(value) + "\n"
+
+def blank_index():
+  return PathIndex(stem=key_stem)
+
+class Stripes(object):
+  """A fixed set of locks shared out between directories by hashing their
+     paths, so operations on different directories rarely wait on each
+     other without keeping a lock per directory.
+
+     Take every lock an operation needs in one call: locks are acquired in
+     a fixed order, which only prevents deadlocks if nobody holding one
+     stripe goes back for another."""
 
-def path_key(path):
-  """One layer in"""
-  return layer(path, 0)
+  def __init__(self, count=LOCK_STRIPES):
+    self.locks = [RLock() for i in xrange(count)]
 
-def path_field(path):
-  """Two layers in"""
-  return layer(path, 1)
+  @contextmanager
+  def __call__(self, *dirs):
+    stripes = sorted(set(hash(dir) % len(self.locks) for dir in dirs))
+    for stripe in stripes:
+      self.locks[stripe].acquire()
+    try:
+      yield
+    finally:
+      for stripe in reversed(stripes):
+        self.locks[stripe].release()
+
+class Connection(redis.Connection):
+  """A redis connection which, once the filesystem has set up client side
+     caching, asks redis to track the keys it reads and send invalidations
+     to tracking['redirect'].  Every command (or pipeline) sent counts as a
+     round trip in stats."""
+
+  def __init__(self, tracking=None, stats=None, **kwargs):
+    redis.Connection.__init__(self, **kwargs)
+    self.tracking = tracking if tracking is not None else {}
+    self.stats = stats
 
-def blank_files_and_dirs():
-  files = {}
-  dirs = defaultdict(list)
-  now = time()
-  dirs['/'].extend([".", ".."])
-  files['/'] = dict(st_mode=(S_IFDIR | 0755), st_ctime=now,
-      st_mtime=now, st_atime=now, st_nlink=2)
-  return (files, dirs)
+  def send_packed_command(self, *args, **kwargs):
+    if self.stats:
+      self.stats.round_trip()
+    redis.Connection.send_packed_command(self, *args, **kwargs)
 
-class Redis(LoggingMixIn, Operations):
+  def on_connect(self):
+    redis.Connection.on_connect(self)
+    redirect = self.tracking.get('redirect')
+    if redirect:
+      self.send_command('CLIENT', 'TRACKING', 'ON', 'REDIRECT', redirect)
+      self.read_response()
+
+class Redis(LogOps, TimeOps, Operations):
   """Redis-as-FS"""
 
-  def __init__(self, host, port):
-    self.redis = redis.Redis(host=host, port=port)
-    (self.files, self.dirs) = blank_files_and_dirs();
-    self.fd = 0
+  def __init__(self, host, port, max_dirty=MAX_DIRTY, scan_count=SCAN_COUNT,
+               lazy=False, watch=True, poll_interval=POLL_INTERVAL,
+               cache_size=CACHE_SIZE, threads=THREADS, client=None,
+               readonly=False, cluster=False, replicas=(),
+               routing=ROUTINGS[0], replica_lag=REPLICA_LAG, coalesce=None,
+               coalesce_batch=BATCH, readahead=READAHEAD_MAX,
+               attr_timeout=None, warm_size=None, warm_max=WARM_MAX,
+               chunk_size=None):
+    self.tracking = {}
+    self.stats = Stats()
+    # seconds to gather commands from concurrent ops into one pipeline
+    # (see coalesce.py), None to give every thread its own connection
+    self.coalesce = coalesce
+    self.coalesce_batch = coalesce_batch
+    self.coalescers = []
+    self.reports = {}   # what getattr last showed for each of STATS_FILES
+    if client is None and cluster:
+      # host:port is any node, the rest are found through it
+      client = Cluster(host, port, stats=self.stats,
+          max_connections=threads + BACKGROUND_CONNECTIONS)
+    elif client is None:
+      client = self.connect(host, port, threads)
+    # anything with the redis-py client API, say an rdb.SnapshotClient
+    self.redis = client
+    self.cluster = cluster
+    # (host, port) of each replica to read from instead, see replicas.py
+    self.replicas = Replicas(self.redis,
+        [self.connect(h, p, threads) for (h, p) in replicas], routing,
+        replica_lag) if replicas else None
+    self.readonly = readonly
+    self.scripts = Scripts(self.redis)
+    self.index = blank_index()
+    self.paths = PathParser()
+    # Concurrency: fuse calls us from many threads at once.  Adding or
+    # removing a directory entry holds the lock for that directory (see
+    # Stripes); anything touching the network happens outside the locks.
+    # Lookups only read dicts, which is atomic, so they don't lock.
+    self.dir_lock = Stripes()
+    self.populating = Lock()
+    # A listing resolves keys first and indexes them after, so a file
+    # removed in between would come back.  While any are in flight each
+    # removal leaves a tombstone (path -> removal number) for index_key.
+    self.tombstone_lock = Lock()
+    self.resolving = 0
+    self.removals = 0
+    self.tombstones = {}
+    self.fds = count(1)
+    self.handles = {}   # fh -> WriteBuffer
+    self.max_dirty = max_dirty
+    self.scan_count = scan_count
+    # lazy: only list directories (key namespaces) when they're visited
+    self.lazy = lazy
+    self.loaded = set()   # directories listed from redis in lazy mode
+    # seconds a directory's attributes are trusted before listing it looks
+    # its files up again; None to rely on watching for changes
+    self.attr_timeout = attr_timeout
+    self.populated = time()   # when the whole keyspace was last listed
+    self.refreshed = {}       # directory -> when its files were last resolved
+    self.expiring = {}        # path -> when its key expires
+    # follow changes made by other clients after mounting
+    self.watch = watch
+    self.poll_interval = poll_interval
+    self.cache = ContentCache(cache_size) if cache_size else None
+    # concurrent reads of the same bytes share one fetch, and handles read
+    # sequentially fetch up to readahead bytes ahead (see readahead.py)
+    self.flights = Flights()
+    self.prefetcher = Prefetcher(self.stats) if readahead else None
+    self.readahead = readahead
+    self.readaheads = {}   # fh -> ReadAhead
+    # files up to warm_size bytes are fetched into the cache a directory
+    # at a time, up to warm_max bytes each (None: one by one as they're
+    # read)
+    self.warm_size = warm_size
+    self.warm_max = warm_max
+    self.warmed = set()   # directories whose small files were fetched
+    # files growing past chunk_size bytes are stored in chunks that size
+    # (see chunks.py), None to keep every file a single value
+    self.chunk_size = chunk_size
+    self.notified = False
+    self.digests = True   # until the server tells us DEBUG is off
     self.repr = False
     self.disallow_unlink_representations = True
     self.disallow_rename_representations = True
+
+  def connect(self, host, port, threads):
+    # one connection per fuse thread so their round trips overlap; a
+    # thread waits for a free connection instead of failing if we ever
+    # run out
+    pool = redis.BlockingConnectionPool(host=host, port=port,
+        connection_class=Connection, tracking=self.tracking,
+        stats=self.stats, timeout=None,
+        max_connections=threads + BACKGROUND_CONNECTIONS)
+    if self.coalesce is None:
+      return redis.Redis(connection_pool=pool)
+    client = Coalesced(pool, self.stats, self.coalesce, self.coalesce_batch)
+    self.coalescers.append(client.coalescer)
+    return client
+
+  def reader(self, *keys):
+    """The client to read keys from: a replica, if there are any and
+       none of keys changed too recently for it to have caught up."""
+    return self.replicas.client(keys) if self.replicas else self.redis
+
+  def __call__(self, op, *args):
+    # the stats files can still be reset
+    if self.readonly and op in WRITES and args[0] not in STATS_FILES:
+      raise FuseOSError(EROFS)
+    return super(Redis, self).__call__(op, *args)
+
+  def init(self, path):
+    self.scripts.load()
+    if self.replicas:
+      self.replicas.start()
+    # a server only sends invalidations for keys read from it, to a client
+    # of its own: no use when reads are spread over nodes or replicas
+    tracking = self.cache and not self.cluster and not self.replicas and \
+        self.start_tracking()
+    self.notified = self.watch and self.start_watching()
+    # cached contents are only safe if redis tells us when they change
+    if self.cache and not tracking and not self.notified:
+      log.warning("No keyspace notifications or CLIENT TRACKING, not caching")
+      self.cache = None
     
   def hashkey(self, filename, field, dir):
     if not field:
@@ -65,7 +272,7 @@ class Redis(LoggingMixIn, Operations):
     if dir == '/':
       dir = ''
     dirkey = dir + '/' + filename.replace('.' + field, '') # + "_representation"
-    print "hashkey:", dirkey
+    log.debug("hashkey: %s", dirkey)
     return dirkey
 
   def splitpath(self, path):
@@ -73,87 +280,101 @@ class Redis(LoggingMixIn, Operations):
 
         Returns (rediskey, hash-field-name, parent-directory, filename)
     """
-    splits = filter(None, path.split("/"))
-    dirent = splits[-1]
-    key = False
-    field = False
-    if path in self.files and 'r_type' in self.files[path] \
-        and self.files[path]["r_type"] == 'string':
-      key = ":".join(filter(None, path.split("/")))
+    (string_key, key, field, dir, dirent) = self.paths.parse(path)
+    st = self.index.get(path)
+    if st and st.type in ('string', 'chunked'):
+      key = string_key
       field = False
-    else:
-      key = ":".join(filter(None, path_key(path).split("/")))
-      field = path_field(path)
-    dir = "/" + "/".join(splits[:-1])
-    solution = (key, field, dir, dirent)
-    print solution
-    return solution
+    return (key, field, dir, dirent)
 
   def chmod(self, path, mode):
-    self.files[path]['st_mode'] &= 0770000
-    self.files[path]['st_mode'] |= mode
+    st = self.index[path]
+    st.mode = (st.mode & 0770000) | mode
     return 0
 
   def chown(self, path, uid, gid):
-    self.files[path]['st_uid'] = uid
-    self.files[path]['st_gid'] = gid
+    self.index[path].owner = (uid, gid)
   
   def create(self, path, mode):
     (key, field, dir, filename) = self.splitpath(path)
 
     dirkey = self.hashkey(filename, field, dir)
 
-    if path in self.files:
+    if path in self.index:
       raise FuseOSError(EEXIST)
 
+    hk = False
     # don't turn lock files into hashes
     if field == 'lock':
-      print "LOCK", filename
-      self.files[path] = self.mkfile(filename, 'string')
-      self.add_new_file(path)
+      log.debug("LOCK %s", filename)
+      st = self.mkfile(filename, 'string')
     # If the parent key is a string, we can't make this a hash.  re-string.
-    elif field and dirkey in self.files \
-        and self.files[dirkey]["r_type"] == 'string':
-      print "STRING HASH", filename
-      self.files[path] = self.mkfile(filename, 'string')
-      self.add_new_file(path)
+    elif field and dirkey in self.index \
+        and self.index[dirkey].type == 'string':
+      log.debug("STRING HASH %s", filename)
+      st = self.mkfile(filename, 'string')
     # else, we have hash
     elif field:
-      print "FIELD", key, field
-      self.files[path] = self.mkfile(key, 'hash_field', field)
-      self.add_new_file(path)
+      log.debug("FIELD %s %s", key, field)
+      st = self.mkfile(key, 'hash_field', field)
       # If this is the first field in a hash, make the hash object too:
       hk = self.hashkey(filename, field, dir)
-      if self.repr and hk not in self.files:
-        self.files[hk] = self.mkfile(key, 'hash')
-        self.add_new_file(hk)
     # else, else, we have string again.  :(
     else:
-      print "OTHER", key
-      self.files[path] = self.mkfile(key, 'string')
-      self.add_new_file(path)
-    self.fd += 1
-    return self.fd
+      log.debug("OTHER %s", key)
+      st = self.mkfile(key, 'string')
+
+    with self.dir_lock(dir):
+      # somebody else may have created it while we talked to redis
+      if path in self.index:
+        raise FuseOSError(EEXIST)
+      self.add_new_file(path, st)
+      if self.repr and hk and hk not in self.index:
+        self.add_new_file(hk, self.mkfile(key, 'hash'))
+    return self.new_handle(path)
   
   def getattr(self, path, fh=None):
+    if path in STATS_FILES:
+      # the size has to match what read returns, so keep what we measured
+      report = self.reports[path] = self.report(path)
+      return Record(S_IFREG | 0644, len(report)).stat()
+    if path == "/.debug":
+      toggle_debug()
     if path == "/.updater":
-      print "Updating Listings..."
-      self.populate_files()
+      log.info("Updating Listings...")
+      if self.lazy:
+        self.index = blank_index()
+        self.loaded.clear()
+        self.refreshed.clear()
+        self.expiring.clear()
+        self.warmed.clear()
+      else:
+        self.populate_files()
+
+    if path not in self.index and self.lazy:
+      self.lookup(path)
+    expires = self.expiring.get(path)
+    if expires and expires <= time():
+      # gone by now, unless someone pushed its expiry back
+      self.expiring.pop(path, None)
+      self.refresh_keys([self.splitpath(path)[0]])
 
-    if path not in self.files:
+    if path not in self.index:
       raise FuseOSError(ENOENT)
-    st = self.files[path]
-    return st
+    st = self.index[path]
+    if st.size is None:
+      self.measure(path, st)
+    return st.stat()
   
   def getxattr(self, path, name, position=0):
-    attrs = self.files[path].get('attrs', {})
+    attrs = self.index[path].xattrs or {}
     try:
       return attrs[name]
     except KeyError:
       return ''     # Should return ENOATTR
   
   def listxattr(self, path):
-    attrs = self.files[path].get('attrs', {})
+    attrs = self.index[path].xattrs or {}
     return attrs.keys()
  
   # directories are keyspaces:
@@ -164,122 +385,820 @@ class Redis(LoggingMixIn, Operations):
 
   # want: .git/objects/hashes/HASH ==> .git:objects:hashes:HASH => CONTENT
   # So, extract_dirs([.git, objects, hashes, HASH], [])
-  # dirs[/.git] = [., .., objects]
-  # dirs[/.git/objects] = [., .., hashes]
-  # dirs[/.git/objects/hashes] = [., ..]
+  # makes directories /.git, /.git/objects and /.git/objects/hashes
   def extract_dirs(self, unprocessed = [], path_so_far = ''):
     if len(unprocessed) < 2:
       return path_so_far or '/'
 
     path = path_so_far + '/' + unprocessed[0]
 
-    if not path in self.dirs:
-      self.mkdir(path, 0755)
+    if not self.index.is_dir(path):
+      self.ensure_dir(path)
 
     return self.extract_dirs(unprocessed[1:], path)
 
   def mkdir(self, path, mode):
     (key, field, parent_dir, filename) = self.splitpath(path)
-    if path in self.files:
-      raise FuseOSError(EEXIST)
+    with self.dir_lock(path, parent_dir):
+      if path in self.index:
+        raise FuseOSError(EEXIST)
+      # makes parent dirs too
+      try:
+        self.index.mkdir(path, DirRecord(S_IFDIR | mode))
+      except KeyError:
+        raise FuseOSError(ENOTDIR)   # a parent is a file
 
-    self.files[path] = dict(st_mode=(S_IFDIR | mode), st_nlink=2,
-        st_size=0, st_ctime=time(), st_mtime=time(), st_atime=time())
-    self.dirs[path].extend([".", ".."])
+  def open(self, path, flags):
+    if self.readonly and flags & (O_WRONLY | O_RDWR) and \
+       path not in STATS_FILES:
+      raise FuseOSError(EROFS)
+    return self.new_handle(path)
 
-    # make parent dir too
-    if not parent_dir in self.files:
-      self.files[parent_dir] = dict(st_mode=(S_IFDIR | mode), st_nlink=2,
-          st_size=0, st_ctime=time(), st_mtime=time(), st_atime=time())
-    else:
-      self.files[parent_dir]['st_nlink'] += 1
+  def new_handle(self, path):
+    fh = next(self.fds)
+    self.handles[fh] = WriteBuffer(path)
+    return fh
 
-    if not self.dirs[parent_dir]:
-      self.dirs[parent_dir].extend([".", ".."])
+  def flush(self, path, fh):
+    self.push_handle(path, fh)
+    return 0
 
-    self.dirs[parent_dir].append(filename)
+  def fsync(self, path, datasync, fh):
+    self.push_handle(path, fh)
+    return 0
 
-  def open(self, path, flags):
-    self.fd += 1
-    return self.fd
+  def release(self, path, fh):
+    self.push_handle(path, fh)
+    self.handles.pop(fh, None)
+    self.readaheads.pop(fh, None)
+    return 0
  
   def read(self, path, size, offset, fh):
+    if path in STATS_FILES:
+      report = self.reports.get(path) or self.report(path)
+      return report[offset:offset + size]
+    # make sure we read back anything still sitting in a write buffer
+    # (pushing it may move the file into chunks, and so to another key)
+    self.push_path(path)
     (key, field, dir, filename) = self.splitpath(path)
+    type = self.r_type(path, key, field)
+    if size <= 0:
+      return ''
+
+    # small files are read whole once and served from the cache after that
+    st = self.index.get(path)
+    if st and st.size is None:
+      self.measure(path, st)
+    if self.cache and st and st.size <= self.cache.max_entry:
+      if self.warm_size and dir not in self.warmed:
+        self.warm_contents(dir)
+      value = self.cache.get(key, field or None)
+      if value is None:
+        epoch = self.cache.epoch
+        value = self.flights.fetch((key, field or None),
+            lambda: self.contents(key, field, type))
+        self.cache.put(key, field or None, value, epoch)
+        st.size = len(value)
+      # a window onto the cached value, fuse.py copies it out just once
+      return buffer(value, offset, size)
+
+    # strings, hash fields and chunked files only fetch the window the
+    # kernel asked for, and what comes after it if the handle is being
+    # read sequentially
+    if type in RANGED:
+      readahead = st and self.read_ahead(fh, key, field, type)
+      data = readahead and readahead.read(offset, size, st.size)
+      if data is None:
+        data = self.fetch_range(key, field, type, offset, offset + size)
+      return data
+    # representations only exist client-side, so build them and slice
+    solution = self.flights.fetch((key, field or None),
+        lambda: self.representation(key, field, type))
+    if path in self.index:
+      self.index[path].size = len(solution)
+    return solution[offset:offset + size]
+
+  def read_ahead(self, fh, key, field, type):
+    """fh's ReadAhead, if reading ahead is on and fh is ours."""
+    if not self.prefetcher or fh not in self.handles:
+      return None
+    readahead = self.readaheads.get(fh)
+    if readahead is None or readahead.key != key:
+      # renamed files start over
+      readahead = self.readaheads[fh] = ReadAhead(key,
+          lambda start, end: self.fetch_range(key, field, type, start, end),
+          self.prefetcher, min(READAHEAD_MIN, self.readahead),
+          self.readahead)
+    return readahead
+
+  def fetch_range(self, key, field, type, start, end):
+    """Bytes start up to end of a string, hash field or chunked file,
+       fetched once however many threads ask for them at the same time."""
+    if end <= start:
+      return ''
+    client = self.reader(key)
+    if type == 'string':
+      fetch = lambda: client.getrange(key, start, end - 1)
+    elif type == 'chunked':
+      fetch = lambda: self.scripts.chunkgetrange(key, start, end - 1,
+          client)
+    else:
+      fetch = lambda: self.scripts.hgetrange(key, field, start, end - 1,
+          client)
+    return self.flights.fetch((key, field, start, end), fetch)
+
+  def report(self, path):
+    extra = dict(cache=self.cache.stats()) if self.cache else {}
+    if self.coalescers:
+      extra['coalesce'] = coalesced(self.coalescers)
+    if path.endswith('.json'):
+      return self.stats.json(**extra)
+    return self.stats.text(**extra)
+
+  def contents(self, key, field, type):
+    """Everything read(2) would return for the file."""
+    if type in RANGED:
+      return self.fetch(self.reader(key), key, field, type) or ''
+    return self.representation(key, field, type)
+
+  def invalidate(self, key):
+    """key changed (or is about to), through us or someone else."""
+    if self.cache:
+      self.cache.invalidate(key)
+    self.flights.forget(key)
+    for readahead in self.readaheads.values():
+      if readahead.key == key:
+        readahead.drop()
+    if self.replicas:
+      self.replicas.changed(key)
+
+  def r_type(self, path, key, field):
+    """Type of the redis value behind path, asking redis only if we
+       don't already know it."""
+    st = self.index.get(path)
+    if st and st.type:
+      return st.type
     type = self.redis.type(key)
-    solution = self.representation(key, field, type)
-    self.files[path]["st_size"] = len(solution)
-    return solution
+    if field and type == 'hash':
+      type = 'hash_field'
+    elif type == 'hash' and self.redis.hexists(key, chunks.MANIFEST):
+      type = 'chunked'
+    if st and type != 'none':
+      st.type = type
+    return type
 
   def representation(self, key, field, type):
+    return formatted(self.fetch(self.reader(key), key, field, type))
+
+  def fetch(self, client, key, field, type):
+    """Issue the command reading a whole value of type on client, which
+       may be a pipeline."""
     value = ''
     if type == 'hash' or type == 'hash_field':
       if field:
-        value = self.redis.hget(key, field)
+        value = client.hget(key, field)
       else:
-        value = self.redis.hgetall(key)
+        value = client.hgetall(key)
     elif type == 'string':
-      value = self.redis.get(key)
+      value = client.get(key)
+    elif type == 'chunked':
+      value = self.scripts.chunkgetrange(key, 0, -1, client)
     elif type == 'list':
-      value = self.redis.lrange(key, 0, -1)
+      value = client.lrange(key, 0, -1)
     elif type == 'set':
-      value = self.redis.smembers(key)
+      value = client.smembers(key)
     elif type == 'zset':
-      value = self.redis.zrange(key, 0, -1)
+      value = client.zrange(key, 0, -1)
+    return value
+
+  def readdir(self, path, fh, offset=0):
+    listed = False
+    if self.lazy:
+      if path not in self.loaded:
+        self.populate_dir(path)
+        listed = True
+    elif self.index["/"].nlink == 2:
+      with self.populating:
+        # everyone who got here before the first listing finished waits
+        # for it instead of starting their own
+        if self.index["/"].nlink == 2:
+          self.populate_files()
+          listed = True
+    if not self.index.is_dir(path):
+      raise FuseOSError(ENOENT)
+    if not offset:
+      self.warm(path, refresh=not listed)
+    return self.listing(path, offset)
+
+  def warm(self, path, refresh=True):
+    """Get the attributes of everything in path ready before the kernel
+       stats the entries one by one (ls -l, find -size): files resolved
+       more than attr_timeout seconds ago are looked up again, their
+       lengths, stamps and TTLs a pipeline per scan_count keys instead of
+       a round trip each.  Collections aren't read here: a formatted size
+       is worked out on the first getattr or read of that file."""
+    when = time()
+    if refresh and self.attr_timeout is not None and \
+       when - self.refreshed.get(path, self.populated) >= self.attr_timeout:
+      self.refreshed[path] = when
+      base = path.rstrip('/')
+      children = [base + '/' + name
+          for (name, st, seq) in self.index.entries(path, 0) if st.type]
+      # files open with writes still on their way to redis aren't there
+      # yet, leave their keys alone
+      keys = set(self.splitpath(child)[0] for child in children)
+      keys -= set(self.splitpath(child)[0] for child in children
+          if self.buffers_for(child))
+      keys = sorted(keys)
+      if self.lazy:
+        # listing it again finds new keys too
+        found = self.populate_dir(path)
+        for key in keys:
+          if key not in found:
+            self.forget_key(key)
+      else:
+        for i in xrange(0, len(keys), self.scan_count):
+          self.refresh_keys(keys[i:i + self.scan_count], touch=False)
+    if self.cache and self.warm_size:
+      self.warm_contents(path)
+
+  def warm_contents(self, path):
+    """Fetch the small files in directory path into the content cache,
+       strings with MGET and the fields of each hash with HMGET, all in
+       one pipeline.  Readers going through every file right after
+       listing it (grep -r, git status) then find them cached instead of
+       making a round trip each."""
+    self.warmed.add(path)
+    base = path.rstrip('/')
+    (strings, fields, budget) = ([], {}, self.warm_max)
+    largest = min(self.warm_size, self.cache.max_entry)
+    for (name, st, seq) in self.index.entries(path, 0):
+      if st.type not in ('string', 'hash_field') or st.size is None or \
+         st.size > min(largest, budget):
+        continue
+      (key, field) = self.splitpath(base + '/' + name)[:2]
+      if (key, field or None) in self.cache:
+        continue
+      budget -= st.size
+      if field:
+        fields.setdefault(key, []).append(field)
+      else:
+        strings.append(key)
+    if not strings and not fields:
+      return
+    epoch = self.cache.epoch
+    pipe = self.reader(*(strings + fields.keys())).pipeline(
+        transaction=False)
+    # MGET can't span a cluster's slots: GETs there, which its pipeline
+    # sends to every node at once
+    chunk = 1 if self.cluster else self.scan_count
+    batches = [strings[i:i + chunk] for i in xrange(0, len(strings), chunk)]
+    for batch in batches:
+      if self.cluster:
+        pipe.get(batch[0])
+      else:
+        pipe.mget(batch)
+    for (key, names) in fields.items():
+      pipe.hmget(key, names)
+    replies = pipe.execute(raise_on_error=False)
+    fetched = []
+    for (batch, reply) in zip(batches, replies):
+      if self.cluster and not isinstance(reply, Exception):
+        reply = [reply]
+      if isinstance(reply, list):
+        fetched.extend(zip([(key, None) for key in batch], reply))
+    for ((key, names), reply) in zip(fields.items(), replies[len(batches):]):
+      if isinstance(reply, list):
+        fetched.extend(zip([(key, field) for field in names], reply))
+    for ((key, field), value) in fetched:
+      self.cache.put(key, field, value, epoch)
+
+  def listing(self, path, offset):
+    """(name, attrs, offset) for each entry of path after offset.
+
+       '.' and '..' are offsets 1 and 2 and everything else is at its
+       index sequence number, so the kernel can page through a huge
+       directory and pick up where it left off even if entries come and go
+       in between.  Attributes come straight from the index; files not
+       measured yet only get their mode (enough for the entry type).
+       Keys that have expired are left out."""
+    if offset < 1:
+      yield ('.', self.index[path].stat(), 1)
+    if offset < 2:
+      yield ('..', None, 2)
+    base = path.rstrip('/')
+    started = time()
+    for (name, st, seq) in self.index.entries(path, offset):
+      if self.expiring and \
+         self.expiring.get(base + '/' + name, started) < started:
+        continue
+      if st.size is None:
+        yield (name, dict(st_mode=st.mode), seq)
+      else:
+        yield (name, st.stat(), seq)
+
+  def populate_files(self):
+    self.index = blank_index()
+    self.populated = time()
+    self.refreshed.clear()
+    self.expiring.clear()
+    self.warmed.clear()
+    with self.indexing() as since:
+      for batch in self.scan(each=self.resolve):
+        for resolved in batch:
+          self.index_key(*resolved, since=since)
+
+  def populate_dir(self, path):
+    """List a single directory from redis (lazy mode).
+
+       Only keys under the directory's namespace are scanned.  Keys directly
+       in it become files; deeper keys just create the subdirectory they
+       live in, which is listed when (if) someone visits it.  Returns the
+       keys found directly in it."""
+    prefix = ":".join(filter(None, path.split("/")))
+    if prefix:
+      prefix += ":"
+    base = path.rstrip('/')
+    found = set()
+    if not self.index.is_dir(path):
+      return found
+
+    def split(keys):
+      (here, subdirs) = ([], set())
+      for key in keys:
+        rest = key[len(prefix):]
+        if ':' in rest:
+          subdirs.add(base + '/' + rest.split(':', 1)[0])
+        elif rest:
+          here.append(key)
+      return (subdirs, self.resolve(here))
+
+    with self.indexing() as since:
+      for (subdirs, batch) in self.scan(glob_escape(prefix) + "*", split):
+        for subdir in subdirs:
+          if subdir not in self.index:
+            self.ensure_dir(subdir)
+        for resolved in batch:
+          found.add(resolved[0])
+          self.index_key(*resolved, since=since)
+
+    self.loaded.add(path)
+    self.refreshed[path] = time()
+    return found
+
+  def lookup(self, path):
+    """Find one path we haven't listed yet (lazy mode) by resolving just
+       the key it maps to.  If that's not a key, the path can only be a
+       directory, so list the parent to find out."""
+    if not path.strip('/'):
+      return
+    parent = path.rsplit('/', 1)[0] or '/'
+    if parent in self.loaded:
+      return   # the parent's listing already told us everything
+
+    (string_key, key, field, dir, filename) = self.paths.parse(path)
+    with self.indexing() as since:
+      for resolved in self.resolve(list(set([string_key, key]))):
+        if resolved[1] == 'hash' or resolved[0] == string_key:
+          self.index_key(*resolved, since=since)
+
+    if path not in self.index and parent in self.index:
+      self.populate_dir(parent)
+
+  def scan(self, match=None, each=None):
+    """Walk the keyspace with SCAN (never KEYS, which blocks the server)
+       yielding one batch of keys at a time, or what each(batch) makes of
+       it.  A cluster's primaries are walked all at once, each in a
+       thread of its own that calls each too, so the round trips
+       resolving a batch overlap with the other shards'."""
+    if not self.cluster:
+      return self.scan_node(self.reader(), match, each)
+    return merged([self.scan_node(client, match, each)
+        for client in self.redis.primaries()])
+
+  def scan_node(self, client, match, each):
+    cursor = 0
+    while True:
+      cursor, keys = client.scan(cursor, match=match, count=self.scan_count)
+      if keys:
+        yield each(keys) if each else keys
+      if not int(cursor):
+        break
+
+  def resolve(self, keys):
+    """Find type and size of a batch of keys using one pipeline per step
+       instead of several round trips per key.
+
+       Returns a list of (key, type, size, fields, stamp, expires) where
+       fields is a list of (field, size) for hashes and expires when the
+       key expires (None if it doesn't).  Hashes holding a chunked file
+       come back as type chunked, with its length.  Sets, zsets and lists
+       get a None size (it's worked out on first getattr, see measure)
+       and their version stamp.  Keys which vanished or changed type while
+       we were looking are left out."""
+    client = self.reader(*keys)
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+      pipe.type(key)
+    types = pipe.execute()
+
+    digests = self.digests
+    pipe = client.pipeline(transaction=False)
+    for key, type in zip(keys, types):
+      if type == 'string':
+        pipe.strlen(key)
+      elif type == 'hash':
+        pipe.hkeys(key)
+      elif type in CARDINALITY:
+        self.stamp(pipe, key, type, digests)
+      if type != 'none':
+        pipe.pttl(key)
+    results = iter(pipe.execute(raise_on_error=False))
+    (values, expiries) = ([], [])
+    started = time()
+    for key, type in zip(keys, types):
+      if type in ('string', 'hash'):
+        values.append(next(results))
+      elif type in CARDINALITY:
+        values.append(self.stamped(results, digests))
+      else:
+        values.append(None)
+      ttl = next(results) if type != 'none' else None
+      expiries.append(started + ttl / 1000.0
+          if isinstance(ttl, (int, long)) and ttl >= 0 else None)
+
+    pipe = client.pipeline(transaction=False)
+    for key, type, value in zip(keys, types, values):
+      if type == 'hash' and isinstance(value, list):
+        if chunks.MANIFEST in value:
+          pipe.hget(key, chunks.MANIFEST)
+          continue
+        for field in value:
+          pipe.hstrlen(key, field)
+    field_sizes = iter(pipe.execute(raise_on_error=False))
+
+    resolved = []
+    for key, type, value, expires in zip(keys, types, values, expiries):
+      if not key or type == 'none' or isinstance(value, Exception):
+        continue
+      if type == 'string':
+        resolved.append((key, type, value, None, None, expires))
+      elif type == 'hash' and chunks.MANIFEST in value:
+        layout = chunks.parse(next(field_sizes))
+        if layout is not None:
+          resolved.append((key, 'chunked', layout[0], None, None, expires))
+      elif type == 'hash':
+        fields = [(field, next(field_sizes)) for field in value]
+        fields = [(f, size) for (f, size) in fields
+            if not isinstance(size, Exception)]
+        resolved.append((key, type, 0, fields, None, expires))
+      elif type in CARDINALITY:
+        resolved.append((key, type, None, None, value, expires))
+    return resolved
+
+  def stamp(self, client, key, type, digests):
+    """Queue the commands making up a collection's version stamp."""
+    getattr(client, CARDINALITY[type])(key)
+    if digests:
+      client.execute_command('DEBUG', 'DIGEST-VALUE', key)
+
+  def stamped(self, results, digests):
+    """Pull the results queued by stamp back out of results."""
+    count = next(results)
+    if isinstance(count, Exception):
+      if digests:
+        next(results)
+      return count
+    if not digests:
+      return (count, None)
+    digest = next(results)
+    if isinstance(digest, Exception):
+      self.digests = False   # DEBUG is disabled (or too old), stop asking
+      digest = None
+    return (count, digest)
+
+  def measure(self, path, st):
+    """Work out the size of a formatted collection the first time someone
+       asks for it, instead of reading every collection at mount."""
+    (key, field) = self.splitpath(path)[:2]
+    epoch = self.cache.epoch if self.cache else None
+    # stamp first: if the value changes in between, the stamp is the stale
+    # one and the next refresh measures again
+    digests = self.digests
+    pipe = self.reader(key).pipeline(transaction=False)
+    self.stamp(pipe, key, st.type, digests)
+    self.fetch(pipe, key, field, st.type)
+    results = iter(pipe.execute(raise_on_error=False))
+    stamp = self.stamped(results, digests)
+    value = next(results)
+    if isinstance(value, Exception):
+      st.size = 0
+      return
+    value = formatted(value)
+    st.size = len(value)
+    st.stamp = stamp
+    if self.cache:
+      self.cache.put(key, field or None, value, epoch)
+
+  @contextmanager
+  def indexing(self):
+    """Around resolving keys and indexing what came back: yields the
+       since to pass index_key, so files removed meanwhile stay removed."""
+    with self.tombstone_lock:
+      self.resolving += 1
+      since = self.removals
+    try:
+      yield since
+    finally:
+      with self.tombstone_lock:
+        self.resolving -= 1
+        if not self.resolving:
+          self.tombstones.clear()
 
-    if isinstance(value, str):
-      return value
+  def removed(self, path):
+    """path just left the index.  Call holding its directory's lock."""
+    with self.tombstone_lock:
+      if self.resolving:
+        self.removals += 1
+        self.tombstones[path] = self.removals
+
+  def index_key(self, key, type, size, fields=None, stamp=None, expires=None,
+                touch=False, since=None):
+    """Add or update the file(s) for one resolved key in the index.
+       Returns their paths.  Paths removed after since (see indexing)
+       were resolved before they went and aren't added back."""
+    dir_for_key = '/'
+    if ':' in key:
+      dir_for_key = self.extract_dirs(key.split(":"))
+
+    path = "/" + "/".join(key.split(":"))
+    update_paths = []
+
+    # if we are a hash, make entries for each hash key but not the hash itself
+    if type == 'hash':
+      for field, field_size in fields:
+        update_paths.append((path + '.' + field, 'hash_field', field_size))
+    # else, we are a non-hash, so just make the file the key name
     else:
-      # hgetall, sets, lists, and zsets aren't returnable unless formatted
-      # also, let's be nice and throw in a newline so we can `cat` nicely
-      return pformat(value) + "\n"
+      update_paths.append((path, type, size))
 
-  
-  def readdir(self, path, fh):
-    if self.files["/"]["st_nlink"] == 2:
-      self.populate_files()
-    dir = self.dirs[path]
-    if not dir:
-      raise FuseOSError(ENOENT)
+    with self.dir_lock(dir_for_key):
+      # a key named like a namespace ("a" next to "a:b"): the directory
+      # wins, whichever is found first (see ensure_dir)
+      if not self.index.is_dir(dir_for_key):
+        return []
+      for (update, r_type, r_size) in update_paths:
+        if expires:
+          self.expiring[update] = expires
+        else:
+          self.expiring.pop(update, None)
+        st = self.index.get(update)
+        # already listed (lazy mode can find a key more than once, the
+        # watcher finds them again when they change)
+        if st is None:
+          if since is not None and self.tombstones.get(update, 0) > since:
+            continue
+          self.index.add(update, Record(size=r_size, type=r_type,
+              stamp=stamp))
+          continue
+        if self.index.is_dir(update):
+          continue
+        if r_type in CARDINALITY:
+          # the formatted size is only stale if the collection changed
+          changed = touch or r_type != st.type or stamp != st.stamp
+          st.stamp = stamp
+          if changed:
+            st.size = None
+        else:
+          changed = touch or st.size != r_size
+          # our own unflushed writes are newer than what redis has
+          if not any(len(b) for b in self.buffers_for(update)):
+            st.size = r_size
+        if changed:
+          st.touch()
+        st.type = r_type
+    return [update for (update, r_type, r_size) in update_paths]
+
+  # Keeping up with other clients.
+  # If the server publishes keyspace events (notify-keyspace-events with
+  # K or E, plus generic, string and hash events) we subscribe and apply
+  # each change to the index as it happens.  Otherwise a background thread
+  # re-walks the keyspace with SCAN every poll_interval seconds.
+  def start_watching(self):
+    # each cluster node only publishes events for its own keys
+    clients = self.redis.primaries() if self.cluster else [self.redis]
+    flags = ''.join(set.intersection(*[set(self.keyspace_events(client))
+        for client in clients]))
+    db = self.redis.connection_pool.connection_kwargs.get('db', 0)
+    # every type of value we show and cache, plus expiries and evictions
+    wanted = 'A' in flags or all(f in flags for f in EVENT_CLASSES)
+    if wanted and 'K' in flags:
+      target, pattern = self.follow, '__keyspace@%s__:*' % db
+    elif wanted and 'E' in flags:
+      target, pattern = self.follow, '__keyevent@%s__:*' % db
     else:
-      return dir
+      log.info("Keyspace notifications are off (or leave out some of "
+          "%s), polling every %ss", EVENT_CLASSES, self.poll_interval)
+      target, pattern = self.poll, None
+    # one follower per node, one poller for the lot
+    watchers = [(pattern, client) for client in clients] if pattern else [()]
+    for args in watchers:
+      watcher = Thread(target=target, args=args)
+      watcher.daemon = True
+      watcher.start()
+    return target == self.follow
 
-  def populate_files(self):
-    (self.files, self.dirs) = blank_files_and_dirs();
-    for key in self.redis.keys():
-      if not key:
+  def keyspace_events(self, client):
+    try:
+      return client.config_get('notify-keyspace-events').get(
+          'notify-keyspace-events', '')
+    except redis.ResponseError:
+      return ''   # CONFIG is disabled, assume nobody turned events on
+
+  # Client side caching.
+  # A dedicated connection subscribes to __redis__:invalidate and every
+  # other connection turns on CLIENT TRACKING redirected to it as it
+  # connects (see Connection), so redis tells us whenever a key we have
+  # read changes and we drop it from the content cache.
+  def start_tracking(self):
+    pool = self.redis.connection_pool
+    # our own connection, outside the pool: it must survive the disconnect
+    # below and shouldn't take a fuse thread's slot
+    conn = Connection(**pool.connection_kwargs)
+    try:
+      conn.send_command('CLIENT', 'ID')
+      redirect = conn.read_response()
+      # redis < 6 doesn't track.  find out before every connection asks.
+      conn.send_command('CLIENT', 'TRACKING', 'ON', 'REDIRECT', redirect)
+      conn.read_response()
+      conn.send_command('CLIENT', 'TRACKING', 'OFF')
+      conn.read_response()
+      conn.send_command('SUBSCRIBE', '__redis__:invalidate')
+      conn.read_response()
+    except redis.RedisError:
+      conn.disconnect()
+      return False
+    self.tracking['redirect'] = redirect
+    pool.disconnect()   # reconnect everything with tracking on
+    tracker = Thread(target=self.track, args=(conn,))
+    tracker.daemon = True
+    tracker.start()
+    return True
+
+  def track(self, conn):
+    while True:
+      try:
+        message = conn.read_response()
+      except redis.RedisError:
+        # connections still redirect to the client we just lost, so
+        # nothing in the cache can be trusted any more
+        self.tracking.pop('redirect', None)
+        self.cache.invalidate()
+        if not self.notified:
+          log.warning("Lost the CLIENT TRACKING connection, not caching")
+          self.cache = None
+        return
+      if message[0] != 'message':
         continue
-      dir_for_key = '/'
-      if re.search(':', key):
-        dir_for_key = self.extract_dirs(key.split(":"))
-
-      path = "/" + "/".join(key.split(":"))
-
-      made_file = self.mkfile(key)
-      update_paths = []
-
-      # if we are a hash, make entries for each hash key but not the hash itself
-      if made_file['r_type'] == 'hash':
-        base_path = path
-        for field in self.redis.hkeys(key):
-          path = base_path + '.' + field
-          self.files[path] = self.mkfile(key, 'hash_field', field)
-          update_paths.append(path)
-      # else, we are a non-hash, so just make the file the key name
+      if message[2] is None:   # FLUSHDB/FLUSHALL
+        self.cache.invalidate()
       else:
-        self.files[path] = made_file
-        update_paths.append(path)
+        for key in message[2]:
+          self.invalidate(key)
+
+  def follow(self, pattern, client):
+    """Apply keyspace events as they arrive.  If the subscription is lost
+       (the server restarted, say) subscribe again, then catch up on what
+       was missed meanwhile with a sweep."""
+    lost = False
+    while True:
+      pubsub = client.pubsub(ignore_subscribe_messages=True)
+      try:
+        pubsub.psubscribe(pattern)
+        if lost:
+          # whatever was cached while nobody was listening may be stale
+          if self.cache:
+            self.cache.invalidate()
+          self.sweep()
+          lost = False
+        self.apply_events(pubsub)
+      except redis.RedisError, e:
+        if not lost:
+          log.warning("Lost keyspace notifications, subscribing again: %s",
+              e)
+        lost = True
+        # nothing tells us about changes until we're back
+        if self.cache:
+          self.cache.invalidate()
+        try:
+          pubsub.close()
+        except redis.RedisError:
+          pass
+        sleep(RESUBSCRIBE_DELAY)
+
+  def apply_events(self, pubsub):
+    while True:
+      message = pubsub.get_message(timeout=1.0)
+      # apply whatever piled up in one go so a burst of writes to a key
+      # costs one lookup
+      events = {}
+      while message:
+        (space, name) = message['channel'].split(':', 1)
+        if space.startswith('__keyspace@'):
+          events[name] = message['data']
+        else:
+          events[message['data']] = name
+        message = pubsub.get_message()
+      for key in events:
+        self.invalidate(key)
+      if events:
+        gone = [k for (k, e) in events.iteritems() if e in GONE_EVENTS]
+        for key in gone:
+          self.forget_key(key)
+        self.refresh_keys([k for (k, e) in events.iteritems()
+            if e not in GONE_EVENTS])
+
+  def poll(self):
+    while True:
+      sleep(self.poll_interval)
+      try:
+        self.sweep()
+      except redis.RedisError, e:
+        log.warning("Sweep failed: %s", e)
+
+  def sweep(self):
+    """Bring the index up to date with one incremental SCAN of the
+       keyspace, a batch at a time, then drop whatever wasn't seen."""
+    started = now()   # timestamps are to the second, see records.py
+    seen = set()
+    for keys in self.scan():
+      seen.update(keys)
+      self.refresh_keys(keys, touch=False)
+    for path, st in list(self.index.walk()):
+      if not st.type or st.ctime >= started or \
+         path not in self.index or self.buffers_for(path):
+        continue
+      key = self.splitpath(path)[0]
+      if key not in seen:
+        self.forget_key(key)
+
+  def refresh_keys(self, keys, touch=True):
+    """Look keys up again and update (or drop) their files."""
+    keys = [key for key in keys if key and self.tracked(key)]
+    found = set()
+    with self.indexing() as since:
+      for resolved in self.resolve(keys):
+        found.add(resolved[0])
+        self.forget_key(resolved[0], keep=self.index_key(*resolved,
+            touch=touch, since=since))
+    for key in keys:
+      if key not in found:
+        self.forget_key(key)
 
-      for update in update_paths:
-        (key, field, dir, filename) = self.splitpath(update)
-        self.dirs[dir_for_key].append(filename)
-        self.files[dir_for_key]["st_nlink"] = len(self.dirs[dir_for_key])
+  def tracked(self, key):
+    """Lazy mode only follows keys in directories somebody listed.  A new
+       key further below a listed directory just adds the subdirectory it
+       lives in."""
+    if not self.lazy:
+      return True
+    parts = key.split(':')
+    if '/' + '/'.join(parts) in self.index:
+      return True
+    for depth in xrange(len(parts) - 1, -1, -1):
+      ancestor = '/' + '/'.join(parts[:depth])
+      if ancestor in self.loaded:
+        if depth == len(parts) - 1:
+          return True
+        self.ensure_dir(ancestor.rstrip('/') + '/' + parts[depth])
+        return False
+    return False
 
+  def forget_key(self, key, keep=()):
+    """Remove every file key shows up as, except those in keep."""
+    parts = key.split(':')
+    dir = '/' + '/'.join(parts[:-1])
+    if not self.index.is_dir(dir):
+      return
+    base = parts[-1]
+    with self.dir_lock(dir):
+      # the key itself, or the fields of a hash
+      for name in self.index.related(dir.rstrip('/') + '/' + base):
+        path = dir.rstrip('/') + '/' + name
+        st = self.index.get(path)
+        if path in keep or not st or not st.type:
+          continue
+        # a.b could just as well be a string key named a.b
+        if name != base and self.splitpath(path)[0] != key:
+          continue
+        self.index.remove(path)
+        self.removed(path)
+        self.expiring.pop(path, None)
 
   def readlink(self, path):
     return self.read(self, path)
   
   def removexattr(self, path, name):
-    attrs = self.files[path].get('attrs', {})
+    attrs = self.index[path].xattrs or {}
     try:
       del attrs[name]
     except KeyError:
@@ -291,8 +1210,12 @@ class Redis(LoggingMixIn, Operations):
     # If field, read from field, write to new field, delete old field
     #   Technically, that would allow cross-hash renames too
     #   Promote a hash field to a top level string?
+    self.push_path(old)
     (okey, ofield, odir, ofilename) = self.splitpath(old)
     (nkey, nfield, ndir, nfilename) = self.splitpath(new)
+    if self.index[old].type == 'chunked' and new not in self.index:
+      # a chunked file is a key of its own, whatever its new name says
+      (nkey, nfield) = (self.paths.parse(new)[0], False)
 
     # If vim is trying to rename the file to re-write it, disallow.
     # It breaks any non-string or non-hash field because it renames the existing
@@ -300,8 +1223,8 @@ class Redis(LoggingMixIn, Operations):
     # the renamed set, zset, list, or hash.
     disallow_types = ('hash', 'set', 'zset', 'list')
     if self.disallow_rename_representations and \
-       self.files[old]["r_type"] in disallow_types or (new in self.files and \
-       self.files[new]["r_type"] in disallow_types):
+       self.index[old].type in disallow_types or (new in self.index and \
+       self.index[new].type in disallow_types):
       raise FuseOSError(EACCES)
 
     # if we are trying to rename a hash field, don't allow it.
@@ -310,26 +1233,34 @@ class Redis(LoggingMixIn, Operations):
       raise FuseOSError(EACCES)
 
     self.redis.rename(okey, nkey)
-    self.files[new] = self.files.pop(old)
-    self.dirs[odir].remove(ofilename)
-    self.files[odir]["st_nlink"] -= 1
-    self.files[ndir]["st_nlink"] += 1
-    # make sure new_dir exist before doing this or else we won't have . and ..
-    if not ndir in self.dirs:
-      self.dirs[ndir].extend([".", ".."])
-    self.dirs[ndir].append(nfilename)
+    self.invalidate(okey)
+    self.invalidate(nkey)
+    with self.dir_lock(odir, ndir):
+      # replaces new if it was there
+      self.index.move(old, new)
+      self.removed(old)
+      for buffer in self.buffers_for(old):
+        buffer.path = new
+    # RENAME keeps the expiry
+    expires = self.expiring.pop(old, None)
+    if expires:
+      self.expiring[new] = expires
+    else:
+      self.expiring.pop(new, None)
+    self.paths.forget(old)
   
   def rmdir(self, path):
     (key, field, dir, filename) = self.splitpath(path)
-    self.files.pop(path)
-    self.dirs[dir].remove(filename)
-    # delete from parent directory here too
-    self.files[dir]['st_nlink'] -= 1
+    with self.dir_lock(dir, path):
+      self.index.remove(path)
+    self.paths.forget(path)
   
   def setxattr(self, path, name, value, options, position=0):
     # Ignore options
-    attrs = self.files[path].setdefault('attrs', {})
-    attrs[name] = value
+    st = self.index[path]
+    if st.xattrs is None:
+      st.xattrs = {}
+    st.xattrs[name] = value
   
   def statfs(self, path):
     # Figure out if these need to be accurate or if lies are okay
@@ -338,26 +1269,35 @@ class Redis(LoggingMixIn, Operations):
   
   def symlink(self, target, source):
     # incorporate with link functionality in er
-    self.files[target] = dict(st_mode=(S_IFLNK | 0777), st_nlink=1,
-      st_size=len(source))
+    self.add_new_file(target, Record(S_IFLNK | 0777, len(source)))
   
   def truncate(self, path, length, fh=None):
-    (key, field, dir, filename) = self.splitpath(path)
-
+    if path in STATS_FILES:
+      self.stats.reset()
+      return
     if self.disallow_unlink_representations and \
-       self.files[path]["r_type"] in ('hash', 'set', 'zset', 'list'):
+       self.index[path].type in ('hash', 'set', 'zset', 'list'):
       raise FuseOSError(EACCES)
 
-    if path in self.files:
-      self.files[path]['st_size'] = length
-    if field:
-      # ugh.  read/set
-      val = self.redis.hget(key, field)
-      self.redis.hset(key, val[:length])
+    # drop buffered writes past the new end, push the rest first so the
+    # truncate below sees them
+    for buffer in self.buffers_for(path):
+      buffer.truncate(length)
+      buffer.base = min(buffer.base, length)
+    self.push_path(path)
+
+    (key, field, dir, filename) = self.splitpath(path)
+    type = self.r_type(path, key, field)
+    if self.chunk_size and type in ('string', 'hash_field') and \
+       length > self.chunk_size:
+      (key, type) = self.chunkify(path, key, field)
+    if path in self.index:
+      self.index[path].size = length
+    self.invalidate(key)
+    if type == 'chunked':
+      self.scripts.chunktruncate(key, length)
     else:
-      # ugh.  read/set
-      val = self.redis.get(key)
-      self.redis.set(key, val[:length])
+      self.scripts.truncate(key, length, field or None)
 
   def unlink(self, path):
     (key, field, dir, filename) = self.splitpath(path)
@@ -373,93 +1313,341 @@ class Redis(LoggingMixIn, Operations):
     # non-strings and non-hash-fields.  There should be a config option
     # for "allow renames" and "allow delete" for all types.
     if self.disallow_unlink_representations and \
-       self.files[path]["r_type"] in ('hash', 'set', 'zset', 'list'):
+       self.index[path].type in ('hash', 'set', 'zset', 'list'):
       raise FuseOSError(EACCES)
 
-    self.files.pop(path)
-    self.dirs[dir].remove(filename)
-    self.files[dir]['st_nlink'] -= 1
+    # whatever is still buffered for this file is going away with it
+    for buffer in self.buffers_for(path):
+      buffer.clear()
+
+    # gone from redis before the index: a listing resolving it from now
+    # on can't find it again
+    self.invalidate(key)
     if field:
       self.redis.hdel(key, field)
-      # If last field in the hash, delete the toplevel hash representation
-      if self.repr and not self.redis.hkeys(key):
-        hk = self.hashkey(filename, field, dir)
-        self.files.pop(hk)
-        (hkey, hfield, hdir, hfilename) = self.splitpath(hk)
-        self.dirs[dir].remove(hfilename)
-        self.files[dir]['st_nlink'] -= 1
     else:
       self.redis.delete(key)
+    with self.dir_lock(dir):
+      # following changes may have dropped it already
+      if path in self.index:
+        self.index.remove(path)
+      self.removed(path)
+    self.paths.forget(path)
+    self.expiring.pop(path, None)
+    # If last field in the hash, delete the toplevel hash representation
+    if field and self.repr and not self.redis.hkeys(key):
+      hk = self.hashkey(filename, field, dir)
+      (hkey, hfield, hdir, hfilename) = self.splitpath(hk)
+      with self.dir_lock(dir):
+        self.index.remove(hk)
 
   def utimens(self, path, times=None):
-    now = time()
-    atime, mtime = times if times else (now, now)
-    self.files[path]['st_atime'] = atime
-    self.files[path]['st_mtime'] = mtime
+    atime, mtime = times if times else (now(), now())
+    st = self.index[path]
+    (st.atime, st.mtime) = (atime, mtime)
  
-  def add_new_file(self, path):
-    (key, field, dir, filename) = self.splitpath(path)
-    self.files[dir]["st_nlink"] += 1
-    self.dirs[dir].append(filename)
+  def add_new_file(self, path, st):
+    """Add a file to the index, unless another thread just beat us to it.
+       Returns the stat it ended up with."""
+    dir = split_path(path)[0]
+    with self.dir_lock(dir):
+      existing = self.index.get(path)
+      if existing is not None:
+        return existing
+      try:
+        return self.index.add(path, st)
+      except KeyError:
+        raise FuseOSError(ENOENT)
+
+  def ensure_dir(self, path):
+    """mkdir for a key namespace, unless another thread just beat us to
+       it.  A key named like the namespace ("a" next to "a:b") can't be
+       shown as well: the directory takes the file's place."""
+    parent = split_path(path)[0]
+    with self.dir_lock(parent, path):
+      if path in self.index and not self.index.is_dir(path):
+        self.index.remove(path)
+        self.removed(path)
+        self.expiring.pop(path, None)
+        self.paths.forget(path)
+      try:
+        self.mkdir(path, 0755)
+      except FuseOSError:
+        pass
     
   def write(self, path, data, offset, fh):
+    if path in STATS_FILES:
+      self.stats.reset()
+      return len(data)
     (key, field, dir, filename) = self.splitpath(path)
     type = ''
-    if path in self.files:
-      type = self.files[path]['r_type']
+    if path in self.index:
+      type = self.index[path].type
     elif field and self.redis.type(key) == 'hash':  # new hash field
       type = 'hash_field'
-      self.files[path] = self.mkfile(key, 'hash_field', field)
+      self.add_new_file(path, self.mkfile(key, 'hash_field', field))
     else:  # new string
       type = 'string'
-      self.files[path] = self.mkfile(key, 'string')
+      self.add_new_file(path, self.mkfile(key, 'string'))
 
-    if type == 'hash':  # writing existing python representation of a redis hash
+    # no writing to hashes directly (and sets, zsets, or lists)
+    if type not in RANGED:
       raise FuseOSError(EACCES)
 
-    if field and type == 'hash_field':
-      existing_data = self.redis.hget(key, field)
-      use_data = existing_data[:offset] + data if existing_data else data
-      self.redis.hset(key, field, use_data)
-      if self.repr and use_data:
+    buffer = self.handles.get(fh)
+    if buffer is None:
+      # not written through a handle we know about, so nothing will ever
+      # flush it for us.  write through.
+      buffer = WriteBuffer(path)
+    with buffer.lock:
+      st = self.index[path]
+      if not len(buffer):
+        buffer.base = st.size
+      buffer.path = path
+      buffer.write(offset, data)
+      st.size = max(st.size, offset + len(data))
+
+      if fh not in self.handles or len(buffer) >= self.max_dirty:
+        self.push(buffer)
+
+    return len(data)
+
+  def buffers_for(self, path):
+    # values() copies, so other threads can open and close files meanwhile
+    return [b for b in self.handles.values() if b.path == path]
+
+  def push_path(self, path):
+    for buffer in self.buffers_for(path):
+      self.push(buffer)
+
+  def push_handle(self, path, fh):
+    buffer = self.handles.get(fh)
+    if buffer is not None:
+      if path:
+        buffer.path = path
+      self.push(buffer)
+
+  def push(self, buffer):
+    """Send everything buffered for a handle to redis in one go."""
+    with buffer.lock:
+      self._push(buffer)
+
+  def _push(self, buffer):
+    if not len(buffer):
+      return
+    path = buffer.path
+    (key, field, dir, filename) = self.splitpath(path)
+    type = self.r_type(path, key, field)
+    st = self.index.get(path)
+    if self.chunk_size and type in ('string', 'hash_field') and st and \
+       st.size > self.chunk_size:
+      (key, type) = self.chunkify(path, key, field)
+
+    if type == 'chunked':
+      def queue(pipe):
+        for offset, data in buffer.items():
+          self.scripts.chunksetrange(key, offset, str(data), pipe)
+      self.scripts.execute(queue)
+    elif field and type == 'hash_field':
+      if buffer.covers(buffer.base):
+        # the whole field is new
+        self.redis.hset(key, field, buffer.splice(''))
+      else:
+        def queue(pipe):
+          for offset, data in buffer.items():
+            self.scripts.hsetrange(key, field, offset, str(data), pipe)
+        self.scripts.execute(queue)
+      if self.repr:
         hk = self.hashkey(filename, field, dir)
-        self.files[path]['st_size'] = len(use_data)
-        self.files[hk] = self.mkfile(key, 'hash')
-    elif type == 'string':
-      print "WRITING TO", key, path, data
-      self.redis.setrange(key, offset, data)
-      self.files[path]['st_size'] = self.redis.strlen(key)
+        # measured again on the next stat
+        self.add_new_file(hk, self.mkfile(key, 'hash')).size = None
     else:
-      # no writing to hashes directly (and sets, zsets, or lists)
-      raise FuseOSError(EACCES)
+      pipe = self.redis.pipeline(transaction=False)
+      for offset, data in buffer.items():
+        pipe.setrange(key, offset, str(data))
+      pipe.execute()
 
-    return len(data)
+    self.invalidate(key)
+    buffer.clear()
+
+  def chunkify(self, path, key, field):
+    """Move the string or hash field behind path into a chunked file at
+       the key path names (see chunks.py).  Returns the key and type to
+       write to from now on, which stay as they were if a field's new key
+       is taken by something else."""
+    target = self.paths.parse(path)[0]
+    pipe = self.redis.pipeline(transaction=False)
+    if field:
+      pipe.hget(key, field)
+      pipe.exists(target)
+    else:
+      pipe.get(key)
+      pipe.pttl(key)
+    (value, extra) = pipe.execute()
+    if field and extra:
+      return (key, 'hash_field')
+    # before the old value goes, so following changes doesn't drop the
+    # file in between
+    self.index[path].type = 'chunked'
+    pipe = self.redis.pipeline(transaction=False)
+    if not field:
+      pipe.delete(key)
+    for (name, data) in chunks.fields(value or '', self.chunk_size):
+      pipe.hset(target, name, data)
+    if field:
+      pipe.hdel(key, field)
+    elif extra > 0:
+      pipe.pexpire(target, extra)
+    pipe.execute()
+    self.invalidate(key)
+    self.invalidate(target)
+    return (target, 'chunked')
 
   def mkfile(self, key, r_type=False, field=False):
     type = r_type or self.redis.type(key)
     size = 0
     if type == 'string':
       size = self.redis.strlen(key)
-    elif type in ('hash', 'zset', 'set', 'list'):
-      # read the entire data for each key, format it, get the size of the
-      # formatted version, then throw the representation away.
-      # maybe we should cache it?  maybe not?
-      val = self.representation(key, field, type)
-      if val:
-        size = len(val)
+    elif type in CARDINALITY:
+      # formatted collections are measured when first stat'd
+      size = None
     elif field and type == 'hash_field':
-      # redis can't do strlen on hash fields.  sad.
-      # read the entire value just to get the size
-      val = self.representation(key, field, type)
-      if val:
-        size = len(val)
-    return dict(st_mode=(S_IFREG | 0755), st_nlink=1,
-             r_type = type,
-             st_size=size, st_ctime=time(), st_mtime=time(), st_atime=time())
+      size = self.redis.hstrlen(key, field)
+    return Record(size=size, type=type)
 
 
 if __name__ == "__main__":
-  if len(argv) != 4:
-    print 'usage: %s <server> <port> <mountpoint>' % argv[0]
+  parser = OptionParser(
+      usage='usage: %prog [options] <server> <port> <mountpoint>\n'
+            '       %prog [options] --rdb <dump.rdb> <mountpoint>')
+  parser.add_option('--max-dirty', type='int', default=MAX_DIRTY,
+      help='bytes buffered per open file before writing to redis early '
+           '[default: %default]')
+  parser.add_option('--lazy', action='store_true', default=False,
+      help='only read a directory from redis when it is visited, instead of '
+           'listing the whole keyspace on the first ls')
+  parser.add_option('--no-watch', action='store_false', dest='watch',
+      default=True,
+      help="don't follow changes other clients make after mounting")
+  parser.add_option('--poll', type='int', default=POLL_INTERVAL,
+      help='seconds between keyspace sweeps when the server has keyspace '
+           'notifications turned off [default: %default]')
+  parser.add_option('--cache-size', type='int', default=CACHE_SIZE >> 20,
+      help='megabytes of file contents cached in memory, 0 to disable '
+           '[default: %default]')
+  parser.add_option('--threads', type='int', default=THREADS,
+      help='redis connections for fuse worker threads, 1 to run '
+           'single threaded [default: %default]')
+  parser.add_option('--scan-count', type='int', default=SCAN_COUNT,
+      help='keys fetched per SCAN and resolved per pipeline while listing '
+           '[default: %default]')
+  parser.add_option('--log-level', default='warning',
+      choices=['debug', 'info', 'warning', 'error'],
+      help='debug logs every operation; stat <mountpoint>/.debug to switch '
+           'debug on and off while mounted [default: %default]')
+  parser.add_option('--log-sample', type='int', default=1,
+      help='log only one in this many calls of each operation '
+           '[default: %default]')
+  parser.add_option('--log-async', action='store_true', default=False,
+      help='write log records from a background thread, dropping them '
+           'if it falls behind')
+  parser.add_option('--cluster', action='store_true', default=False,
+      help='the server is a node of a Redis Cluster, mount the whole '
+           'cluster (needs redis-py-cluster)')
+  parser.add_option('--replica', action='append', default=[],
+      metavar='HOST:PORT',
+      help='read from this replica of the server, writing only to the '
+           'server itself; give it once per replica')
+  parser.add_option('--replica-routing', default=ROUTINGS[0],
+      choices=list(ROUTINGS),
+      help='which replica serves each read: round-robin, or latency for '
+           'the one answering quickest [default: %default]')
+  parser.add_option('--replica-lag', type='float', default=REPLICA_LAG,
+      help='seconds a changed key is still read from the server, until '
+           'the replicas have it too [default: %default]')
+  parser.add_option('--coalesce', type='float', metavar='MS',
+      help='send the commands of concurrent operations together, as one '
+           'pipeline on one connection, waiting up to MS milliseconds to '
+           'gather them (0 sends whatever has queued up)')
+  parser.add_option('--coalesce-batch', type='int', default=BATCH,
+      help='commands sent at most in one --coalesce batch '
+           '[default: %default]')
+  parser.add_option('--readahead', type='int', default=READAHEAD_MAX >> 20,
+      help='megabytes fetched ahead at most for a file being read '
+           'sequentially, 0 to disable [default: %default]')
+  parser.add_option('--attr-timeout', type='float', metavar='SECONDS',
+      help='look the files of a directory up again when it is listed if '
+           'that was longer ago than this, and let the kernel keep '
+           'attributes that long (by default listings are kept current by '
+           'following changes)')
+  parser.add_option('--warm', type='int', metavar='KB',
+      help='when a directory is listed, or the first file in it read, '
+           'fetch all its files up to KB kilobytes into the content cache '
+           'at once')
+  parser.add_option('--warm-max', type='int', default=WARM_MAX >> 20,
+      help='megabytes --warm fetches per directory at most '
+           '[default: %default]')
+  parser.add_option('--chunk-size', type='int', metavar='KB',
+      help='store files growing past KB kilobytes as chunks that size, '
+           'so writes only touch the chunks they cover and no redis value '
+           'gets bigger than one chunk')
+  parser.add_option('--read-only', action='store_true', default=False,
+      help='refuse every change to the filesystem')
+  parser.add_option('--rdb', metavar='FILE',
+      help='mount this RDB snapshot (read-only) instead of a server')
+  parser.add_option('--db', type='int', default=0,
+      help='database in the --rdb snapshot to mount [default: %default]')
+  (options, args) = parser.parse_args()
+  if len(args) != (1 if options.rdb else 3):
+    parser.print_usage()
     exit(1)
-  fuse = FUSE(Redis(argv[1], int(argv[2])), argv[3], foreground=True)
+  if options.rdb and options.cluster:
+    parser.error('--rdb and --cluster are mutually exclusive')
+  if options.replica and (options.rdb or options.cluster):
+    parser.error('--replica only goes with a single server')
+  if options.coalesce is not None and (options.rdb or options.cluster):
+    parser.error('--coalesce only goes with a single server')
+  try:
+    replicas = [(host, int(port)) for (host, port) in
+        (replica.rsplit(':', 1) for replica in options.replica)]
+  except ValueError:
+    parser.error('--replica takes HOST:PORT')
+  setup_logging(options.log_level, sample=options.log_sample,
+      queued=options.log_async)
+  (host, port, client) = (None, None, None)
+  if options.rdb:
+    try:
+      client = SnapshotClient(Snapshot(options.rdb, options.db))
+    except (IOError, RDBError), e:
+      parser.error(str(e))
+    # a snapshot never changes: nothing to watch, and reading it is as
+    # quick as the cache would be
+    (options.read_only, options.watch, options.cache_size) = (True, False, 0)
+  else:
+    (host, port) = (args[0], int(args[1]))
+  mount_options = dict(foreground=True, nothreads=options.threads == 1)
+  if options.read_only:
+    mount_options['ro'] = True   # the kernel refuses writes before we see them
+  if options.attr_timeout is not None:
+    mount_options.update(attr_timeout=options.attr_timeout,
+        entry_timeout=options.attr_timeout)
+  try:
+    fs = Redis(host, port, max_dirty=options.max_dirty,
+               scan_count=options.scan_count, lazy=options.lazy,
+               watch=options.watch, poll_interval=options.poll,
+               cache_size=options.cache_size << 20, threads=options.threads,
+               client=client, readonly=options.read_only,
+               cluster=options.cluster, replicas=replicas,
+               routing=options.replica_routing,
+               replica_lag=options.replica_lag,
+               coalesce=None if options.coalesce is None else
+                   options.coalesce / 1000.0,
+               coalesce_batch=options.coalesce_batch,
+               readahead=options.readahead << 20,
+               attr_timeout=options.attr_timeout,
+               warm_size=options.warm and options.warm << 10,
+               warm_max=options.warm_max << 20,
+               chunk_size=options.chunk_size and options.chunk_size << 10)
+  except Unavailable, e:
+    parser.error(str(e))
+  fuse = FUSE(fs, args[-1], **mount_options)
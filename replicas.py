@@ -0,0 +1,115 @@
+"""Reading from replicas.
+
+Given replicas of the server, listings, attribute lookups and reads go to
+them and only changes go to the primary, so mounting and browsing a big
+keyspace puts no load on the primary.
+
+Replication is asynchronous, so a replica can be a little behind.  A key
+that changed recently, through us (read your writes) or as keyspace
+events told us, is read from the primary for lag seconds afterwards.
+
+A probe pings every replica every PROBE_INTERVAL seconds.  One that
+doesn't answer or has lost its link to the primary gets no reads until it
+recovers, and with none left everything goes to the primary.  Routing is
+'round-robin', or 'latency': the replica answering pings quickest lately.
+"""
+
+from itertools import count
+from threading import Lock, Thread
+from time import sleep, time
+from timeit import default_timer
+
+import redis
+
+from log import log
+
+ROUTINGS = ('round-robin', 'latency')
+
+# seconds a changed key is read from the primary
+REPLICA_LAG = 5
+
+# seconds between probes of the replicas
+PROBE_INTERVAL = 2
+
+# weight of the latest ping in a replica's latency
+SMOOTHING = 0.3
+
+# changed keys remembered before the stale ones are dropped
+PRUNE_AT = 10000
+
+
+def name(client):
+  kwargs = client.connection_pool.connection_kwargs
+  return '%s:%s' % (kwargs.get('host'), kwargs.get('port'))
+
+
+class Replicas(object):
+  def __init__(self, primary, replicas, routing=ROUTINGS[0], lag=REPLICA_LAG):
+    self.primary = primary
+    self.replicas = replicas
+    self.routing = routing
+    self.lag = lag
+    self.latency = dict((client, 0.0) for client in replicas)   # seconds
+    self.healthy = list(replicas)
+    self.turn = count()
+    self.recent = {}   # key -> when it last changed
+    self.prune_at = PRUNE_AT
+    self.prune_lock = Lock()
+
+  def start(self):
+    """Probe the replicas once, then keep probing in the background."""
+    self.probe()
+    prober = Thread(target=self.keep_probing)
+    prober.daemon = True
+    prober.start()
+
+  def changed(self, key):
+    self.recent[key] = time()
+    if len(self.recent) > self.prune_at:
+      with self.prune_lock:
+        cutoff = time() - self.lag
+        for (old, when) in self.recent.items():
+          if when < cutoff:
+            self.recent.pop(old, None)
+        # a burst of changes is pruned at most once per doubling
+        self.prune_at = max(PRUNE_AT, 2 * len(self.recent))
+
+  def client(self, keys=()):
+    """Where to read keys from."""
+    healthy = self.healthy
+    if not healthy:
+      return self.primary
+    if keys and self.recent:
+      cutoff = time() - self.lag
+      if any(self.recent.get(key, 0) > cutoff for key in keys):
+        return self.primary
+    if self.routing == 'latency':
+      return min(healthy, key=self.latency.get)
+    return healthy[next(self.turn) % len(healthy)]
+
+  def keep_probing(self):
+    while True:
+      sleep(PROBE_INTERVAL)
+      self.probe()
+
+  def probe(self):
+    healthy = []
+    for client in self.replicas:
+      try:
+        start = default_timer()
+        client.ping()
+        took = default_timer() - start
+        link = client.info('replication').get('master_link_status', 'up')
+      except redis.RedisError, e:
+        link = str(e)
+      if link != 'up':
+        if client in self.healthy:
+          log.warning("Not reading from replica %s: %s", name(client), link)
+        continue
+      if client not in self.healthy:
+        log.warning("Reading from replica %s again", name(client))
+      before = self.latency[client]
+      self.latency[client] = before + SMOOTHING * (took - before) \
+          if before else took
+      healthy.append(client)
+    self.healthy = healthy
@@ -0,0 +1,243 @@
+"""Lua scripts run inside redis.
+
+Redis has GETRANGE and SETRANGE for strings but nothing like them for
+hash fields, and no way to truncate anything, so without these a partial
+write to a field or a truncate ships the whole value both ways.  Each
+script does its job server-side and only the bytes that change cross the
+network.  (Field lengths need no script: HSTRLEN does that.)  The CHUNK
+scripts do the same for chunked files (see chunks.py), touching only the
+chunks covering the bytes asked for.
+
+Scripts are run by SHA1 with EVALSHA.  load() sends all of them up front;
+if the server loses them later (a restart, SCRIPT FLUSH) they are loaded
+again and the call retried.
+"""
+
+from redis.exceptions import NoScriptError
+
+# KEYS[1] hash, ARGV field, start, end.  GETRANGE for a hash field:
+# offsets are zero-based and inclusive.
+HGETRANGE = """
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if not value then
+  return ''
+end
+return string.sub(value, tonumber(ARGV[2]) + 1, tonumber(ARGV[3]) + 1)
+"""
+
+# KEYS[1] hash, ARGV field, offset, data.  SETRANGE for a hash field:
+# a field too short for offset is padded with zero bytes first.  Returns
+# the field's new length.
+HSETRANGE = """
+local value = redis.call('HGET', KEYS[1], ARGV[1]) or ''
+local offset = tonumber(ARGV[2])
+if #value < offset then
+  value = value .. string.rep('\\0', offset - #value)
+end
+value = string.sub(value, 1, offset) .. ARGV[3] ..
+    string.sub(value, offset + #ARGV[3] + 1)
+redis.call('HSET', KEYS[1], ARGV[1], value)
+return #value
+"""
+
+# KEYS[1] key, ARGV length and, for a hash field, the field.  Cuts the
+# value down to length or pads it with zero bytes up to it, like
+# truncate(2).  A string keeps its TTL.  Returns the new length.
+TRUNCATE = """
+local length = tonumber(ARGV[1])
+local field = ARGV[2]
+local value
+if field then
+  value = redis.call('HGET', KEYS[1], field) or ''
+else
+  value = redis.call('GET', KEYS[1]) or ''
+end
+if #value == length then
+  return length
+end
+if #value < length then
+  value = value .. string.rep('\\0', length - #value)
+else
+  value = string.sub(value, 1, length)
+end
+if field then
+  redis.call('HSET', KEYS[1], field, value)
+else
+  local ttl = redis.call('PTTL', KEYS[1])
+  redis.call('SET', KEYS[1], value)
+  if ttl > 0 then
+    redis.call('PEXPIRE', KEYS[1], ttl)
+  end
+end
+return length
+"""
+
+# KEYS[1] chunked file, ARGV start, end.  GETRANGE for a chunked file:
+# offsets are zero-based and inclusive, a negative end is the last byte.
+# Chunks missing inside the file read as zero bytes.
+CHUNKGETRANGE = """
+local manifest = redis.call('HGET', KEYS[1], '__chunks__')
+if not manifest then
+  return ''
+end
+local length, size = string.match(manifest, '(%d+) (%d+)')
+length, size = tonumber(length), tonumber(size)
+local at, stop = tonumber(ARGV[1]), tonumber(ARGV[2])
+if stop < 0 or stop >= length then
+  stop = length - 1
+end
+local parts = {}
+while at <= stop do
+  local index = math.floor(at / size)
+  local offset = at - index * size
+  local take = math.min(size - offset, stop - at + 1)
+  local field = string.format('%d', index)
+  local chunk = redis.call('HGET', KEYS[1], field) or ''
+  local piece = string.sub(chunk, offset + 1, offset + take)
+  if #piece < take then
+    piece = piece .. string.rep('\\0', take - #piece)
+  end
+  parts[#parts + 1] = piece
+  at = at + take
+end
+return table.concat(parts)
+"""
+
+# KEYS[1] chunked file, ARGV offset, data.  SETRANGE for a chunked file:
+# each chunk data falls in is spliced like HSETRANGE does a field.
+# Returns the file's new length.
+CHUNKSETRANGE = """
+local manifest = redis.call('HGET', KEYS[1], '__chunks__')
+if not manifest then
+  return redis.error_reply('ERR not a chunked file')
+end
+local length, size = string.match(manifest, '(%d+) (%d+)')
+length, size = tonumber(length), tonumber(size)
+local offset, data = tonumber(ARGV[1]), ARGV[2]
+local done = 0
+while done < #data do
+  local at = offset + done
+  local index = math.floor(at / size)
+  local start = at - index * size
+  local piece = string.sub(data, done + 1, done + size - start)
+  local field = string.format('%d', index)
+  local chunk = ''
+  if start > 0 or #piece < size then
+    chunk = redis.call('HGET', KEYS[1], field) or ''
+  end
+  if #chunk < start then
+    chunk = chunk .. string.rep('\\0', start - #chunk)
+  end
+  chunk = string.sub(chunk, 1, start) .. piece ..
+      string.sub(chunk, start + #piece + 1)
+  redis.call('HSET', KEYS[1], field, chunk)
+  done = done + #piece
+end
+if #data > 0 then
+  length = math.max(length, offset + #data)
+end
+redis.call('HSET', KEYS[1], '__chunks__',
+    string.format('%d %d', length, size))
+return length
+"""
+
+# KEYS[1] chunked file, ARGV length.  truncate(2) for a chunked file:
+# chunks past length are dropped and the last one cut short; growing only
+# changes the manifest.  Returns the new length.
+CHUNKTRUNCATE = """
+local manifest = redis.call('HGET', KEYS[1], '__chunks__')
+if not manifest then
+  return redis.error_reply('ERR not a chunked file')
+end
+local old, size = string.match(manifest, '(%d+) (%d+)')
+old, size = tonumber(old), tonumber(size)
+local length = tonumber(ARGV[1])
+if length < old then
+  local keep = math.ceil(length / size)
+  for index = keep, math.ceil(old / size) - 1 do
+    redis.call('HDEL', KEYS[1], string.format('%d', index))
+  end
+  local tail = length - (keep - 1) * size
+  if keep > 0 and tail < size then
+    local field = string.format('%d', keep - 1)
+    local chunk = redis.call('HGET', KEYS[1], field)
+    if chunk and #chunk > tail then
+      redis.call('HSET', KEYS[1], field, string.sub(chunk, 1, tail))
+    end
+  end
+end
+redis.call('HSET', KEYS[1], '__chunks__',
+    string.format('%d %d', length, size))
+return length
+"""
+
+SOURCES = {'hgetrange': HGETRANGE, 'hsetrange': HSETRANGE,
+    'truncate': TRUNCATE, 'chunkgetrange': CHUNKGETRANGE,
+    'chunksetrange': CHUNKSETRANGE, 'chunktruncate': CHUNKTRUNCATE}
+
+
+class Scripts(object):
+  """The scripts, registered with one redis client.
+
+     Each is a method taking the script's keys and arguments in order
+     (scripts.hsetrange(key, field, offset, data)).  Given client=, the
+     call goes there instead.  A pipeline just queues it; run the pipeline
+     with execute() so lost scripts are handled."""
+
+  def __init__(self, client):
+    self.client = client
+    self.scripts = dict((name, client.register_script(source))
+        for (name, source) in SOURCES.items())
+
+  def load(self):
+    """Send every script to the server, in one round trip (one per
+       primary on a cluster, where each node has its own script cache)."""
+    primaries = getattr(self.client, 'primaries', None)
+    for client in primaries() if primaries else [self.client]:
+      pipe = client.pipeline(transaction=False)
+      for source in SOURCES.values():
+        pipe.script_load(source)
+      pipe.execute()
+
+  def run(self, name, keys, args, client=None):
+    script = self.scripts[name]
+    if not hasattr(client, 'execute'):   # not a pipeline
+      # Script loads itself and retries on NOSCRIPT
+      return script(keys=keys, args=args, client=client)
+    # queued straight onto the pipeline: Script would have the pipeline
+    # check SCRIPT EXISTS first, an extra round trip every time
+    return client.evalsha(script.sha, len(keys), *(keys + args))
+
+  def execute(self, queue):
+    """Run the commands queue(pipeline) adds in a pipeline and return
+       their replies.  If the server has lost our scripts they're loaded
+       again and the whole pipeline is run a second time, so queue must
+       only add commands that are safe to repeat."""
+    for retry in (False, True):
+      pipe = self.client.pipeline(transaction=False)
+      queue(pipe)
+      try:
+        return pipe.execute()
+      except NoScriptError:
+        if retry:
+          raise
+        self.load()
+
+  def hgetrange(self, key, field, start, end, client=None):
+    return self.run('hgetrange', [key], [field, start, end], client)
+
+  def hsetrange(self, key, field, offset, data, client=None):
+    return self.run('hsetrange', [key], [field, offset, data], client)
+
+  def truncate(self, key, length, field=None, client=None):
+    args = [length, field] if field else [length]
+    return self.run('truncate', [key], args, client)
+
+  def chunkgetrange(self, key, start, end, client=None):
+    return self.run('chunkgetrange', [key], [start, end], client)
+
+  def chunksetrange(self, key, offset, data, client=None):
+    return self.run('chunksetrange', [key], [offset, data], client)
+
+  def chunktruncate(self, key, length, client=None):
+    return self.run('chunktruncate', [key], [length], client)
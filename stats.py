@@ -0,0 +1,156 @@
+"""Operation statistics.
+
+Every filesystem operation is counted and timed by TimeOps, and every
+round trip to redis is charged to the operation that caused it (see
+Stats.round_trip; the redis connection calls it).  The filesystem shows
+the numbers as the virtual files /.stats and /.stats.json.
+"""
+
+import json
+from threading import Lock, local
+from timeit import default_timer
+
+# latency histogram buckets.  Values below 16us get a bucket each, above
+# that every power of two is split into 8, so any percentile we report is
+# within 12.5% of the real one.
+SUB_BUCKETS = 8
+BUCKETS = 256
+
+# round trips made outside any operation (watcher, sweeps, tracking)
+BACKGROUND = '(background)'
+
+
+def bucket(us):
+  if us < 2 * SUB_BUCKETS:
+    return us
+  shift = us.bit_length() - 4
+  return min(shift * SUB_BUCKETS + (us >> shift), BUCKETS - 1)
+
+
+def bucket_limit(index):
+  """Largest number of microseconds landing in bucket index."""
+  if index < 2 * SUB_BUCKETS:
+    return index
+  shift = index // SUB_BUCKETS - 1
+  return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+
+class OpStats(object):
+  def __init__(self):
+    self.lock = Lock()
+    self.reset()
+
+  def reset(self):
+    self.calls = 0
+    self.errors = 0
+    self.bytes = 0
+    self.trips = 0
+    self.max_us = 0
+    self.buckets = [0] * BUCKETS
+
+  def record(self, us, size, failed):
+    with self.lock:
+      self.calls += 1
+      self.errors += failed
+      self.bytes += size
+      self.buckets[bucket(us)] += 1
+      if us > self.max_us:
+        self.max_us = us
+
+  def percentile(self, fraction):
+    """Microseconds fraction of the calls finished within."""
+    wanted = fraction * self.calls
+    seen = 0
+    for index, n in enumerate(self.buckets):
+      seen += n
+      if n and seen >= wanted:
+        return min(bucket_limit(index), self.max_us)
+    return 0
+
+  def as_dict(self):
+    return dict(calls=self.calls, errors=self.errors, bytes=self.bytes,
+        round_trips=self.trips, p50_ms=self.percentile(0.5) / 1000.0,
+        p99_ms=self.percentile(0.99) / 1000.0, max_ms=self.max_us / 1000.0)
+
+
+class Stats(object):
+  def __init__(self):
+    self.ops = {}
+    self.lock = Lock()
+    self.current = local()   # the OpStats of the op each thread is running
+    self.since = default_timer()
+
+  def op(self, name):
+    stats = self.ops.get(name)
+    if stats is None:
+      with self.lock:
+        stats = self.ops.setdefault(name, OpStats())
+    return stats
+
+  def round_trip(self, op=None):
+    """Charge a round trip to op, by default the one this thread is
+       running."""
+    stats = op or getattr(self.current, 'op', None) or self.op(BACKGROUND)
+    with stats.lock:
+      stats.trips += 1
+
+  def reset(self):
+    for stats in self.ops.values():
+      with stats.lock:
+        stats.reset()
+    self.since = default_timer()
+
+  def as_dict(self, **extra):
+    report = dict(seconds=default_timer() - self.since,
+        ops=dict((name, stats.as_dict())
+            for (name, stats) in self.ops.items() if stats.calls or
+            stats.trips))
+    report.update(extra)
+    return report
+
+  def json(self, **extra):
+    return json.dumps(self.as_dict(**extra), indent=2,
+        sort_keys=True) + "\n"
+
+  def text(self, **extra):
+    report = self.as_dict(**extra)
+    lines = ['%.0f seconds' % report.pop('seconds'),
+        '%-14s %8s %6s %12s %8s %8s %8s %8s %6s' % ('op', 'calls', 'errors',
+            'bytes', 'p50 ms', 'p99 ms', 'max ms', 'trips', '/call')]
+    for (name, op) in sorted(report.pop('ops').items()):
+      per_call = float(op['round_trips']) / op['calls'] if op['calls'] else 0
+      lines.append('%-14s %8d %6d %12d %8.3f %8.3f %8.3f %8d %6.2f' % (name,
+          op['calls'], op['errors'], op['bytes'], op['p50_ms'],
+          op['p99_ms'], op['max_ms'], op['round_trips'], per_call))
+    for (name, section) in sorted(report.items()):
+      lines.append('%s: %s' % (name, ' '.join('%s %s' % item
+          for item in sorted(section.items()))))
+    return '\n'.join(lines) + '\n'
+
+
+def payload(op, args, ret):
+  """Bytes moved by an operation: read's result or write's data."""
+  if op == 'read' and ret:
+    return len(ret)
+  if op == 'write':
+    return len(args[1])
+  return 0
+
+
+class TimeOps(object):
+  """Mixin for Operations recording each call in self.stats."""
+
+  def __call__(self, op, *args):
+    stats = self.stats.op(op)
+    self.stats.current.op = stats
+    start = default_timer()
+    ret = None
+    failed = True
+    try:
+      ret = super(TimeOps, self).__call__(op, *args)
+      failed = False
+      return ret
+    finally:
+      self.stats.current.op = None
+      stats.record(int((default_timer() - start) * 1e6),
+          payload(op, args, ret), failed)
@@ -0,0 +1,110 @@
+"""Write-back buffering for open file handles.
+
+The kernel hands us writes in small chunks (4 KB for most editors, up to
+128 KB for cp/dd).  Sending each chunk to redis as it arrives costs a round
+trip per chunk, and for hash fields a full read/modify/write of the field.
+Instead every open file handle collects its writes here and the filesystem
+pushes them to redis on flush, fsync or release (or once too many bytes are
+dirty).
+"""
+
+from bisect import bisect_left
+from threading import RLock
+
+
+class WriteBuffer(object):
+  """Dirty byte ranges written through one file handle.
+
+     Extents are kept sorted and non-overlapping.  Writes that overlap or
+     touch an existing extent are merged into it, so sequential writes
+     collapse into a single extent no matter how many chunks they arrive
+     in."""
+
+  def __init__(self, path):
+    self.path = path
+    self.offsets = []   # start offset of each extent, sorted
+    self.extents = []   # bytearray for each extent, parallel to offsets
+    self.dirty = 0
+    self.base = 0       # size of the value when the buffer was last empty
+    # the kernel may write and flush through one handle from several
+    # threads at once
+    self.lock = RLock()
+
+  def __len__(self):
+    return self.dirty
+
+  def end(self):
+    """Offset one past the last dirty byte."""
+    if not self.extents:
+      return 0
+    return self.offsets[-1] + len(self.extents[-1])
+
+  def write(self, offset, data):
+    end = offset + len(data)
+
+    # fast path: appending right after the last extent (sequential writes)
+    if self.extents and self.end() == offset:
+      self.extents[-1].extend(data)
+      self.dirty += len(data)
+      return
+
+    # find every extent overlapping or touching [offset, end]
+    first = bisect_left(self.offsets, offset)
+    if first > 0 and \
+       self.offsets[first - 1] + len(self.extents[first - 1]) >= offset:
+      first -= 1
+    last = first
+    while last < len(self.offsets) and self.offsets[last] <= end:
+      last += 1
+
+    if first == last:
+      self.offsets.insert(first, offset)
+      self.extents.insert(first, bytearray(data))
+      self.dirty += len(data)
+      return
+
+    start = min(offset, self.offsets[first])
+    stop = max(end, self.offsets[last - 1] + len(self.extents[last - 1]))
+    merged = bytearray(stop - start)
+    for i in xrange(first, last):
+      o = self.offsets[i] - start
+      merged[o:o + len(self.extents[i])] = self.extents[i]
+      self.dirty -= len(self.extents[i])
+    merged[offset - start:end - start] = data
+
+    self.offsets[first:last] = [start]
+    self.extents[first:last] = [merged]
+    self.dirty += len(merged)
+
+  def truncate(self, length):
+    """Forget anything written at or past length."""
+    while self.extents and self.offsets[-1] >= length:
+      self.offsets.pop()
+      self.dirty -= len(self.extents.pop())
+    if self.extents and self.end() > length:
+      cut = self.end() - length
+      del self.extents[-1][-cut:]
+      self.dirty -= cut
+
+  def covers(self, size):
+    """True if the dirty data alone describes the first size bytes, so the
+       existing value never needs to be read back to apply it."""
+    return len(self.extents) == 1 and self.offsets[0] == 0 and \
+        len(self.extents[0]) >= size
+
+  def splice(self, existing):
+    """Apply the dirty extents on top of existing and return the result."""
+    value = bytearray(existing or '')
+    for offset, data in zip(self.offsets, self.extents):
+      if len(value) < offset:
+        value.extend('\0' * (offset - len(value)))
+      value[offset:offset + len(data)] = data
+    return str(value)
+
+  def items(self):
+    return zip(self.offsets, self.extents)
+
+  def clear(self):
+    self.offsets = []
+    self.extents = []
+    self.dirty = 0